@@ -32,6 +32,7 @@ from PIL import ImageGrab
 import json
 
 from util.affine_transform import AffineTransform
+from util.tiff_synthesizer import load_crop, read_tif
 
 from util.main_window import MainWindow
 from atp_editor.atp_editor import ATPEditor
@@ -129,6 +130,18 @@ class Main(MainWindow):
             "Open A Folder Containing Rotated Image Files")
         openRotImgFolder.triggered.connect(self.open_rotated_images_folder)
 
+        autoRegister = QAction("Auto Register...", self)
+        autoRegister.setShortcut("Ctrl+R")
+        autoRegister.setStatusTip(
+            "Register The Rotated Images To The Base Images Automatically")
+        autoRegister.triggered.connect(self.auto_register)
+
+        scanSimilarity = QAction("Scan Similarity...", self)
+        scanSimilarity.setShortcut("Ctrl+L")
+        scanSimilarity.setStatusTip(
+            "Scan The Similarity Around The Current Rotated Parameters")
+        scanSimilarity.triggered.connect(self.scan_similarity)
+
         quitApp = QAction("Quit", self)
         quitApp.setShortcut("Ctrl+Q")
         quitApp.setStatusTip("Quit This Application")
@@ -167,6 +180,9 @@ class Main(MainWindow):
         fileMenu.addAction(openBaseImgFolder)
         fileMenu.addAction(openRotImgFolder)
         fileMenu.addSeparator()
+        fileMenu.addAction(autoRegister)
+        fileMenu.addAction(scanSimilarity)
+        fileMenu.addSeparator()
         fileMenu.addAction(quitApp)
 
         #editMenu.addAction(Undo)
@@ -189,7 +205,15 @@ Ctrl+T Export
     merge all matching datafiles (using one from 
     each of the four folders) after transforming 
     the images according to the parameters set 
-    for each image.""")
+    for each image.
+Ctrl+R Auto Register
+    estimate the parameters of the rotated images
+    (nominal rotation +- search range) so that they
+    overlap the transformed base images.
+Ctrl+L Scan Similarity
+    ZNCC of small offsets (position, rotation) around
+    the current rotated parameters, the best one can
+    be applied.""")
         M.exec()
 
     def mouse(self):
@@ -225,6 +249,80 @@ Shift
         self.editor.open_folder(
             "rotated", dialog_message="Open Rotated Images Folder")
 
+    def auto_register(self):
+        rotated = self.editor.folders["rotated"]
+        if self.editor.folders["base"].raw_img is None or rotated.raw_img is None:
+            QMessageBox.warning(self, "Auto Register", "Open both images folders first.")
+            return
+        psi, ok = QInputDialog.getDouble(
+            self, "Auto Register", "Nominal rotation [deg]:",
+            rotated.transform.get_rotation_degree(), -360.0, 360.0, 2)
+        if not ok:
+            return
+        search, ok = QInputDialog.getDouble(
+            self, "Auto Register", "Rotation search range [deg]:", 5.0, 0.0, 180.0, 2)
+        if not ok:
+            return
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            result = self.editor.auto_register(psi, search_deg=search)
+        finally:
+            QApplication.restoreOverrideCursor()
+        if result is None:
+            return
+        QMessageBox.information(
+            self, "Auto Register",
+            f"position: ({result['px']:.2f}, {result['py']:.2f})\n"
+            f"rotation: {np.degrees(result['rz']):.3f} deg\n"
+            f"scale: ({result['sx']:.4f}, {result['sy']:.4f})\n"
+            f"ZNCC: {result['score']:.4f}")
+
+    def scan_similarity(self):
+        rotated = self.editor.folders["rotated"]
+        if self.editor.folders["base"].raw_img is None or rotated.raw_img is None:
+            QMessageBox.warning(self, "Scan Similarity", "Open both images folders first.")
+            return
+        shift, ok = QInputDialog.getDouble(
+            self, "Scan Similarity", "Position range [px]:", 16.0, 1.0, 500.0, 1)
+        if not ok:
+            return
+        rotation, ok = QInputDialog.getDouble(
+            self, "Scan Similarity", "Rotation range [deg]:", 1.0, 0.0, 30.0, 2)
+        if not ok:
+            return
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            result = self.editor.scan_similarity(shift=shift, rotation_deg=rotation)
+        except ValueError as e:
+            result = None
+            QMessageBox.warning(self, "Scan Similarity", str(e))
+        finally:
+            QApplication.restoreOverrideCursor()
+        if result is None:
+            return
+        best = result["best"]
+        px, py = rotated.transform.get_position()
+        rz = rotated.transform.get_rotation_degree()
+        # 回転ごとの ZNCC の最大値
+        rows = "\n".join(
+            f"{a:+7.3f} deg: {np.nanmax(s):.4f}" for a, s in zip(result["angles"], result["scores"]))
+        M = QMessageBox(self)
+        M.setWindowTitle("Scan Similarity")
+        M.setText(
+            f"ZNCC: {result['current']:.4f} (current) -> {best['score']:.4f} (best)\n"
+            f"position: ({best['px']:.2f}, {best['py']:.2f}) "
+            f"[{best['px'] - px:+.2f}, {best['py'] - py:+.2f}]\n"
+            f"rotation: {np.degrees(best['rz']):.3f} deg "
+            f"[{np.degrees(best['rz']) - rz:+.3f}]\n\n"
+            "Apply the best parameters?")
+        M.setDetailedText(
+            f"scan on 1/{2 ** result['level']} images, "
+            f"position step {2 ** result['level']} px\n"
+            f"max ZNCC for each rotation offset:\n{rows}")
+        M.setStandardButtons(QMessageBox.Yes | QMessageBox.No)
+        if M.exec() == QMessageBox.Yes:
+            rotated.set_params(best)
+
     def layout_widgets(self):
         self.setCentralWidget(self.mainContainer)
 
@@ -296,7 +394,9 @@ Shift
         files = list(src_dir.glob("*.tif"))
         if not files:
             return
-        im = tiff.imread(files[0])
+        # virtual crop (crop.json) of the folder: only the cropped maps are transformed
+        crop = load_crop(src_dir)
+        im = read_tif(files[0], crop)
         h, w = im.shape
         transform.set_origin(w // 2, h // 2)
         M = transform.M()
@@ -308,7 +408,7 @@ Shift
             self.synth_progress.setValue(((i+1)*100)//n)
             
             print(f)
-            im = tiff.imread(f)
+            im = read_tif(f, crop)
             h, w = im.shape
             # dst = cv2.warpAffine(im, M, (w, h), borderMode=cv2.BORDER_REPLICATE)
             dst = cv2.warpAffine(im, M, (w, h), borderMode=cv2.BORDER_CONSTANT,borderValue=np.nan)
@@ -5,10 +5,13 @@ from pathlib import Path
 #import msgpack
 #import msgpack_numpy
 
+from math import radians
+
 from PyQt5.QtCore import QObject
 
 from util.folder import Folder
 from util.editor import Editor
+from util import registration
 
 
 LOGFORM = logging.Formatter(
@@ -69,6 +72,53 @@ class ATPEditor(Editor):
         self.write_dict_to_file(self.file_name_path, dict_data)
         return True
 
+    def auto_register(self, psi_deg: float = None, **kwargs) -> dict:
+        """
+        rotated の合成画像を base の変換後の合成画像に自動で位置合わせし、rotated のパラメータに設定する。
+        psi_deg は名目の回転 [deg] (None なら現在の回転)、kwargs は registration.register の引数。
+        """
+        base, rotated = self.folders["base"], self.folders["rotated"]
+        if base.raw_img is None or rotated.raw_img is None:
+            logger.warning("auto_register: images are not synthesized")
+            return None
+        fixed = registration.base_image(base.raw_img, self._params(base.transform))
+        init = self._params(rotated.transform)
+        if psi_deg is not None:
+            init["rz"] = radians(psi_deg)
+        result = registration.register(
+            fixed, rotated.raw_img, init,
+            origin=rotated.transform.get_origin(), **kwargs)
+        logger.info(f"auto_register: {result['px']}, {result['py']}, "
+                    f"{result['rz']}, {result['sx']}, {result['sy']}, "
+                    f"score={result['score']}")
+        rotated.set_params(result)
+        return result
+
+    def scan_similarity(self, **kwargs) -> dict:
+        """
+        rotated の現在のパラメータの周りで ZNCC の地形を求める (パラメータは変更しない)。
+        kwargs は registration.scan の引数。結果の 'best' は set_params に渡せる。
+        """
+        base, rotated = self.folders["base"], self.folders["rotated"]
+        if base.raw_img is None or rotated.raw_img is None:
+            logger.warning("scan_similarity: images are not synthesized")
+            return None
+        fixed = registration.base_image(base.raw_img, self._params(base.transform))
+        result = registration.scan(
+            fixed, rotated.raw_img, self._params(rotated.transform),
+            origin=rotated.transform.get_origin(), **kwargs)
+        best = result["best"]
+        logger.info(f"scan_similarity: current={result['current']}, "
+                    f"best={best['score']} at {best['px']}, {best['py']}, {best['rz']}")
+        return result
+
+    @staticmethod
+    def _params(transform) -> dict:
+        px, py = transform.get_position()
+        sx, sy = transform.get_scale()
+        return {"px": px, "py": py, "rz": transform.get_rotation_radian(),
+                "sx": sx, "sy": sy}
+
     def load_data_from_dict(self, dict_data: dict) -> None:
         dict_f = dict_data["folders"]
         for key, folder in self.folders.items():
@@ -8,7 +8,8 @@ from PyQt5.QtWidgets import (
 )
 from PyQt5.QtGui import (
     QImage,
-    QPixmap
+    QPixmap,
+    QTransform
 )
 
 from common_widgets.image_view import ImageView
@@ -22,6 +23,7 @@ class DiffView(QFrame):
         self.editor = editor
         self.im_bin_b: np.ndarray = None
         self.im_bin_r: np.ndarray = None
+        self.im_prev_b: np.ndarray = None
         self.setFrameStyle(QFrame.StyledPanel)
 
         folder_b_key = "base"
@@ -59,9 +61,20 @@ class DiffView(QFrame):
             self.on_folder_b_generaged_bin_img)
         self.folder_r.generated_bin_image_transformed.connect(
             self.on_folder_r_generated_bin_img)
+        self.folder_b.generated_bin_image_preview.connect(
+            self.on_folder_b_generated_preview)
+        self.folder_r.generated_bin_image_transformed_preview.connect(
+            self.on_folder_r_generated_preview)
 
-    def update_diff_image(self) -> None:
-        diff = cv2.absdiff(self.im_bin_b, self.im_bin_r)
+    def update_diff_image(self, im_bin_b: np.ndarray = None, im_bin_r: np.ndarray = None, scale: float = 1.0) -> None:
+        """
+        差分画像を表示する。縮小画像のときは scale 倍して元の大きさで表示する。
+        """
+        if im_bin_b is None:
+            im_bin_b, im_bin_r = self.im_bin_b, self.im_bin_r
+        if im_bin_b is None or im_bin_r is None or im_bin_b.shape != im_bin_r.shape:
+            return
+        diff = cv2.absdiff(im_bin_b, im_bin_r)
         image = QImage(
             diff,
             diff.shape[1],
@@ -71,6 +84,7 @@ class DiffView(QFrame):
         )
         pixmap = QPixmap.fromImage(image)
         self.view.update_pixmapitem("diff", pixmap)
+        self.view.set_transform_mapitem("diff", QTransform.fromScale(scale, scale))
 
     def on_folder_b_generaged_bin_img(self, im_bin: np.ndarray) -> None:
         self.im_bin_b = im_bin
@@ -78,3 +92,13 @@ class DiffView(QFrame):
     def on_folder_r_generated_bin_img(self, im_bin: np.ndarray) -> None:
         self.im_bin_r = im_bin
         self.update_diff_image()
+
+    def on_folder_b_generated_preview(self, im_bin: np.ndarray) -> None:
+        self.im_prev_b = im_bin
+
+    def on_folder_r_generated_preview(self, im_bin: np.ndarray) -> None:
+        # NOTE: 最初の表示は元の解像度で行う (ビューの拡大率を合わせるため)。
+        if "diff" not in self.view.dict_items:
+            return
+        level = self.folder_r.preview_level
+        self.update_diff_image(self.im_prev_b, im_bin, 2 ** level)
@@ -1,5 +1,6 @@
 import numpy as np
 from PyQt5.QtWidgets import (
+    QApplication,
     QWidget,
     QFrame,
     QLabel,
@@ -7,9 +8,10 @@ from PyQt5.QtWidgets import (
     QGridLayout,
     QLineEdit
 )
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QThread
 
 from util.editor import Editor
+from util.similarity import SimilarityWorker
 
 
 class SimilarityIndicator(QFrame):
@@ -19,6 +21,8 @@ class SimilarityIndicator(QFrame):
         self.editor = editor
         self.im_bin_b: np.ndarray = None
         self.im_bin_r: np.ndarray = None
+        self.im_prev_b: np.ndarray = None
+        self.im_prev_r: np.ndarray = None
         self.ncc_val = 0.0
         self.zncc_val = 0.0
         self.setFrameStyle(QFrame.StyledPanel)
@@ -35,6 +39,13 @@ class SimilarityIndicator(QFrame):
             return
         self.folder_r = self.editor.folders[folder_r_key]
 
+        # 類似度はワーカースレッドで計算する。
+        self.thread = QThread(self)
+        self.worker = SimilarityWorker()
+        self.worker.moveToThread(self.thread)
+        self.worker.requested.connect(self.worker.run)
+        self.thread.start()
+
         self.create_widgets()
         self.create_actions()
         self.layout_widgets()
@@ -72,36 +83,50 @@ class SimilarityIndicator(QFrame):
             self.on_folder_b_generaged_bin_img)
         self.folder_r.generated_bin_image_transformed.connect(
             self.on_folder_r_generated_bin_img)
-
-    def update_display(self) -> None:
+        self.folder_b.generated_bin_image_transformed_preview.connect(
+            self.on_folder_b_generated_preview)
+        self.folder_r.generated_bin_image_transformed_preview.connect(
+            self.on_folder_r_generated_preview)
+        self.worker.calculated.connect(self.on_worker_calculated)
+        QApplication.instance().aboutToQuit.connect(self.stop_thread)
+
+    def stop_thread(self) -> None:
+        self.thread.quit()
+        self.thread.wait()
+
+    def update_display(self, is_preview: bool = False) -> None:
+        # 縮小画像での値は (preview) と表示する。
+        self.title_label.setText("Similarity (preview)" if is_preview else "Similarity")
         self.ncc_val_le.setText(f"{self.ncc_val:.4f}")
         self.zncc_val_le.setText(f"{self.zncc_val:.4f}")
 
     def calc_similarity(self) -> None:
         if self.im_bin_b is None or self.im_bin_r is None:
             return
-        self.ncc_val = self.ncc(self.im_bin_b, self.im_bin_r)
-        self.zncc_val = self.zncc(self.im_bin_b, self.im_bin_r)
-        self.update_display()
-
-    def ncc(self, mat1: np.ndarray, mat2: np.ndarray) -> float:
-        sum = np.sum(mat1 * mat2)
-        n1 = np.linalg.norm(mat1)
-        n2 = np.linalg.norm(mat2)
-        if n1 ==0 or n2 == 0:
-            return 0
-        else:
-            return sum / (n1*n2)
-
-    def zncc(self, mat1: np.ndarray, mat2: np.ndarray) -> float:
-        m1 = mat1 - mat1.mean()
-        m2 = mat2 - mat2.mean()
-        return self.ncc(m1, m2)
+        self.worker.submit(self.im_bin_b, self.im_bin_r, False)
+
+    def calc_similarity_preview(self) -> None:
+        if self.im_prev_b is None or self.im_prev_r is None:
+            return
+        self.worker.submit(self.im_prev_b, self.im_prev_r, True)
+
+    def on_worker_calculated(self, ncc: float, zncc: float, is_preview: bool) -> None:
+        self.ncc_val = ncc
+        self.zncc_val = zncc
+        self.update_display(is_preview)
 
     def on_folder_b_generaged_bin_img(self, im_bin: np.ndarray) -> None:
-        self.im_bin_b = im_bin.astype(np.float32)
+        self.im_bin_b = im_bin
         self.calc_similarity()
         
     def on_folder_r_generated_bin_img(self, im_bin: np.ndarray) -> None:
-        self.im_bin_r = im_bin.astype(np.float32)
+        self.im_bin_r = im_bin
         self.calc_similarity()
+
+    def on_folder_b_generated_preview(self, im_bin: np.ndarray) -> None:
+        self.im_prev_b = im_bin
+        self.calc_similarity_preview()
+
+    def on_folder_r_generated_preview(self, im_bin: np.ndarray) -> None:
+        self.im_prev_r = im_bin
+        self.calc_similarity_preview()
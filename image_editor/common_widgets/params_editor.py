@@ -1,3 +1,4 @@
+import copy
 import logging
 from logging.handlers import RotatingFileHandler
 from os import makedirs
@@ -168,14 +169,16 @@ class ParamsEditor(QFrame):
         self.setEnabled(True)
 
     def on_folder_loaded_transform(self, trans: AffineTransform) -> None:
+        # NOTE: フォルダーには設定済みなので、表示の更新で再設定しない (丸めた値で上書きしない)。
+        self.transform = copy.deepcopy(trans)
         px, py = trans.get_position()
         rz = trans.get_rotation_degree()
         sx, sy = trans.get_scale()
-        self.pos_sb_x.setValue(px)
-        self.pos_sb_y.setValue(py)
-        self.rot_sb.setValue(rz)
-        self.scl_sb_x.setValue(sx)
-        self.scl_sb_y.setValue(sy)
+        sbs = (self.pos_sb_x, self.pos_sb_y, self.rot_sb, self.scl_sb_x, self.scl_sb_y)
+        for sb, val in zip(sbs, (px, py, rz, sx, sy)):
+            sb.blockSignals(True)
+            sb.setValue(val)
+            sb.blockSignals(False)
 
     def on_update_position(self, val: float) -> None:
         self.transform.set_position(
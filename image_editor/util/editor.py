@@ -33,7 +33,9 @@ class Editor(QObject):
         if p == "":
             return p
         self.changed_folder_path.emit(key, p)
-        self.synthesize_folder_images(key)
+        # キャッシュした合成画像が有効なら合成しない (step の入力も不要)
+        if not self.folders[key].load_cached_images():
+            self.synthesize_folder_images(key)
 
     def synthesize_folder_images(self, key: str):
         print(f"SYNTH0 {key}")
@@ -60,6 +62,8 @@ the result is, and the longer it takes.)""",
         if not is_ok:
             return
         print(f"SYNTH4 {key}")        
+        if self.folders[key].load_cached_images(step):
+            return
         self.folders[key].synthesize_images(self.parent(), step)
         print(f"SYNTH5 {key}")
         
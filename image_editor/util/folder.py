@@ -1,7 +1,7 @@
 from os.path import isdir
 from pathlib import Path
 import copy
-from PyQt5.QtCore import QObject, Qt, QThread, pyqtSignal
+from PyQt5.QtCore import QObject, Qt, QThread, QTimer, pyqtSignal
 from PyQt5.QtGui import QImage, QPixmap, QColor
 from PyQt5.QtWidgets import (
     QWidget,
@@ -13,8 +13,14 @@ from PyQt5.QtWidgets import (
 import numpy as np
 import cv2
 
-from util.tiff_synthesizer import TiffSynthesizer, TiffSynthWorker
+from util.tiff_synthesizer import (
+    TiffSynthesizer,
+    TiffSynthWorker,
+    load_synth_cache,
+    save_synth_cache
+)
 from util.affine_transform import AffineTransform
+from util.similarity import REFRESH_DELAY, preview_level, preview_matrix, shrink
 
 
 # TODO: 別のフォルダーを開くときに既存のデータをリセットしてシグナルを発信する処理を追加。
@@ -22,6 +28,8 @@ class Folder(QObject):
     generated_disp_image = pyqtSignal(QPixmap)
     generated_bin_image = pyqtSignal(np.ndarray)
     generated_bin_image_transformed = pyqtSignal(np.ndarray)
+    generated_bin_image_preview = pyqtSignal(np.ndarray)
+    generated_bin_image_transformed_preview = pyqtSignal(np.ndarray)
     generated_raw_image_transformed = pyqtSignal(np.ndarray)
     updated_path = pyqtSignal(str)
     updated_transform = pyqtSignal(AffineTransform)
@@ -42,9 +50,12 @@ class Folder(QObject):
         self.raw_img_transformed: np.ndarray = None
         self.bin_img: np.ndarray = None
         self.bin_img_transformed: np.ndarray = None
+        self.bin_img_preview: np.ndarray = None
+        self.preview_level = 0
         self.image_img: QImage = None
         self.pm_img: QPixmap = None
         self.step: int = 16
+        self.spike_threshold: int = 64000
         self.is_synth_ready = False
         self.opacity = 1.0
         self.is_visible = True
@@ -54,6 +65,12 @@ class Folder(QObject):
         self.threshold = 0.0
         self.color = {"r": 255, "g": 0, "b": 0, "a": 255}
 
+        # 操作中は縮小画像だけを変換し、操作が止まってから元の解像度で変換する。
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setSingleShot(True)
+        self.refresh_timer.setInterval(REFRESH_DELAY)
+        self.refresh_timer.timeout.connect(self.generate_image_transformed_full)
+
     # FIXME: 思いがけず意図しない transform を設定しかねないので少なくとも公開しないほうがよいか？
     def _set_transform(self, transform: AffineTransform) -> None:
         self.transform = copy.deepcopy(transform)
@@ -75,6 +92,18 @@ class Folder(QObject):
         self.updated_transform.emit(self.transform)
         self.generate_image_transformed()
 
+    def set_params(self, params: dict) -> None:
+        """
+        位置・回転 (rz はラジアン)・拡大率をまとめて設定する (自動位置合わせの結果など)。
+        loaded_transform でパラメータエディターの表示も更新する。
+        """
+        self.transform.set_position(params["px"], params["py"])
+        self.transform.set_rotation_radian(params["rz"])
+        self.transform.set_scale(params["sx"], params["sy"])
+        self.loaded_transform.emit(self.transform)
+        self.updated_transform.emit(self.transform)
+        self.generate_image_transformed()
+
     def get_transform(self) -> AffineTransform:
         return copy.deepcopy(self.transform)
 
@@ -200,6 +229,28 @@ class Folder(QObject):
         self.is_synth_ready = True
         return p
 
+    def load_cached_images(self, step: int = None) -> bool:
+        """
+        フォルダーにキャッシュした合成画像 (save_synth_cache) があれば読み込んで True を返す。
+        step が None なら最も step の小さいキャッシュを使う。
+        """
+        if not self.is_synth_ready or self.path == "":
+            return False
+        cache = load_synth_cache(self.path, step, self.spike_threshold)
+        if cache is None:
+            return False
+        image, step = cache
+        print(f"Folder (\"{self.name}\") Loaded Cached Image (step: {step}).")
+        self.set_synth_image(image, step)
+        return True
+
+    def set_synth_image(self, image: np.ndarray, step: int) -> None:
+        self.raw_img = image
+        self.mean = self.threshold = np.median(self.raw_img)
+        self.set_step(step)
+        self.generate_display_image()
+        self.generate_image_transformed()
+
     def synthesize_images(self, parent: QWidget, step: int) -> None:
         if not self.is_synth_ready:
             print(f"Folder (\"{self.name}\") Is NOT Ready For Synthesizing.")
@@ -224,7 +275,7 @@ class Folder(QObject):
 
         # スレッドの初期化
         self.thread = QThread()
-        self.worker = TiffSynthWorker(self.path, step=step)
+        self.worker = TiffSynthWorker(self.path, self.spike_threshold, step=step)
         self.worker.moveToThread(self.thread)
         self.thread.started.connect(self.worker.run)
         self.worker.updated.connect(self.on_worker_updated)
@@ -256,11 +307,8 @@ class Folder(QObject):
 
     def on_worker_synthesized(self, image: np.ndarray):
         self.progress_cancel_btn.setEnabled(False)
-        self.raw_img = image
-        self.mean = self.threshold = np.median(self.raw_img)
-        self.set_step(self.tmp_step)
-        self.generate_display_image()
-        self.generate_image_transformed()
+        save_synth_cache(self.path, image, self.tmp_step, self.spike_threshold)
+        self.set_synth_image(image, self.tmp_step)
 
     def on_worker_aborted(self):
         self.close_progress()
@@ -299,6 +347,9 @@ class Folder(QObject):
         self.bin_img[:,w//2] = True        
         self.generated_bin_image.emit(self.bin_img)
         self.bin_img_transformed = self.bin_img
+        self.preview_level = preview_level(self.bin_img.shape)
+        self.bin_img_preview = shrink(self.bin_img, self.preview_level)
+        self.generated_bin_image_preview.emit(self.bin_img_preview)
         self.update_display_image_color()
         
     def update_display_image_color(self):
@@ -317,9 +368,22 @@ class Folder(QObject):
         self.generated_disp_image.emit(self.pm_img)
 
     def generate_image_transformed(self):
+        """
+        縮小画像を変換して generated_bin_image_transformed_preview を発信し、
+        REFRESH_DELAY の間に次の変更がなければ元の解像度で変換する。
+        """
         if self.raw_img is None:
             print(f"Folder (\"{self.name}\") DOSEN'T Have Any Image Data.")
             return
+        m = preview_matrix(self.transform.M(), self.preview_level)
+        h, w = self.bin_img_preview.shape
+        self.generated_bin_image_transformed_preview.emit(
+            cv2.warpAffine(self.bin_img_preview, m, (w, h)))
+        self.refresh_timer.start()
+
+    def generate_image_transformed_full(self):
+        if self.raw_img is None:
+            return
         m = self.transform.M()
         h, w = self.bin_img.shape
         self.bin_img_transformed = cv2.warpAffine(self.bin_img, m, (w, h))
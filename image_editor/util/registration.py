@@ -0,0 +1,429 @@
+"""
+合成画像どうしの自動位置合わせ (AffineTransform のパラメータ推定)
+
+ピラミッドの最も粗いレベルで回転角を名目の ψ 回転の周りで探索し (平行移動は位相相関)、
+細かいレベルに向かって ECC で精密化する。評価値は重なり部分の ZNCC。
+scan は現在のパラメータの周りの ZNCC の地形 (平行移動は FFT の相互相関、回転は並列) を求める。
+Qt を使わないので GUI なしでも使える。
+
+    python -m util.registration BASE_FOLDER ROTATED_FOLDER --psi 120 --step 4
+"""
+from concurrent.futures import ThreadPoolExecutor
+from math import atan2, cos, degrees, hypot, radians, sin
+import argparse
+import json
+
+import numpy as np
+import cv2
+
+# 回転以外の初期値 (AffineTransform と同じキー、rz はラジアン)
+DEFAULT_PARAMS = {"px": 0.0, "py": 0.0, "rz": 0.0, "sx": 1.0, "sy": 1.0}
+
+
+def normalize(image, lower=1, upper=99):
+    """
+    float32、パーセンタイル lower-upper でクリップし平均 0・標準偏差 1 にした画像 (nan は 0)
+    """
+    image = np.asarray(image, dtype=np.float32)
+    finite = np.isfinite(image)
+    if not finite.any():
+        return np.zeros(image.shape, np.float32)
+    lo, hi = np.percentile(image[finite], (lower, upper))
+    out = np.clip(np.where(finite, image, lo), lo, hi).astype(np.float32)
+    out -= out.mean()
+    std = out.std()
+    return out / std if std > 0 else out
+
+
+def pyramid(image, min_size=256):
+    """
+    cv2.pyrDown のピラミッド [レベル 0 (元画像), 1, ...]、最後のレベルは短辺 <= min_size
+    """
+    levels = [image]
+    while min(levels[-1].shape[:2]) > min_size:
+        levels.append(cv2.pyrDown(levels[-1]))
+    return levels
+
+
+def params_matrix(px, py, rz, sx=1.0, sy=1.0, ox=0.0, oy=0.0):
+    """
+    AffineTransform.M() と同じ 3x3 行列 (origin 周りの回転・拡大と平行移動)
+    """
+    a = np.array([[sx * cos(rz), -sy * sin(rz)],
+                  [sx * sin(rz), sy * cos(rz)]])
+    m = np.eye(3)
+    m[:2, :2] = a
+    m[:2, 2] = np.array([px + ox, py + oy]) - a @ np.array([ox, oy])
+    return m
+
+
+def matrix_params(m, ox=0.0, oy=0.0):
+    """
+    params_matrix の逆 (せん断は無視)。rz はラジアン。
+    """
+    a = m[:2, :2]
+    rz = atan2(a[1, 0], a[0, 0])
+    sx = hypot(a[0, 0], a[1, 0])
+    sy = hypot(a[0, 1], a[1, 1]) * (1 if np.linalg.det(a) >= 0 else -1)
+    px, py = m[:2, 2] - np.array([ox, oy]) + a @ np.array([ox, oy])
+    return {"px": float(px), "py": float(py), "rz": float(rz), "sx": float(sx), "sy": float(sy)}
+
+
+def level_matrix(m, level):
+    """
+    レベル 0 の座標の行列 m をピラミッドのレベル level の座標に変換する
+    (pyrDown: x_l = x / 2^l)
+    """
+    d = _level_scale(level)
+    return d @ m @ np.linalg.inv(d)
+
+
+def warp(image, m, shape=None):
+    """
+    cv2.warpAffine (M は 3x3 でも 2x3 でも可)。範囲外は 0。
+    """
+    h, w = (image.shape if shape is None else shape)[:2]
+    return cv2.warpAffine(image, np.asarray(m, np.float64)[:2], (w, h),
+                          flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+
+def zncc(a, b, mask=None):
+    """
+    ZNCC (mask の画素のみ)。どちらかが一定値なら 0。
+    """
+    if mask is not None:
+        a = a[mask]
+        b = b[mask]
+    a = a - a.mean()
+    b = b - b.mean()
+    n = np.sqrt(np.sum(a * a) * np.sum(b * b))
+    return float(np.sum(a * b) / n) if n > 0 else 0.0
+
+
+def overlap(m, moving_shape, shape):
+    """
+    warp(moving, m, shape) のうち moving の内側の画素 (一部だけ覆われた端の画素を含む)
+    """
+    return warp(np.ones(moving_shape[:2], np.float32), m, shape) > 0
+
+
+def score(fixed, moving, m):
+    """
+    warp(moving, m) と fixed の重なり部分の ZNCC
+    """
+    return zncc(fixed, warp(moving, m, fixed.shape), overlap(m, moving.shape, fixed.shape))
+
+
+def phase_shift(fixed, moved, window=None):
+    """
+    moved を fixed に合わせる平行移動行列 (位相相関) と応答値
+    """
+    # NOTE: window を渡すと phaseCorrelate は入力の画像に窓関数を掛けてしまうのでコピーを渡す。
+    if window is not None:
+        fixed, moved = fixed.copy(), moved.copy()
+    (dx, dy), response = cv2.phaseCorrelate(fixed, moved, window)
+    t = np.eye(3)
+    t[:2, 2] = -dx, -dy
+    return t, response
+
+
+def search_rotation(fixed, moving, m, origin, angles):
+    """
+    origin 周りの回転 angles [rad] (m の回転に加える) ごとに位相相関で平行移動を求め、
+    ZNCC が最大の行列を返す。
+
+    Returns:
+        tuple: 行列, ZNCC, [(angle, ZNCC)]
+    """
+    window = cv2.createHanningWindow(fixed.shape[::-1], cv2.CV_32F)
+    ox, oy = origin
+    best = (m, -np.inf)
+    scores = []
+    for angle in angles:
+        r = params_matrix(0.0, 0.0, angle, ox=ox, oy=oy) @ m
+        t, _ = phase_shift(fixed, warp(moving, r, fixed.shape), window)
+        cand = t @ r
+        s = score(fixed, moving, cand)
+        scores.append((float(angle), s))
+        if s > best[1]:
+            best = (cand, s)
+    return best[0], best[1], scores
+
+
+def refine_ecc(fixed, moving, m, motion=cv2.MOTION_EUCLIDEAN, iterations=100, eps=1e-6):
+    """
+    ECC で m を精密化する。収束しなければ m をそのまま返す。
+
+    findTransformECC の euclidean は回転角を asin で求めるので 90 度を超える回転を扱えない。
+    moving を m で変換しておき、残りの小さな変換 W (fixed -> 変換後の座標) だけを求める。
+    """
+    moved = warp(moving, m, fixed.shape)
+    mask = overlap(m, moving.shape, fixed.shape).astype(np.uint8)
+    w = np.eye(2, 3, dtype=np.float32)
+    criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, iterations, eps)
+    try:
+        _, w = cv2.findTransformECC(fixed, moved, w, motion, criteria, mask, 5)
+    except cv2.error:
+        return m
+    res = np.eye(3)
+    res[:2] = w
+    return np.linalg.inv(res) @ m
+
+
+def register(fixed, moving, init=None, origin=None, search_deg=5.0, step_deg=None,
+             min_size=256, finest=0, motion="euclidean", iterations=100, eps=1e-6):
+    """
+    moving を fixed に重ねる AffineTransform のパラメータを推定する。
+
+    1. 両画像を normalize してピラミッドを作る
+    2. 最も粗いレベルで init の回転 ± search_deg を step_deg 刻みで探索 (平行移動は位相相関)
+    3. 粗いレベルから finest まで ECC で精密化 (motion: "euclidean" は拡大率を init に固定、"affine")
+
+    Args:
+        fixed (ndarray): 基準の画像 (base の変換後の合成画像)
+        moving (ndarray): 変換する画像 (rotated の合成画像)
+        init (dict, optional): 初期値 {'px', 'py', 'rz' [rad], 'sx', 'sy'}。名目の ψ 回転は rz に入れる。
+        origin (tuple, optional): 回転の中心 (Folder と同じく moving の中心 (w/2, h/2))
+        search_deg (float, optional): 回転の探索範囲 [deg]。0 なら探索しない。
+        step_deg (float, optional): 回転の探索間隔 [deg]。既定値は最も粗いレベルで端が 1 画素動く角度。
+        min_size (int, optional): 最も粗いレベルの短辺の上限。
+        finest (int, optional): ECC を行う最も細かいレベル (0: 元の解像度)。
+        motion (str, optional): "euclidean" か "affine"。
+        iterations (int, optional): ECC の反復回数。
+        eps (float, optional): ECC の収束判定。
+
+    Returns:
+        dict: {'px', 'py', 'rz' [rad], 'sx', 'sy', 'score' (finest での ZNCC), 'search' [(rz, ZNCC)]}
+    """
+    p = dict(DEFAULT_PARAMS, **(init or {}))
+    h, w = moving.shape[:2]
+    ox, oy = (w / 2, h / 2) if origin is None else origin
+    pyr_f = pyramid(normalize(fixed), min_size)
+    mov = normalize(moving)
+    # euclidean: 拡大率は固定し、先に moving に掛けておく (M = E @ S)
+    s = params_matrix(0.0, 0.0, 0.0, p["sx"], p["sy"], ox, oy)
+    if motion == "euclidean":
+        pyr_m = pyramid(warp(mov, s, mov.shape), min_size)
+        m = params_matrix(p["px"], p["py"], p["rz"], ox=ox, oy=oy)
+        ecc_motion = cv2.MOTION_EUCLIDEAN
+    elif motion == "affine":
+        pyr_m = pyramid(mov, min_size)
+        m = params_matrix(p["px"], p["py"], p["rz"], p["sx"], p["sy"], ox, oy)
+        ecc_motion = cv2.MOTION_AFFINE
+    else:
+        raise ValueError(f"unknown motion: {motion}")
+    top = min(len(pyr_f), len(pyr_m)) - 1
+    finest = min(max(finest, 0), top)
+
+    searched = []
+    if search_deg > 0:
+        if step_deg is None:
+            step_deg = degrees(2.0 / max(min(pyr_f[top].shape), 1))
+        n = int(np.ceil(search_deg / step_deg))
+        angles = np.radians(np.arange(-n, n + 1) * step_deg)
+        org = (_level_scale(top) @ np.array([ox, oy, 1.0]))[:2]
+        m_top, _, searched = search_rotation(pyr_f[top], pyr_m[top], level_matrix(m, top), org, angles)
+        m = _from_level(m_top, top)
+        searched = [(p["rz"] + a, sc) for a, sc in searched]
+
+    for level in range(top, finest - 1, -1):
+        m_level = refine_ecc(pyr_f[level], pyr_m[level], level_matrix(m, level), ecc_motion, iterations, eps)
+        m = _from_level(m_level, level)
+
+    final = score(pyr_f[finest], pyr_m[finest], level_matrix(m, finest))
+    if motion == "euclidean":
+        m = m @ s
+    result = matrix_params(m, ox, oy)
+    result["score"] = final
+    result["search"] = searched
+    return result
+
+
+def scan(fixed, moving, params, origin=None, shift=16.0, rotation_deg=1.0, step_deg=None,
+         max_size=512, min_overlap=0.5, workers=None):
+    """
+    params の周りの平行移動 ±shift [px] と回転 ±rotation_deg [deg] の格子で ZNCC を求める (類似度の地形)。
+
+    縮小画像 (短辺 <= max_size) の上で、回転の各サンプルについて重なり部分の ZNCC を
+    全ての平行移動に対して FFT の相互相関でまとめて求める。回転のサンプルはスレッドで並列に計算する。
+    回転は moving の中心 (origin) の行き先の周りなので、平行移動 0 は params の px, py のまま。
+
+    Args:
+        fixed (ndarray): 基準の画像 (base の変換後の合成画像)
+        moving (ndarray): 変換する画像 (rotated の合成画像)
+        params (dict): 現在のパラメータ {'px', 'py', 'rz' [rad], 'sx', 'sy'}
+        origin (tuple, optional): 回転の中心 (既定値は moving の中心 (w/2, h/2))
+        shift (float, optional): 平行移動の範囲 [px] (元の解像度)。刻みは縮小率 2^level [px]。
+        rotation_deg (float, optional): 回転の範囲 [deg]
+        step_deg (float, optional): 回転の刻み [deg]。既定値は縮小画像の端が 1 画素動く角度。
+        max_size (int, optional): 縮小画像の短辺の上限
+        min_overlap (float, optional): 重なりの画素数がこの割合より少ない平行移動は nan
+        workers (int, optional): スレッド数
+
+    Returns:
+        dict: {'best': 最大の ZNCC のパラメータと 'score' (平行移動・回転はパラボラ補間),
+               'current': params の ZNCC (best と同じ score), 'angles' [deg] (params からの差), 'shifts' [px],
+               'scores' (回転, y, x の ZNCC), 'level'}
+    """
+    p = dict(DEFAULT_PARAMS, **params)
+    h, w = moving.shape[:2]
+    ox, oy = (w / 2, h / 2) if origin is None else origin
+    pyr_f = pyramid(normalize(fixed), max_size)
+    pyr_m = pyramid(normalize(moving), max_size)
+    level = min(len(pyr_f), len(pyr_m)) - 1
+    fix, mov = pyr_f[level], pyr_m[level]
+    s = 2 ** level
+    k = max(int(np.ceil(shift / s)), 1)
+    if step_deg is None:
+        step_deg = degrees(2.0 / max(min(fix.shape), 1))
+    n = int(np.ceil(rotation_deg / step_deg)) if rotation_deg > 0 else 0
+    angles = np.arange(-n, n + 1) * step_deg
+
+    # moving は周りに k 画素広げた枠に変換し、平行移動で枠の外から入る画素も含める
+    pad = (fix.shape[0] + 2 * k, fix.shape[1] + 2 * k)
+    shift_k = params_matrix(k, k, 0.0)
+    size = (cv2.getOptimalDFTSize(pad[0]), cv2.getOptimalDFTSize(pad[1]))
+    spec_f = _spectrum(fix, size)
+    spec_ff = _spectrum(fix * fix, size)
+    spec_1 = _spectrum(np.ones(fix.shape, np.float32), size)
+    min_n = min_overlap * fix.size
+
+    def landscape(angle):
+        m = params_matrix(p["px"], p["py"], p["rz"] + radians(angle), p["sx"], p["sy"], ox, oy)
+        m = shift_k @ level_matrix(m, level)
+        # g は重なりの外を 0 にして、どの和も同じ画素で取る (score と同じ overlap)
+        mask = overlap(m, mov.shape, pad).astype(np.float32)
+        g = warp(mov, m, pad) * mask
+        spec_m = _spectrum(mask, size)
+        spec_g = _spectrum(g, size)
+        n_ = _correlate(spec_1, spec_m, k)
+        sf = _correlate(spec_f, spec_m, k)
+        sff = _correlate(spec_ff, spec_m, k)
+        sg = _correlate(spec_1, spec_g, k)
+        sgg = _correlate(spec_1, _spectrum(g * g, size), k)
+        sfg = _correlate(spec_f, spec_g, k)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            var = (sff - sf * sf / n_) * (sgg - sg * sg / n_)
+            zn = (sfg - sf * sg / n_) / np.sqrt(var)
+        zn[(n_ < min_n) | ~(var > 0)] = np.nan
+        return zn
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        scores = np.stack(list(pool.map(landscape, angles)))
+
+    if np.all(np.isnan(scores)):
+        raise ValueError("no overlap in the scan range")
+    i, y, x = np.unravel_index(np.nanargmax(scores), scores.shape)
+    da = (angles[i] + _parabola(scores[:, y, x], i) * step_deg) if len(angles) > 1 else angles[i]
+    dy = (y - k + _parabola(scores[i, :, x], y)) * s
+    dx = (x - k + _parabola(scores[i, y, :], x)) * s
+    best = {"px": p["px"] + dx, "py": p["py"] + dy, "rz": p["rz"] + radians(da),
+            "sx": p["sx"], "sy": p["sy"]}
+    m = params_matrix(best["px"], best["py"], best["rz"], best["sx"], best["sy"], ox, oy)
+    best["score"] = score(fix, mov, level_matrix(m, level))
+    # current も best と同じ score で評価する
+    m = params_matrix(p["px"], p["py"], p["rz"], p["sx"], p["sy"], ox, oy)
+    return {
+        "best": best,
+        "current": score(fix, mov, level_matrix(m, level)),
+        "angles": angles,
+        "shifts": np.arange(-k, k + 1) * s,
+        "scores": scores,
+        "level": level,
+    }
+
+
+def base_image(image, params=None):
+    """
+    base の合成画像を base の変換 (params、origin は画像の中心) で変換した fixed 画像
+    """
+    if not params:
+        return image
+    h, w = image.shape[:2]
+    p = dict(DEFAULT_PARAMS, **params)
+    return warp(image, params_matrix(p["px"], p["py"], p["rz"], p["sx"], p["sy"], w / 2, h / 2))
+
+
+def register_folders(base_folder, rotated_folder, psi=0.0, step=1, spike_threshold=64000,
+                     base=None, init=None, use_cache=True, **kwargs):
+    """
+    2 つのフォルダーの合成画像 (tiff_synthesizer.synthesize_folder) から rotated のパラメータを推定する。
+
+    Args:
+        base_folder (str): base の画像フォルダー
+        rotated_folder (str): rotated の画像フォルダー
+        psi (float, optional): 名目の回転 [deg] (init に rz が無いとき)
+        step (int, optional): 合成の step
+        spike_threshold (int, optional): 合成の spike_threshold
+        base (dict, optional): base の変換 {'px', 'py', 'rz' [rad], 'sx', 'sy'}
+        init (dict, optional): rotated の初期値
+        use_cache (bool, optional): 合成画像のキャッシュを使う
+        kwargs: register の引数
+
+    Returns:
+        dict: register の結果
+    """
+    from util.tiff_synthesizer import synthesize_folder
+
+    fixed = base_image(synthesize_folder(base_folder, step, spike_threshold, use_cache), base)
+    moving = synthesize_folder(rotated_folder, step, spike_threshold, use_cache)
+    init = dict(init or {})
+    init.setdefault("rz", radians(psi))
+    return register(fixed, moving, init, **kwargs)
+
+
+def _spectrum(image, size):
+    "size に 0 で埋めた image の DFT"
+    pad = np.zeros(size, np.float64)
+    pad[:image.shape[0], :image.shape[1]] = image
+    return cv2.dft(pad, flags=cv2.DFT_COMPLEX_OUTPUT)
+
+
+def _correlate(spec_a, spec_b, k):
+    "c[dy, dx] = sum a(x) b(x + k - d) の |d| <= k の部分 (2k+1, 2k+1)、b は k 画素広げた枠"
+    c = cv2.idft(cv2.mulSpectrums(spec_a, spec_b, 0, conjB=True),
+                 flags=cv2.DFT_REAL_OUTPUT | cv2.DFT_SCALE)
+    idx = np.arange(-2 * k, 1)
+    return c[np.ix_(idx % c.shape[0], idx % c.shape[1])].astype(np.float64)
+
+
+def _parabola(values, i):
+    "values[i] の両隣とのパラボラ補間による頂点の位置 (i からのずれ、-0.5 〜 0.5)"
+    if i <= 0 or i >= len(values) - 1:
+        return 0.0
+    a, b, c = values[i - 1], values[i], values[i + 1]
+    d = a - 2 * b + c
+    if not np.isfinite(d) or d >= 0:
+        return 0.0
+    return float(np.clip(0.5 * (a - c) / d, -0.5, 0.5))
+
+
+def _level_scale(level):
+    "レベル 0 の座標 -> レベル level の座標"
+    s = 2.0 ** level
+    return np.array([[1 / s, 0, 0], [0, 1 / s, 0], [0, 0, 1]])
+
+
+def _from_level(m, level):
+    "level_matrix の逆"
+    d = _level_scale(level)
+    return np.linalg.inv(d) @ m @ d
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="automatic registration of two image folders")
+    parser.add_argument("base", help="base images folder")
+    parser.add_argument("rotated", help="rotated images folder")
+    parser.add_argument("--psi", help="nominal rotation [deg]", type=float, default=0.0)
+    parser.add_argument("--search", help="rotation search range [deg]", type=float, default=5.0)
+    parser.add_argument("--step", help="synthesize step", type=int, default=1)
+    parser.add_argument("--finest", help="finest pyramid level of the refinement", type=int, default=0)
+    parser.add_argument("--motion", help="refinement motion", choices=("euclidean", "affine"),
+                        default="euclidean")
+    args = parser.parse_args()
+
+    result = register_folders(args.base, args.rotated, args.psi, args.step,
+                              search_deg=args.search, finest=args.finest, motion=args.motion)
+    result.pop("search")
+    result["rz_deg"] = degrees(result["rz"])
+    print(json.dumps(result, indent=2))
@@ -0,0 +1,96 @@
+"""
+ATP エディターの類似度 (NCC, ZNCC) の計算
+
+パラメータの操作中は縮小画像 (preview) で計算し、操作が止まってから元の解像度で計算し直す。
+計算は SimilarityWorker のスレッドで行い、GUI スレッドを止めない。
+"""
+import threading
+
+import numpy as np
+import cv2
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from util.registration import level_matrix
+
+# 縮小画像の長辺の上限
+PREVIEW_SIZE = 512
+# 最後の操作から元の解像度で計算し直すまでの時間 [ms]
+REFRESH_DELAY = 300
+
+
+def preview_level(shape, max_size=PREVIEW_SIZE) -> int:
+    """
+    長辺が max_size 以下になる縮小のレベル (1/2^level)
+    """
+    level = 0
+    while max(shape[:2]) / 2 ** level > max_size:
+        level += 1
+    return level
+
+
+def shrink(image: np.ndarray, level: int) -> np.ndarray:
+    """
+    1/2^level に縮小した画像 (registration.pyramid と同じ cv2.pyrDown)
+    """
+    for _ in range(level):
+        image = cv2.pyrDown(image)
+    return image
+
+
+def preview_matrix(m: np.ndarray, level: int) -> np.ndarray:
+    """
+    元の解像度の 2x3 (3x3) 行列 m を 1/2^level の縮小画像の 2x3 行列にする
+    """
+    m3 = np.eye(3)
+    m3[:2] = np.asarray(m, np.float64)[:2]
+    return level_matrix(m3, level)[:2]
+
+
+def similarity(mat1: np.ndarray, mat2: np.ndarray) -> (float, float):
+    """
+    NCC と ZNCC。一度の走査で求めた和と内積から計算する (一定値の画像は 0)。
+    """
+    x = mat1.ravel().astype(np.float32)
+    y = mat2.ravel().astype(np.float32)
+    n = x.size
+    sx = float(x.sum(dtype=np.float64))
+    sy = float(y.sum(dtype=np.float64))
+    sxy = float(np.dot(x, y))
+    sxx = float(np.dot(x, x))
+    syy = float(np.dot(y, y))
+    d = sxx * syy
+    ncc = sxy / np.sqrt(d) if d > 0 else 0.0
+    d = (sxx - sx * sx / n) * (syy - sy * sy / n)
+    zncc = (sxy - sx * sy / n) / np.sqrt(d) if d > 0 else 0.0
+    return ncc, zncc
+
+
+class SimilarityWorker(QObject):
+    """
+    別スレッドで類似度を計算する。未処理の要求は最新のものだけを残す
+    (計算中に来た要求は、計算が終わってから最新のものだけを計算する)。
+    moveToThread の後で requested を run につなぐ。
+    """
+    calculated = pyqtSignal(float, float, bool)
+    requested = pyqtSignal()
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._lock = threading.Lock()
+        self._pending = None
+
+    def submit(self, mat1: np.ndarray, mat2: np.ndarray, is_preview: bool) -> None:
+        with self._lock:
+            self._pending = (mat1, mat2, is_preview)
+        self.requested.emit()
+
+    def run(self) -> None:
+        with self._lock:
+            job, self._pending = self._pending, None
+        if job is None:
+            return
+        mat1, mat2, is_preview = job
+        if mat1.shape != mat2.shape:
+            return
+        ncc, zncc = similarity(mat1, mat2)
+        self.calculated.emit(ncc, zncc, is_preview)
@@ -1,3 +1,8 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
 import numpy as np
 import matplotlib.pyplot as plt
 import tifffile as tiff
@@ -5,25 +10,239 @@ import cv2
 from pathlib import Path
 from PyQt5.QtCore import QObject, pyqtSignal, QMutex, QMutexLocker
 
-def calc_sum(dark, files, step, spike_threshold=64000):
-    if dark:
-        d = tiff.imread(dark[0])
+# virtual crop of a folder (written by qfit.virtual_crop)
+# image_editor runs as a script with image_editor/ on the path, where the qfit package
+# cannot be imported: CROP_FILE, load_crop, crop_slices, read_tif and _read_rows are
+# copies of qfit/virtual_crop.py, keep them identical.
+CROP_FILE = "crop.json"
+# synthesized images cached in the folder: .synth_s{step}_t{spike_threshold}.npz
+SYNTH_CACHE = ".synth_s{step}_t{spike_threshold}.npz"
+
+
+def load_crop(folder):
+    """crop descriptor written by save_crop
+
+    Returns:
+        dict: {'x', 'y', 'width', 'height', 'shape'} or None
+    """
+    path = Path(folder) / CROP_FILE
+    if not path.exists():
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def crop_slices(crop):
+    "(row slice, col slice) of a crop descriptor"
+    return (slice(crop["y"], crop["y"] + crop["height"]),
+            slice(crop["x"], crop["x"] + crop["width"]))
+
+
+def read_tif(path, crop=None, mmap=True):
+    """cropped tif map without reading the rest of the image where possible
+
+    1. uncompressed contiguous tif: view of the memory-mapped file (read on access)
+    2. stripped tif (e.g. compressed): only the strips of the cropped rows are read and decoded
+    3. otherwise (tiled ...): full image, sliced
+
+    Args:
+        path (str or pathlib): tif file (2D)
+        crop (dict, optional): crop descriptor. Defaults to None (full map).
+        mmap (bool, optional): memory-map uncompressed files. Defaults to True.
+
+    Returns:
+        ndarray: (height, width), read-only view for memory-mapped files
+    """
+    path = str(path)
+    if mmap:
+        try:
+            data = tiff.memmap(path, mode="r")
+        except ValueError:
+            data = None
+        if data is not None:
+            return data if crop is None else data[crop_slices(crop)]
+    if crop is None:
+        return tiff.imread(path)
+
+    rows, cols = crop_slices(crop)
+    with tiff.TiffFile(path) as tf:
+        page = tf.pages[0]
+        if page.is_tiled or page.samplesperpixel != 1 or len(page.dataoffsets) <= 1:
+            return page.asarray()[rows, cols]
+        return _read_rows(tf.filehandle, page, rows.start, rows.stop)[:, cols]
+
+
+def _read_rows(fh, page, start, stop):
+    "rows start:stop of a stripped tif page, only the strips containing them are read"
+    stop = min(stop, page.imagelength)
+    per_strip = page.rowsperstrip
+    first, last = start // per_strip, (stop - 1) // per_strip
+    strips = []
+    for i in range(first, last + 1):
+        fh.seek(page.dataoffsets[i])
+        segment, _, _ = page.decode(fh.read(page.databytecounts[i]), i)
+        strips.append(segment.reshape(-1, page.imagewidth))
+    rows = np.concatenate(strips) if len(strips) > 1 else strips[0]
+    return rows[start - first * per_strip:stop - first * per_strip]
+
+
+def load_frame(path, spike_threshold=64000, crop=None):
+    """
+    float32 の画像。spike_threshold を超える画素 (と nan) は 0 にする。
+    (以前の np.nan_to_num(im, mean) と同じ結果: mean は copy 引数だった)
+    """
+    im = read_tif(path, crop)
+    frame = im.astype(np.float32)
+    frame[~(im <= spike_threshold)] = 0
+    return frame
+
+
+def synthesize(files, dark=None, step=1, spike_threshold=64000, crop=None,
+               workers=None, callback=None, is_cancelled=None):
+    """
+    files[::step] の和から dark を引いた float32 の画像。
+    画像の読み込みはスレッドプールで並列に行い、読み込んだ順に足し込む。
+    callback(percent) は画像ごとに呼ばれる (TiffSynthWorker.updated と同じ値)。
+    is_cancelled() が True を返したら None を返す。
+    """
+    indices = list(range(0, len(files), step))
+    if not indices:
+        return None
+    workers = workers or os.cpu_count() or 1
+    total = None
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # 読み込み済みの画像がメモリを埋めないよう、先読みは 2 * workers 枚まで
+        pending = deque()
+        queue = iter(indices)
+        for i in queue:
+            pending.append((i, pool.submit(load_frame, files[i], spike_threshold, crop)))
+            if len(pending) >= 2 * workers:
+                break
+        while pending:
+            i, future = pending.popleft()
+            if is_cancelled is not None and is_cancelled():
+                for _, f in pending:
+                    f.cancel()
+                return None
+            frame = future.result()
+            if total is None:
+                total = frame
+            else:
+                total += frame
+            for j in queue:
+                pending.append((j, pool.submit(load_frame, files[j], spike_threshold, crop)))
+                break
+            if callback is not None:
+                callback(int(100 * (i + 1) / len(files)))
+    if dark is not None:
+        total -= len(indices) * read_tif(dark, crop).astype(np.float32)
+    return total
+
+
+def calc_sum(dark, files, step, spike_threshold=64000, crop=None):
+    return synthesize(files, dark[0] if dark else None, step, spike_threshold, crop)
+
+
+def folder_files(folder_path):
+    """
+    合成に使う tif のリストと dark のリスト。
+    output.log があれば dark の枚数をそこから読む。
+    """
+    path = Path(folder_path)
+    file_list = list(path.glob("*.tif"))
+    dark_file_list = []
+    log = path / "output.log"
+    if log.exists():
+        with open(log) as f:
+            for x in f:
+                if "dark" in x.lower():
+                    n = int(x.strip().split()[-1])
+                    file_list.sort()
+                    dark_file_list = file_list[-n:]
+                    file_list = file_list[:-n]
+                    break
     else:
-        d = 0
-    s = None
-    for i in range(0, len(files), step):
-        print(i)
-        im = tiff.imread(files[i])
-        if im is None:
-            print(f"Cannot read {files[i]}")
-            return None
-        im = np.where(im > spike_threshold, np.nan, im)
-        mean = np.nanmean(im)
-        im = np.nan_to_num(im, mean)
-        if s is None:
-            s = np.zeros(im.shape)
-        s += im - d
-    return s
+        file_list = [f for f in file_list if "dark" not in f.stem]
+        file_list = sorted(
+            file_list,
+            key=lambda x: int("".join([y for y in x.stem if y in "0123456789"])),
+            reverse=True
+        )
+        dark_file_list = list(path.glob("*dark.tif"))
+    return file_list, dark_file_list
+
+
+def synthesize_folder(folder_path, step=1, spike_threshold=64000, use_cache=True, workers=None):
+    """
+    フォルダーの合成画像 (TiffSynthWorker と同じく正規化する)。GUI なしで使える。
+    use_cache なら有効なキャッシュを使い、合成した画像はキャッシュに保存する。
+    """
+    if use_cache:
+        cache = load_synth_cache(folder_path, step, spike_threshold)
+        if cache is not None:
+            return cache[0]
+    file_list, dark_file_list = folder_files(folder_path)
+    if not file_list:
+        raise FileNotFoundError(f"CANNOT Find Any TIFF Files: {folder_path}")
+    dark = dark_file_list[0] if dark_file_list else None
+    sum = synthesize(file_list, dark, step, spike_threshold, load_crop(folder_path), workers)
+    image = np.clip(sum, 0.0, None) / np.linalg.norm(sum)
+    if use_cache:
+        save_synth_cache(folder_path, image, step, spike_threshold)
+    return image
+
+
+def folder_signature(folder):
+    """
+    フォルダー内の tif, output.log, crop.json の名前・サイズ・更新時刻のハッシュ。
+    ファイルが追加・変更されるとキャッシュは無効になる。
+    """
+    path = Path(folder)
+    files = sorted(list(path.glob("*.tif")) + [path / "output.log", path / CROP_FILE])
+    items = [(f.name, f.stat().st_size, f.stat().st_mtime_ns) for f in files if f.exists()]
+    return hashlib.sha1(json.dumps(items).encode()).hexdigest()
+
+
+def save_synth_cache(folder, image, step, spike_threshold=64000):
+    """
+    合成画像を folder/.synth_s{step}_t{spike_threshold}.npz に保存する。
+    書き込めないフォルダーでは何もしない。
+    """
+    path = Path(folder) / SYNTH_CACHE.format(step=step, spike_threshold=spike_threshold)
+    try:
+        with open(path, "wb") as f:
+            np.savez(f, image=image, signature=folder_signature(folder),
+                     step=step, spike_threshold=spike_threshold)
+    except OSError as e:
+        print(f"CANNOT Write Cache: {path} ({e})")
+        return None
+    return path
+
+
+def load_synth_cache(folder, step=None, spike_threshold=64000):
+    """
+    フォルダーが変更されていなければキャッシュした合成画像 (image, step) を返す。
+    step が None なら有効なキャッシュのうち最も step の小さいもの。無ければ None。
+    """
+    path = Path(folder)
+    pattern = SYNTH_CACHE.format(step="*" if step is None else step, spike_threshold=spike_threshold)
+    caches = []
+    for p in path.glob(pattern):
+        try:
+            caches.append((int(p.stem.split("_")[1][1:]), p))
+        except ValueError:
+            pass
+    if not caches:
+        return None
+    signature = folder_signature(path)
+    for s, p in sorted(caches):
+        try:
+            with np.load(p) as d:
+                if str(d["signature"]) == signature:
+                    return d["image"], s
+        except (OSError, ValueError, KeyError):
+            pass
+    return None
 
 class TiffSynthesizer:
     def __init__(self, folder_path: str):
@@ -47,7 +266,8 @@ class TiffSynthesizer:
             spike_threshold=64000,
             step=1,
             plot=False):
-        sum = calc_sum(self.dark_file_list, self.file_list, step, spike_threshold)
+        sum = calc_sum(self.dark_file_list, self.file_list, step, spike_threshold,
+                       load_crop(self.path))
         sum = np.clip(sum, 0.0, None)
         self.sum = sum / np.linalg.norm(sum)
         if plot:
@@ -86,7 +306,7 @@ class TiffSynthesizer:
         dark_file_list = list(path.glob("*dark.tif"))
                 
         # 正規化
-        sum = calc_sum(dark_file_list, file_list, step, spike_threshold)        
+        sum = calc_sum(dark_file_list, file_list, step, spike_threshold, load_crop(path))
         sum = np.clip(sum, 0.0, None) / np.linalg.norm(sum)
         return sum
 
@@ -118,42 +338,23 @@ class TiffSynthWorker(QObject):
             self,
             folder_path: str,
             spike_threshold: int = 64000,
-            step: int = 1
+            step: int = 1,
+            workers: int = None
             ):
         super().__init__()
         self.path = Path(folder_path)
         self.spike_threshold = spike_threshold
         self.step = step
+        self.workers = workers
 
         self.mutex = QMutex()
         self.synth_image = None
         self.is_running = False
 
-    # TODO: エラー処理を記述する
     def run(self):
-        print("piyo")
         self.is_running = True
 
-        file_list = list(self.path.glob("*.tif"))
-        log = self.path / "output.log"
-        if log.exists():
-            with open(log) as f:
-                for x in f:
-                    if "dark" in x.lower():
-                        n = int(x.strip().split()[-1])
-                        file_list.sort()
-                        dark_file_list = file_list[-n:]
-                        file_list = file_list[:-n]
-                        break
-        else:
-            file_list = [f for f in file_list if "dark" not in f.stem]
-            file_list = sorted(
-                file_list,
-                key=lambda x: int("".join([y for y in x.stem if y in "0123456789"])),
-                reverse=True
-            )
-            dark_file_list = list(self.path.glob("*dark.tif"))
-        num_files = len(file_list)
+        file_list, dark_file_list = folder_files(self.path)
             
         if file_list == []:
             self.is_running = False
@@ -164,42 +365,18 @@ class TiffSynthWorker(QObject):
         #    self.is_running = False
         #    self.error_occured.emit("CANNOT Find '*dark.tif'")
         #    return
-        if dark_file_list == []:
-            dark = None
-        else:
-            dark = tiff.imread(dark_file_list[0])
-        #if dark is None:
-        #    self.is_running = False
-        #    self.error_occured.emit(f"CANNOT Open File: {dark_file_list[0]}")
-        #    return
-        if dark is not None:
-            sum = np.zeros(dark.shape)
-        else:
-            sum = None
-            
-        for i in range(0, num_files, self.step):
-            if not self.is_running:
-                self.aborted.emit()
-                return
-            im = tiff.imread(file_list[i])
-            if im is None:
-                self.is_running = False
-                self.error_occured.emit(f"CANNOT Open File: {file_list[i]}")
-                return
-            im = np.where(im > self.spike_threshold, np.nan, im)
-            mean = np.nanmean(im)
-            im = np.nan_to_num(im, mean)
-            if dark is None:
-                if sum is None:
-                    sum = im[:,:]
-                else:
-                    sum += im
-            else:
-                sum += im - dark
-            print(f"file_name: {str(file_list[i])}, mean: {str(mean)}")
-            self.updated.emit(int(100 * (i+1) / num_files))
+        dark = dark_file_list[0] if dark_file_list else None
+        try:
+            sum = synthesize(
+                file_list, dark, self.step, self.spike_threshold, load_crop(self.path),
+                workers=self.workers, callback=self.updated.emit,
+                is_cancelled=lambda: not self.is_running)
+        except Exception as e:
+            self.is_running = False
+            self.error_occured.emit(f"CANNOT Open File: {e}")
+            return
         # 正規化
-        if not self.is_running:
+        if sum is None or not self.is_running:
             self.aborted.emit()
             return
         self.synth_image = np.clip(sum, 0.0, None) / np.linalg.norm(sum)
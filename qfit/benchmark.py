@@ -0,0 +1,272 @@
+"""
+Benchmark of the RC fitting with synthetic rocking-curve data
+
+- synthetic_cube: data cube with known peak (center), sigma and height maps,
+  background, poisson noise, dead regions and a wafer disk
+- write_cube: save the cube as tif files + dark.tif + angle.txt (input of fit.py)
+- run_benchmark: time the fitting methods for several sizes and numbers of cores
+  and compare the results with the ground truth
+
+Examples:
+    >>> from qfit import benchmark as bench
+    >>> results = bench.run_benchmark(sizes=(128, 256), ncpus=(1, 4), methods=('hw', 'gaussian'))
+    >>> bench.print_results(results)
+
+    command line
+    python -m qfit.benchmark --sizes 128 256 --cores 1 4 --methods hw gaussian
+"""
+
+import argparse
+import csv
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import tifffile as tiff
+
+from qfit import fit
+
+
+def synthetic_cube(nx=256, ny=256, angles=None, center=-3000.0, bow=300.0,
+                   sigma=25.0, height=400.0, background=100.0, dead=True, seed=0):
+    """synthetic rocking-curve data cube with known parameter maps
+
+    Args:
+        nx (int, optional): number of x pixels (fit.py NX). Defaults to 256.
+        ny (int, optional): number of y pixels (fit.py NY). Defaults to 256.
+        angles (ndarray, optional): measured angles [arcsec]. Defaults to center +- 300, step 10.
+        center (float, optional): mean peak position [arcsec]. Defaults to -3000.
+        bow (float, optional): peak shift at the wafer edge [arcsec] (parabolic). Defaults to 300.
+        sigma (float, optional): mean sigma [arcsec]. Defaults to 25.
+        height (float, optional): mean peak height [counts]. Defaults to 400.
+        background (float, optional): background [counts]. Defaults to 100.
+        dead (bool, optional): add dead regions (detector gap and a dead block). Defaults to True.
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        dict: {'xs':angles, 'data':(angles, nx, ny) uint16, 'dark':(nx, ny) uint16,
+               'c':peak, 'h':height, 'w':sigma (ground truth, nan outside the valid area),
+               'valid':wafer pixels with signal}
+    """
+    rng = np.random.default_rng(seed)
+    if angles is None:
+        angles = np.arange(center - 300, center + 301, 10)
+    xs = np.asarray(angles, dtype=float)
+
+    xx, yy = np.meshgrid(np.arange(nx), np.arange(ny), indexing='ij')
+    cx, cy = (nx - 1)/2, (ny - 1)/2
+    radius = 0.45 * min(nx, ny)
+    r = np.hypot(xx - cx, yy - cy) / radius
+    phi = np.arctan2(yy - cy, xx - cx)
+
+    wafer = r <= 1
+    valid = wafer.copy()
+    if dead:
+        # detector gap and a dead block
+        valid[nx//3:nx//3 + max(nx//64, 1), :] = False
+        valid[nx//2:nx//2 + nx//16, ny//5:ny//5 + ny//16] = False
+
+    c_map = center + bow * r**2 + 0.2 * bow * r * np.cos(phi)
+    w_map = sigma * (1 + 0.2 * r**2 + 0.05 * np.sin(3 * phi))
+    h_map = height * (1 - 0.3 * r**2) * (1 + 0.05 * rng.standard_normal((nx, ny)))
+    h_map = np.where(valid, h_map, 0)
+
+    lam = background + h_map[None] * np.exp(
+        -((xs[:, None, None] - c_map[None]) / (np.sqrt(2) * w_map[None]))**2)
+    data = np.clip(rng.poisson(lam), 0, 65535).astype(np.uint16)
+    dark = np.zeros((nx, ny), dtype=np.uint16)
+
+    nan = np.where(valid, 1.0, np.nan)
+    return {'xs': xs, 'data': data, 'dark': dark, 'c': c_map * nan, 'h': h_map * nan,
+            'w': w_map * nan, 'valid': valid}
+
+
+def write_cube(folder, cube):
+    """save a synthetic cube in the input format of fit.py
+
+    Args:
+        folder (str or pathlib): output folder (created)
+        cube (dict): synthetic_cube output
+
+    Returns:
+        dict: {angle: file name} (fit.Data ang2f)
+    """
+    p = Path(folder)
+    p.mkdir(parents=True, exist_ok=True)
+    ang2f = {}
+    for i, (x, im) in enumerate(zip(cube['xs'], cube['data'])):
+        name = f'{i:04d}.tif'
+        tiff.imwrite(str(p / name), im)
+        ang2f[int(x)] = name
+    tiff.imwrite(str(p / 'dark.tif'), cube['dark'])
+
+    with open(p / 'angle.txt', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['angle', 'filename'])
+        for x, name in ang2f.items():
+            writer.writerow([x, name])
+
+    return ang2f
+
+
+def make_data(folder, ang2f, nx, ny, pmax=30):
+    """fit.Data for a folder written by write_cube"""
+    fit.Data.NX = nx
+    fit.Data.NY = ny
+    fit.Data.PMAX = pmax
+    D = fit.Data(Path(folder), '.tif', None, True, ang2f)
+    # instance values are kept when D is sent to the pool workers
+    D.NX, D.NY, D.PMAX = nx, ny, pmax
+    return D
+
+
+def fit_engine(method, refit=False):
+    """engine for run_benchmark using fit.fit_maps
+
+    Args:
+        method (str): 'hw', 'gaussian' or 'all'
+        refit (bool, optional): second pass for failed pixels. Defaults to False.
+
+    Returns:
+        callable: engine(D, ncpu, options) -> maps {'c', 'h', 'w', ...}
+    """
+    def engine(D, ncpu, options):
+        maps, info = fit.fit_maps(D, method, options, ncpu, refit=refit)
+        return maps
+
+    return engine
+
+
+def compare(maps, cube):
+    """errors of the fitted maps against the ground truth on the valid pixels
+
+    Args:
+        maps (dict): fitted maps {'c', 'h', 'w'}
+        cube (dict): synthetic_cube output
+
+    Returns:
+        dict: fitted (fraction of valid pixels with a result),
+              c_med, c_rmse (median absolute error and rmse of the peak [arcsec]),
+              w_bias, w_med, w_rmse (median error, median absolute error and rmse of sigma [arcsec]),
+              h_med (median absolute relative error of the height)
+    """
+    valid = cube['valid']
+    ok = valid & np.isfinite(maps['c']) & (maps['w'] != 0)
+    dc = (maps['c'] - cube['c'])[ok]
+    dw = (np.abs(maps['w']) - cube['w'])[ok]
+    dh = ((maps['h'] - cube['h']) / cube['h'])[ok]
+
+    def med(d):
+        return float(np.median(d)) if d.size else np.nan
+
+    def rmse(d):
+        return float(np.sqrt(np.mean(d**2))) if d.size else np.nan
+
+    return {
+        'fitted': float(ok.sum() / max(valid.sum(), 1)),
+        'c_med': med(np.abs(dc)),
+        'c_rmse': rmse(dc),
+        'w_bias': med(dw),
+        'w_med': med(np.abs(dw)),
+        'w_rmse': rmse(dw),
+        'h_med': med(np.abs(dh)),
+    }
+
+
+def run_benchmark(sizes=(128, 256), ncpus=(1, 4), methods=('hw', 'gaussian'), engines=None,
+                  filter=30, pmax=30, seed=0, work_dir=None, **cube_kw):
+    """time the fitting engines and compare with the ground truth
+
+    Args:
+        sizes (tuple, optional): image sizes (size x size). Defaults to (128, 256).
+        ncpus (tuple, optional): numbers of cores. Defaults to (1, 4).
+        methods (tuple, optional): fit.py methods. Defaults to ('hw', 'gaussian').
+        engines (dict, optional): additional engines {name: engine(D, ncpu, options) -> maps}.
+        filter (int, optional): fit.py filter. Defaults to 30.
+        pmax (int, optional): fit.py pmax. Defaults to 30.
+        seed (int, optional): random seed of the cube. Defaults to 0.
+        work_dir (str, optional): folder for the tif files. Defaults to a temporary folder.
+        cube_kw: other synthetic_cube arguments (angles, bow, sigma, height, background, dead)
+
+    Returns:
+        list[dict]: {'engine', 'size', 'ncpu', 'pixels', 'time'[s], 'rate'[pixel/s], **compare}
+    """
+    all_engines = {m: fit_engine(m) for m in methods}
+    if engines:
+        all_engines.update(engines)
+
+    tmp = None
+    if work_dir is None:
+        tmp = tempfile.mkdtemp(prefix='qfit_bench_')
+        work_dir = tmp
+
+    results = []
+    try:
+        for size in sizes:
+            cube = synthetic_cube(size, size, seed=seed, **cube_kw)
+            folder = Path(work_dir) / f'cube_{size}'
+            ang2f = write_cube(folder, cube)
+            D = make_data(folder, ang2f, size, size, pmax)
+            options = {'filter': filter}
+
+            for ncpu in ncpus:
+                for name, engine in all_engines.items():
+                    start = time.perf_counter()
+                    maps = engine(D, ncpu, options)
+                    elapsed = time.perf_counter() - start
+                    res = {'engine': name, 'size': size, 'ncpu': ncpu, 'pixels': size * size,
+                           'time': elapsed, 'rate': size * size / elapsed}
+                    res.update(compare(maps, cube))
+                    print(format_result(res), flush=True)
+                    results.append(res)
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    return results
+
+
+def format_result(res):
+    return (f"{res['engine']:>10s} {res['size']:>6d} {res['ncpu']:>4d} {res['time']:>8.2f} "
+            f"{res['rate']:>10.0f} {res['fitted']:>7.3f} {res['c_med']:>8.2f} {res['c_rmse']:>8.2f} "
+            f"{res['w_bias']:>8.2f} {res['w_med']:>8.2f} {res['w_rmse']:>8.2f} {res['h_med']:>7.3f}")
+
+
+def print_results(results):
+    """print run_benchmark results as a table"""
+    print(f"{'engine':>10s} {'size':>6s} {'ncpu':>4s} {'time[s]':>8s} {'pixel/s':>10s} "
+          f"{'fitted':>7s} {'c_med':>8s} {'c_rmse':>8s} {'w_bias':>8s} {'w_med':>8s} {'w_rmse':>8s} "
+          f"{'h_med':>7s}")
+    for res in results:
+        print(format_result(res))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark of the RC fitting with synthetic data")
+    parser.add_argument("--sizes", help="image sizes", nargs="+", type=int, default=[128, 256])
+    parser.add_argument("--cores", help="numbers of cores", nargs="+", type=int, default=[1, 4])
+    parser.add_argument("--methods", help="fitting methods", nargs="+",
+                        choices=("gaussian", "hw", "all"), default=["hw", "gaussian"])
+    parser.add_argument("--filter", help="filter signals by minmax difference", type=float, default=30)
+    parser.add_argument("--pmax", help="PMAX for gaussian fitting", type=int, default=30)
+    parser.add_argument("--seed", help="random seed", type=int, default=0)
+    parser.add_argument("--workdir", help="folder for the synthetic tif files (kept)")
+    parser.add_argument("--csv", help="save results to csv file", type=Path)
+    args = parser.parse_args()
+
+    results = run_benchmark(sizes=args.sizes, ncpus=args.cores, methods=args.methods,
+                            filter=args.filter, pmax=args.pmax, seed=args.seed,
+                            work_dir=args.workdir)
+    print_results(results)
+
+    if args.csv is not None:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+            writer.writeheader()
+            writer.writerows(results)
+
+
+if __name__ == '__main__':
+    main()
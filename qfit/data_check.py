@@ -18,6 +18,8 @@ import numpy as np
 from PIL import Image
 from matplotlib import pyplot as plt
 
+from qfit import map_stats as ms
+
 def error(msg):
     "print message 'msg' and exit program"
     print(msg)
@@ -26,10 +28,12 @@ def error(msg):
 
 def statistics_info(xs, printf=True):
     
-    max_ = np.nanmax(xs)
-    min_ = np.nanmin(xs)
-    mean_ = np.nanmean(xs)
-    median_ = np.nanmedian(xs)
+    # one pass (map_stats), exact median
+    row = ms.describe([xs], quantiles=(0.5,), sample=None).result()['0']
+    max_ = row['max']
+    min_ = row['min']
+    mean_ = row['mean']
+    median_ = row['q50']
     d_max_min_ = max_-min_
     if printf:
         print(f'max: {max_:.4f}')
@@ -42,6 +46,65 @@ def statistics_info(xs, printf=True):
             'd_max_min':d_max_min_}
 
 
+def load_fit_failures(file_path):
+    """load failed gaussian fits recorded by fit.py
+
+    Args:
+        file_path (str or pathlib): _fail.npz file or the RC folder containing it
+
+    Returns:
+        dict: {'xs':angle[arcsec], 'pos':(x,y) pixel index, 'flag':leastsq flag,
+               'x0':initial guess [offset, height, center, width], 'ys':intensity curve}
+    """
+    f_path = Path(file_path)
+    if f_path.is_dir():
+        f_path = list(f_path.glob('*_fail.npz'))[0]
+
+    with np.load(f_path) as npz:
+        failures = {k: npz[k] for k in npz.files}
+
+    print(f'failed fits: {len(failures["flag"])}')
+
+    return failures
+
+
+def plot_fit_failures(failures, num=9, ncols=3):
+    """replay failed gaussian fits: curve and initial guess
+
+    Args:
+        failures (dict): load_fit_failures output
+        num (int, optional): number of plots. Defaults to 9.
+        ncols (int, optional): number of columns. Defaults to 3.
+    """
+    num = min(num, len(failures['flag']))
+    if num == 0:
+        print('no failed fits')
+        return
+
+    nrows = (num + ncols - 1)//ncols
+    xs = failures['xs']
+    fig, ax = plt.subplots(nrows, ncols, figsize=(ncols*4.0, nrows*3.0), squeeze=False)
+    ax_list = ax.flatten()
+
+    for i in range(num):
+        x, y = failures['pos'][i]
+        x0 = failures['x0'][i]
+        guess = x0[0] + x0[1]*np.exp(-(((xs - x0[2])/(np.sqrt(2)*x0[3]))**2))
+        ax_list[i].plot(xs, failures['ys'][i], 'ro-', label='data')
+        ax_list[i].plot(xs, guess, 'b--', label='initial')
+        ax_list[i].set_title(f'x: {x}, y: {y}, flag: {failures["flag"][i]}')
+        ax_list[i].set_xlabel('Angle [arcsec]')
+        ax_list[i].set_ylabel('Intensity')
+        ax_list[i].legend()
+        ax_list[i].grid(True)
+
+    for j in range(num, len(ax_list)):
+        ax_list[j].axis('off')
+
+    fig.tight_layout()
+    plt.show()
+
+
 class CheckData:
     # image shape 2240(h) x 2368(w)
     NX = 2368
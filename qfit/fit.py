@@ -6,14 +6,17 @@ import argparse
 import logging
 import csv
 
-from multiprocessing import Pool
+import json
+import time
+from multiprocessing import Pool, Queue
+from queue import Empty
 from datetime import datetime as dt
 
 import numpy as np
-from scipy.optimize import leastsq
+from scipy.optimize import leastsq, least_squares
+from scipy.ndimage import uniform_filter
 from scipy.interpolate import interp1d
 
-from PIL import Image
 from matplotlib import pyplot as plt
 from matplotlib.colors import Colormap
 
@@ -21,6 +24,12 @@ from matplotlib.colors import Colormap
 
 from pathlib import Path
 
+try:
+    from qfit import virtual_crop as vc
+except ImportError:
+    # run as a script (python qfit/fit.py): the qfit folder is on the path
+    import virtual_crop as vc
+
 logger = logging.getLogger(__name__)
 VERSION = "1.0.0"
 ROOT2 = np.sqrt(2)
@@ -31,7 +40,22 @@ HWFACTOR = 2 * np.sqrt(2 * np.log(2))
 # gauss fit -> sigma, FWHM/HWFactor -> neary sigma
 # HWFACTOR = 1
 DATAFILE = ".rc_merge.npy"
+# virtual crop of the images in the data directory (--crop, see qfit.virtual_crop)
+CROPFILE = vc.CROP_SIDECAR
 CHECKED_SAMPLE = False
+# strategies of the second pass (--refit), index is stored in <base>_refit.npy
+# 0: not fixed, 1: hw initial guess, 2: neighbour initial guess,
+# 3: robust loss (soft_l1), 4: hw fallback
+REFIT_STRATEGIES = ("none", "hwguess", "neighbour", "robust", "hw")
+# goodness-of-fit maps of the gaussian fit (file suffix _<key>.npy)
+# chi2: reduced chi-square (poisson weights), rms: residual RMS
+# eh, ec, ew: standard errors of height, center and width (sigma)
+GOF_KEYS = ("chi2", "rms", "eh", "ec", "ew")
+NOGOF = [np.nan] * len(GOF_KEYS)
+# failed gaussian fits are stored in <base>_fail.npz (see data_check.load_fit_failures)
+FAILFILE = "_fail.npz"
+PROGRESS_EVERY = 1000 # pixels between progress messages of a worker
+_progress_queue = None # set in the pool workers by _init_worker
 
 
 def error(msg):
@@ -40,19 +64,90 @@ def error(msg):
     sys.exit(1)
 
 
+def model(xs, coeffs):
+    "gaussian with offset, coeffs: [offset, height, center, width(sigma)]"
+    return coeffs[0] + coeffs[1] * np.exp(
+        -(((xs - coeffs[2]) / (ROOT2 * coeffs[3])) ** 2)
+    )
+
+
+def residuals(coeffs, y, xs):
+    y0 = np.where(np.isnan(y), 0, y)
+    return y0 - model(xs, coeffs)
+
+
+def refit_candidates(F, W, chi2, wmin, wmax, chi2max):
+    """pixels for the second pass:
+    fits that did not converge, holes (no result) and
+    accepted fits with large chi-square or implausible width.
+    Only pixels with at least 5 of 8 good neighbours are refitted, i.e. inside the sample:
+    outside the wafer and along its edge or dead regions the refits cannot succeed.
+    Pixels rejected by --filter (F == -1) are never refitted."""
+    good = F == 1
+    # number of good neighbours in the 3x3 window (outside of the image: not good)
+    neighbours = np.rint(uniform_filter(good.astype(np.float32), size=3, mode="constant") * 9) - good
+    inside = neighbours >= 5
+    failed = inside & (F > 1)
+    hole = inside & (F == 0)
+    with np.errstate(invalid="ignore"):
+        suspicious = inside & good & ((chi2 > chi2max) | (np.abs(W) <= wmin) | (np.abs(W) >= wmax))
+    logger.info(f"refit candidates: failed {np.sum(failed)}, holes {np.sum(hole)}, suspicious {np.sum(suspicious)}")
+    return failed | hole | suspicious
+
+
+def neighbour_seeds(C, H, W, good, mask, r=2):
+    "(x, y, [height, center, width]) from the median of good neighbours, None if there are none"
+    seeds = []
+    for x, y in zip(*np.nonzero(mask)):
+        sl = (slice(max(x - r, 0), x + r + 1), slice(max(y - r, 0), y + r + 1))
+        g = good[sl]
+        if g.any():
+            seed = [np.median(H[sl][g]), np.median(C[sl][g]), np.median(W[sl][g])]
+        else:
+            seed = None
+        seeds.append((x, y, seed))
+    return seeds
+
+
+def save_failures(path, xs, failures):
+    "save sampled failed fits (x, y, flag, initial guess, curve) to a compressed npz file"
+    nang = len(xs)
+    np.savez_compressed(
+        path,
+        xs=np.array(xs, dtype=np.float32),
+        pos=np.array([f[:2] for f in failures], dtype=np.int32).reshape(-1, 2),
+        flag=np.array([f[2] for f in failures], dtype=np.int32),
+        x0=np.array([f[3] for f in failures], dtype=np.float32).reshape(-1, 4),
+        ys=np.array([f[4] for f in failures], dtype=np.float32).reshape(-1, nang),
+    )
+
+
 class Data:
     # image shape 2240(h) x 2368(w)
     NX = 2368
     NY = 2240
     PMAX = 30 # for using gaussian fitting
+    MAXFAIL = 100 # number of failed fits kept per worker
+    CHI2MAX = 10.0 # refit gaussian fits with larger reduced chi-square
 
-    def __init__(self, dirpath, fmt, cut, dark, ang2f):
+    def __init__(self, dirpath, fmt, cut, dark, ang2f, crop=None):
         self.data = None
         self.count = 0
+        self.failures = []
+        self.nfail = 0
+        self.nfilter = 0
+        self.nfit = 0
+        self.nfev = 0
+        self.start = 0
         self.dirpath = dirpath
         self.fmt = fmt
         self.cut = cut
         self.ang2f = ang2f
+        # image files are NX x NY, with a crop the maps are height x width
+        self.shape = (self.NX, self.NY)
+        self.crop = crop
+        if crop is not None:
+            self.NX, self.NY = crop["height"], crop["width"]
         self.dark = False
         self.bg = self.loadfile(dirpath.joinpath(f"dark{fmt}")).astype(np.int32)
         self.dark = dark
@@ -65,14 +160,15 @@ class Data:
         if not filepath.is_file():
             error(f"not a file: {filepath}")
         logger.info(f"open file {filepath}")
+        # with a crop only the cropped rows are read
         if filepath.suffix == ".tif":
             logger.info("dataformat: tif")
-            I = Image.open(filepath)
-            data = np.array(I)
+            data = vc.read_tif(filepath, self.crop)
         elif filepath.suffix == ".img":
             logger.info("dataformat: img")
-            a = np.fromfile(filepath, dtype=np.uint16)
-            data = a[5120:].reshape(self.NX, self.NY)
+            data = np.memmap(filepath, dtype=np.uint16, mode="r", offset=5120 * 2, shape=self.shape)
+            if self.crop is not None:
+                data = data[vc.crop_slices(self.crop)]
         else:
             raise ValueError(filepath)
         assert data.shape == (self.NX, self.NY)
@@ -183,6 +279,23 @@ class Data:
    
         return center_x, fwhm_x / HWFACTOR
 
+    @staticmethod
+    def goodness(ys, fvec, cov_x, nparams=4):
+        "reduced chi-square, residual RMS and standard errors from the converged fit"
+        n = len(fvec)
+        dof = max(n - nparams, 1)
+        ssr = np.sum(fvec ** 2)
+        # poisson variance estimated from the fitted model (y - residual)
+        var = np.maximum(np.abs(np.nan_to_num(ys) - fvec), 1)
+        chi2 = np.sum(fvec ** 2 / var) / dof
+        rms = np.sqrt(ssr / n)
+        if cov_x is None:
+            # singular J^T J, parameters are not determined
+            err = [np.nan] * nparams
+        else:
+            err = np.sqrt(np.abs(np.diag(cov_x)) * ssr / dof)
+        return [chi2, rms, err[1], err[2], err[3]]
+
     #@staticmethod
     #def nbeads(ys, n):
     #    "calls pybeads library to determine base signal, constants are taken from tutorial"
@@ -205,24 +318,127 @@ class Data:
     #    bg_est = nbg_est[n * ny : (n + 1) * ny]
     #    return signal_est, bg_est
 
+    def report(self, total, force=False):
+        "send progress of this worker every PROGRESS_EVERY pixels (see run_pool)"
+        if _progress_queue is None or not (force or self.count % PROGRESS_EVERY == 0):
+            return
+        _progress_queue.put({
+            "pid": os.getpid(),
+            "done": self.count,
+            "total": total,
+            "filtered": self.nfilter,
+            "failed": self.nfail,
+            "nfit": self.nfit,
+            "nfev": self.nfev,
+            "elapsed": time.time() - self.start,
+        })
+
     def fits(self, args):
         "wrapper function for multiple fittings"
+        print(f"starting {os.getpid()}\n", flush=True)
         self.loaddir()
-        ret = [self.fit(arg) for arg in args]
+        self.start = time.time()
+        ret = []
+        for arg in args:
+            ret.append(self.fit(arg))
+            self.report(len(args))
+        self.report(len(args), force=True)
         print(f"finishing {os.getpid()}\n")
+        return ret, self.failures, self.nfail
+
+    def record_failure(self, x, y, flag, x0, ys):
+        "keep a failed fit for later inspection (the first MAXFAIL per worker)"
+        self.nfail += 1
+        logger.info(f"FAILED {x} {y} {flag}")
+        if len(self.failures) < self.MAXFAIL:
+            self.failures.append((x, y, flag, x0, np.array(ys, dtype=np.float32)))
+
+    def width_limits(self):
+        "plausible range of sigma: half an angle step to half the scan range"
+        xs = np.array(self.xs)
+        return np.min(np.diff(xs)) / 2, (xs[-1] - xs[0]) / 2
+
+    def accept(self, x1, gof):
+        "check a gaussian result of the second pass (peak threshold relaxed to PMAX/2)"
+        wmin, wmax = self.width_limits()
+        return (
+            x1[1] > self.PMAX / 2
+            and wmin < abs(x1[3]) < wmax
+            and self.xs[0] <= x1[2] <= self.xs[-1]
+            and gof[0] <= self.CHI2MAX
+        )
+
+    def refits(self, args):
+        "wrapper function for the second pass"
+        self.loaddir()
+        self.start = time.time()
+        ret = []
+        for arg in args:
+            self.count += 1
+            ret.append(self.refit(arg))
+            self.report(len(args))
+        self.report(len(args), force=True)
+        print(f"finishing refit {os.getpid()}\n")
         return ret
 
+    def refit(self, args):
+        "fit a failed or suspicious pixel again with escalating strategies"
+        x, y, seed = args
+        ys = self.data[:, x, y]
+        if self.cut is not None:
+            ys = np.where(ys > self.cut, np.nan, ys)
+        xs = np.array(self.xs)
+        offset = np.nanmin(ys)
+        center, width = self.hw(xs, ys - offset)
+
+        # 1: initial guess from the half width, 2: from the neighbours
+        guesses = [(1, [offset, np.nanmax(ys) - offset, center, width])]
+        if seed is not None:
+            guesses.append((2, [np.nanmedian(ys), *seed]))
+        for strategy, x0 in guesses:
+            if not x0[3] > 0:
+                continue
+            x1, cov_x, info, _, flag = leastsq(
+                residuals, np.array(x0, dtype=float), args=(ys, xs),
+                maxfev=5000, full_output=True
+            )
+            self.nfit += 1
+            self.nfev += info["nfev"]
+            gof = self.goodness(ys, info["fvec"], cov_x)
+            if flag in (1, 2, 3, 4) and self.accept(x1, gof):
+                logger.info(f"REFIT {x} {y} {REFIT_STRATEGIES[strategy]}")
+                return x, y, x1, 1, gof, strategy
+
+        # 3: robust loss, outliers (spikes, dead angles) are down-weighted
+        x0 = guesses[-1][1]
+        if not x0[3] > 0:
+            x0 = [offset, np.nanmax(ys) - offset, center, 10]
+        try:
+            res = least_squares(
+                residuals, np.array(x0, dtype=float), args=(ys, xs),
+                loss="soft_l1", f_scale=max(np.sqrt(np.nanmax(ys)), 1), max_nfev=5000
+            )
+            self.nfit += 1
+            self.nfev += res.nfev
+            cov_x = np.linalg.pinv(res.jac.T @ res.jac)
+            gof = self.goodness(ys, res.fun, cov_x)
+            if res.success and self.accept(res.x, gof):
+                logger.info(f"REFIT {x} {y} {REFIT_STRATEGIES[3]}")
+                return x, y, res.x, 1, gof, 3
+        except (ValueError, np.linalg.LinAlgError):
+            pass
+
+        # 4: half width fallback
+        wmin, wmax = self.width_limits()
+        if wmin < width < wmax and np.nanmax(ys) - np.nanmedian(ys) > self.PMAX / 2:
+            logger.info(f"REFIT {x} {y} {REFIT_STRATEGIES[4]}")
+            return x, y, [offset, np.nanmax(ys) - offset, center, width], 1, NOGOF, 4
+
+        return x, y, [0, 0, 0, 0], 0, NOGOF, 0
+
     def fit(self, args):
         "wrapper function for all fitting methods"
         x, y, method, options, show = args
-        if self.count == 0:
-            msg = f"starting {os.getpid()}\n"
-        elif self.count % 100 == 0:
-            msg = "."
-        else:
-            msg = ""
-        if msg:
-            print(msg, end="", flush=True)
         self.count += 1
         ret, ret2, ret3, ret4, ret5 = None, None, None, None, None
         ys = self.data[:, x, y]
@@ -231,18 +447,10 @@ class Data:
             ys = np.where(ys > self.cut, np.nan, ys)
         xs = np.array(self.xs)
         if options["filter"] > 0 and max(ys) - min(ys) < options["filter"]:
-            return x, y, [0, 0, 0, 0], -1, ys
+            self.nfilter += 1
+            return x, y, [0, 0, 0, 0], -1, ys, NOGOF
             # return x, y, [np.nan, np.nan, np.nan, np.nan], -1, ys
 
-        def model(xs, coeffs):
-            return coeffs[0] + coeffs[1] * np.exp(
-                -(((xs - coeffs[2]) / (ROOT2 * coeffs[3])) ** 2)
-            )
-
-        def residuals(coeffs, y, xs):
-            y0 = np.where(np.isnan(y), 0, y)
-            return y0 - model(xs, coeffs)
-
         if method == "gaussian" or method == "all":
             t = np.arange(len(xs))
             ymax = np.max(ys)
@@ -255,41 +463,27 @@ class Data:
                 center = np.mean(a)
                 wid = 10
                 x0 = np.array([yavg, ymax, center, wid], dtype=float)
-                x1, flag = leastsq(residuals, x0, args=(ys, xs), maxfev=5000)
+                x1, cov_x, info, _, flag = leastsq(
+                    residuals, x0, args=(ys, xs), maxfev=5000, full_output=True
+                )
+                self.nfit += 1
+                self.nfev += info["nfev"]
                 logger.info(f"{x} {y} {flag}")
-                ret = x, y, x1, flag, ys
+                gof = self.goodness(ys, info["fvec"], cov_x)
+                logger.info(f"GOF {dict(zip(GOF_KEYS, gof))}")
+                ret = x, y, x1, flag, ys, gof
                 logger.info(f"GAUSS {x1[2]} {x1[3]} OS {x1[0]} {x1[1]}")
                 yy = ys - x1[0]
                 y0 = np.abs(np.sum(yy * (xs - x1[2]) ** 2))
                 y1 = np.sum(yy)
                 logger.info(f"NAIVE_WIDTH {np.sqrt(y0 / y1)}")
             else:
-                ret = x, y, [0, 0, 0, 0], 0, ys
+                ret = x, y, [0, 0, 0, 0], 0, ys, NOGOF
                 # ret = x, y, [np.nan, np.nan, np.nan, np.nan], 0, ys
                 
-            if ret[3] == 0 and ymax > yavg + self.PMAX:
-                print(
-                    "MIN",
-                    min(ys),
-                    "1%",
-                    np.quantile(ys, 0.01),
-                    "10%",
-                    np.quantile(ys, 0.1),
-                    "25%",
-                    np.quantile(ys, 0.25),
-                    "50%",
-                    np.quantile(ys, 0.5),
-                    "75%",
-                    np.quantile(ys, 0.75),
-                    "90%",
-                    np.quantile(ys, 0.9),
-                    "99%",
-                    np.quantile(ys, 0.99),
-                    "MAX",
-                    max(ys),
-                )
-                plt.plot(ys)
-                plt.show()
+            # fit was tried but is not accepted (only flag 1 is used for the maps)
+            if ret[3] != 1 and ymax > yavg + self.PMAX:
+                self.record_failure(x, y, ret[3], x0, ys)
         #if method == "bcog" or method == "all":
         #    signal_est, bg_est = self.nbeads(ys, options.get("margin", 3))
         #    offset = np.mean(bg_est)
@@ -340,9 +534,9 @@ class Data:
             center, width = self.hw(xs, signal_est)
             logger.info(f"HW {center} {width} OFF {offset} {scale}")
             if width == 0:
-                ret5 = x, y, [offset, scale, center, width], -1, ys
+                ret5 = x, y, [offset, scale, center, width], -1, ys, NOGOF
             else:
-                ret5 = x, y, [offset, scale, center, width], 1, ys
+                ret5 = x, y, [offset, scale, center, width], 1, ys, NOGOF
 
 
         if show:
@@ -372,6 +566,134 @@ class Data:
         return ret
 
 
+def _init_worker(queue):
+    "pool initializer, progress messages of the worker go to 'queue'"
+    global _progress_queue
+    _progress_queue = queue
+
+
+def summarize_progress(stage, states, total, elapsed):
+    "combine the last message of every worker into one progress record"
+    done = sum(s["done"] for s in states.values())
+    nfit = sum(s["nfit"] for s in states.values())
+    nfev = sum(s["nfev"] for s in states.values())
+    return {
+        "stage": stage,
+        "elapsed": round(elapsed, 1),
+        "done": done,
+        "total": total,
+        "rate": round(done / elapsed, 1) if elapsed > 0 else 0.0,
+        "filtered": sum(s["filtered"] for s in states.values()),
+        "failed": sum(s["failed"] for s in states.values()),
+        "nfev": round(nfev / nfit, 2) if nfit else 0.0,
+        "workers": {str(pid): s["done"] for pid, s in sorted(states.items())},
+    }
+
+
+def run_pool(func, vs, stage="fit", callback=None, interval=10.0):
+    """pool.map(func, vs) with one process per list in vs
+    callback(progress) is called every 'interval' seconds and once at the end"""
+    queue = Queue()
+    total = sum(len(v) for v in vs)
+    states = {}
+    start = time.time()
+    last = start
+    with Pool(len(vs), initializer=_init_worker, initargs=(queue,)) as pool:
+        result = pool.map_async(func, vs)
+        while True:
+            ready = result.ready()
+            try:
+                while True:
+                    msg = queue.get(timeout=0.2)
+                    states[msg["pid"]] = msg
+            except Empty:
+                pass
+            now = time.time()
+            if callback is not None and (ready or now - last >= interval):
+                callback(summarize_progress(stage, states, total, now - start))
+                last = now
+            if ready:
+                break
+        return result.get()
+
+
+def fit_maps(D, method, options, ncpu=1, refit=False, callback=None, interval=10.0):
+    """fit all pixels of D on 'ncpu' processes
+
+    returns maps {'c', 'h', 'w'} (+ GOF_KEYS for gaussian, + 'refit' with refit=True)
+    and info {'skipped', 'good', 'failed', 'failures', 'refit'}
+    callback(progress) receives a dict every 'interval' seconds:
+    stage, elapsed [s], done, total, rate [pixel/s], filtered, failed,
+    nfev (function evaluations per gaussian fit), workers {pid: done}"""
+    H = np.zeros((D.NX, D.NY), dtype=np.float32) + np.nan
+    C = np.zeros((D.NX, D.NY), dtype=np.float32) + np.nan
+    W = np.zeros((D.NX, D.NY), dtype=np.float32) + np.nan
+    # goodness-of-fit maps (gaussian fit only)
+    use_gof = method in ("gaussian", "all")
+    G = {k: np.zeros((D.NX, D.NY), dtype=np.float32) + np.nan for k in GOF_KEYS} if use_gof else {}
+
+    vs = [[] for n in range(ncpu)]
+    idx = 0
+    for xx in range(D.NX):
+        for y in range(D.NY):
+            vs[idx].append((xx, y, method, options, False))
+            idx = (idx + 1) % ncpu
+    fits = run_pool(D.fits, vs, "fit", callback, interval)
+
+    ns = 0
+    ng = 0
+    nf = 0
+    failures = []
+    F = np.zeros((D.NX, D.NY), dtype=np.int8)
+    for rets, fails, nfail in fits:
+        failures.extend(fails)
+        nf += nfail
+        for ret in rets:
+            x, y, x1, flag, _, gof = ret
+            F[x, y] = flag
+            if flag == 1:
+                H[x, y] = x1[1]
+                C[x, y] = x1[2]
+                W[x, y] = x1[3]
+                for k, v in zip(G, gof):
+                    G[k][x, y] = v
+                ng += 1
+            if flag == -1:
+                ns += 1
+    maps = {"c": C, "h": H, "w": W, **G}
+
+    # second pass only for failed or suspicious pixels
+    counts = None
+    if refit and use_gof:
+        wmin, wmax = D.width_limits()
+        mask = refit_candidates(F, W, G["chi2"], wmin, wmax, D.CHI2MAX)
+        seeds = neighbour_seeds(C, H, W, (F == 1) & ~mask, mask)
+        vs = [[] for n in range(ncpu)]
+        for idx, (xx, y, seed) in enumerate(seeds):
+            vs[idx % ncpu].append((xx, y, seed))
+        # the workers load the data again, not worth it without candidates
+        refits = run_pool(D.refits, vs, "refit", callback, interval) if seeds else []
+
+        R = np.zeros((D.NX, D.NY), dtype=np.int8)
+        for rets in refits:
+            for x, y, x1, flag, gof, strategy in rets:
+                R[x, y] = strategy
+                if flag == 1:
+                    if F[x, y] != 1:
+                        ng += 1
+                    H[x, y] = x1[1]
+                    C[x, y] = x1[2]
+                    W[x, y] = x1[3]
+                    for k, v in zip(GOF_KEYS, gof):
+                        G[k][x, y] = v
+        counts = {s: int(np.sum(R[mask] == i)) for i, s in enumerate(REFIT_STRATEGIES)}
+        # float32 like the other maps (npy2folder reads all .npy as float32)
+        maps["refit"] = R.astype(np.float32)
+
+    info = {"skipped": ns, "good": ng, "failed": nf, "failures": failures, "refit": counts}
+    return maps, info
+
+
 def main():
     # commandline options
     parser = argparse.ArgumentParser()
@@ -389,8 +711,21 @@ def main():
     # If peak hight< + peak hight average +pmax then  fitting values nan 
     parser.add_argument("--ny", help="number of y pixels (Height=NY)", type=int)
     parser.add_argument("--pmax", help="PMAX for only use gaussian fitting", type=int)
+    parser.add_argument(
+        "--maxfail", help="number of failed fits stored per cpu (gaussian fitting)", type=int)
+    parser.add_argument(
+        "--refit", help="fit failed or suspicious pixels again (gaussian fitting)",
+        action="store_true")
+    parser.add_argument(
+        "--chi2max", help="refit gaussian fits with larger reduced chi-square", type=float)
+    parser.add_argument(
+        "--progress", help="print progress as json line every [progress] seconds, 0: off",
+        default=0.0, type=float)
     parser.add_argument(
         "--background", "-b", help="subtract background", action="store_true")
+    parser.add_argument(
+        "--crop", help=f"fit only the crop of {CROPFILE} in the data directory (virtual trimming)",
+        action="store_true")
     parser.add_argument("--show", "-s", help="show graph", action="store_true")
     parser.add_argument("--showonly", help="only show graph", action="store_true")
     parser.add_argument(
@@ -457,6 +792,9 @@ def main():
     cpath = Path(f"{base}_c.npy")
     hpath = Path(f"{base}_h.npy")
     wpath = Path(f"{base}_w.npy")
+    gofpaths = {k: Path(f"{base}_{k}.npy") for k in GOF_KEYS}
+    failpath = Path(f"{base}{FAILFILE}")
+    refitpath = Path(f"{base}_refit.npy")
 
     
     # nx,ny
@@ -466,9 +804,27 @@ def main():
         Data.NY = args.ny
     if args.pmax is not None:
         Data.PMAX = args.pmax
+    if args.maxfail is not None:
+        Data.MAXFAIL = args.maxfail
+    if args.chi2max is not None:
+        Data.CHI2MAX = args.chi2max
+
+    # crop
+    crop = None
+    if args.crop:
+        p = args.data / CROPFILE
+        if not p.exists():
+            error(f"file does not exist: {p}")
+        with open(p) as f:
+            crop = json.load(f)
+        if crop.get("shape") and args.nx is None and args.ny is None:
+            Data.NX, Data.NY = crop["shape"]
+        if not (0 <= crop["y"] and crop["y"] + crop["height"] <= Data.NX
+                and 0 <= crop["x"] and crop["x"] + crop["width"] <= Data.NY):
+            error(f"illegal crop {crop} for images of {Data.NX} x {Data.NY}")
         
     # data object
-    D = Data(args.data, args.fmt, args.cut, args.background, ang2f)
+    D = Data(args.data, args.fmt, args.cut, args.background, ang2f, crop)
 
 
 
@@ -499,45 +855,31 @@ def main():
         D.fit(xymos)
 
     elif not args.showonly:
-        # make (D.NX,D.NY) np.nan array
         D.data = None
-        H = np.zeros((D.NX, D.NY), dtype=np.float32) + np.nan
-        C = np.zeros((D.NX, D.NY), dtype=np.float32) + np.nan
-        W = np.zeros((D.NX, D.NY), dtype=np.float32) + np.nan
-
-        now = dt.now()
-        vs = []
-        for n in range(args.pool):
-            vs.append([])
-
-        idx = 0
-        for xx in range(D.NX):
-            for y in range(D.NY):
-                vs[idx].append((xx, y, args.method, options, False))
-                idx = (idx + 1) % args.pool
-        with Pool(args.pool) as pool:
-            fits = pool.map(D.fits, vs)
-
-        ns = 0
-        ng = 0
-        for rets in fits:
-            for ret in rets:
-                # print(ret)
-                x, y, x1, flag, _ = ret
-                if flag == 1:
-                    # print(x1,"H",x1[1],"C",x1[2]/100,"W",x1[3])
-                    H[x, y] = x1[1]
-                    C[x, y] = x1[2]
-                    W[x, y] = x1[3]
-                    ng += 1
-                if flag == -1:
-                    ns += 1
-        print(f"skipped: {ns} good: {ng}")
+        callback = None
+        if args.progress > 0:
+            callback = lambda p: print(json.dumps(p), flush=True)
+        maps, info = fit_maps(
+            D, args.method, options, args.pool, refit=args.refit,
+            callback=callback, interval=args.progress
+        )
+        if info["refit"] is not None:
+            print(f"refit: {info['refit']}")
+        print(f"skipped: {info['skipped']} good: {info['good']} failed: {info['failed']}")
         print(str(cpath))
 
-        C.tofile(cpath)
-        H.tofile(hpath)
-        W.tofile(wpath)
+        maps["c"].tofile(cpath)
+        maps["h"].tofile(hpath)
+        maps["w"].tofile(wpath)
+        for k, path in gofpaths.items():
+            if k in maps:
+                logger.info(f"writing data to {path}")
+                maps[k].tofile(path)
+        if "refit" in maps:
+            maps["refit"].tofile(refitpath)
+        if info["failures"]:
+            logger.info(f"writing {len(info['failures'])} of {info['failed']} failed fits to {failpath}")
+            save_failures(failpath, D.xs, info["failures"])
 
     if not args.xpos and args.show:
         import matplotlib.pyplot as plt
@@ -559,7 +901,7 @@ def main():
                 "x": [1200, 2400],
             }[c]
 
-            data = np.fromfile(path, dtype=dtype).reshape(2368, 2240)
+            data = np.fromfile(path, dtype=dtype).reshape(D.NX, D.NY)
             # im = ax.imshow(data, cmap=cmap, vmin=vmin, vmax=vmax)
             im = ax.imshow(data, cmap=cmap)
 
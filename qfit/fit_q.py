@@ -12,12 +12,20 @@ __version__= "1.0.0"
 __revised__ = "2022/09/02"
 
 
+import json
 from pathlib import Path
 import subprocess
 from subprocess import PIPE
+import threading
 import time
 
+import numpy as np
+import tifffile as tiff
+
 from qfit import file_folder_trans as fft
+from qfit import q2
+from qfit import re_analysis as rean
+from qfit import virtual_crop as vc
 
 P = Path().resolve()
 # print(Path().resolve())
@@ -27,17 +35,29 @@ P = Path().resolve()
 # FIT_path = str(list(P.glob('*/fit.py'))[0])
 FIT_path = str(list(P.glob('**/fit.py'))[0])
 
-#./qfit/q2.py
-# q2_path = str(list(P.glob('*/q2.py'))[0])
-q2_path = str(list(P.glob('**/q2.py'))[0])
-
 
 # print(FIT_path)
 # print(q_path)
 
 
+def print_progress(progress):
+    """default progress callback of fit_analysis (one updating line)
+
+    Args:
+        progress (dict): stage, elapsed[s], done, total, rate[pixel/s], filtered, failed,
+            nfev(function evaluations per gaussian fit), workers{pid: done}
+    """
+    p = progress
+    print(f"\r{p['stage']}: {p['done']}/{p['total']} pixels, {p['rate']:.0f} pixel/s, "
+          f"filtered: {p['filtered']}, failed: {p['failed']}, nfev: {p['nfev']}, "
+          f"{p['elapsed']:.0f} s", end='', flush=True)
+    if p['done'] == p['total']:
+        print('')
+
+
 def fit_analysis(target_file, method='hw', comment='', filter=30, pmax=30, 
-                NX=2368, NY=2240, core=4, timeout=20000, out_tif=True):
+                NX=2368, NY=2240, core=4, timeout=20000, out_tif=True, refit=False,
+                progress=print_progress, interval=10, crop=False):
     """Rocing curve fitting using subprocess
 
     Args:
@@ -57,6 +77,12 @@ def fit_analysis(target_file, method='hw', comment='', filter=30, pmax=30,
         core (int, optional): Number of cores. Defaults to 4.
         timeout (int, optional): fitting timeout. Defaults to 20000.-> about 5.5h
         out_tif (bool, optional): output to tif file. Defaults to 'True'
+        refit (bool, optional): fit failed or suspicious pixels again (gaussian only). Defaults to False.
+        progress (callable, optional): called with a progress dict while fit.py runs.
+            Defaults to print_progress. None: no progress.
+        interval (float, optional): progress interval [s]. Defaults to 10.
+        crop (bool, optional): fit only the crop of crop.json in the target folder
+            (virtual_crop.save_crop, fit.py --crop), the maps are height x width. Defaults to False.
 
     Returns:
         folder_dir(str): Output folder name
@@ -82,22 +108,45 @@ def fit_analysis(target_file, method='hw', comment='', filter=30, pmax=30,
     command_list = ['python',FIT_path, str(target_file), method, '-f', 'tif', 
                     '--filter', str(filter), '-n', str(core),'-s','--pmax', 
                     str(pmax),'-b','--nx', str(NX), '--ny', str(NY) ]
+    if refit:
+        command_list.append('--refit')
+    if crop:
+        command_list.append('--crop')
+        crop_info = vc.crop_of(target_file)
+        if crop_info is not None:
+            NX, NY = crop_info['height'], crop_info['width']
+    # fit.py prints no progress by default
+    if progress is not None:
+        command_list += ['--progress', str(interval)]
     proc = subprocess.Popen(command_list, stdout=PIPE, stderr=PIPE)
 
-
-    try:
-        outs, errs = proc.communicate(timeout=timeout)
-    except subprocess.SubprocessError:
-        proc.kill()
-        outs, errs = proc.communicate()
+    # stdout is read while fit.py runs (json lines are progress),
+    # stderr is drained in a thread and the process is killed after timeout
+    errs = []
+    err_thread = threading.Thread(target=lambda: errs.append(proc.stderr.read()), daemon=True)
+    err_thread.start()
+    timer = threading.Timer(timeout, proc.kill)
+    timer.start()
+    outs = []
+    for line in iter(proc.stdout.readline, b''):
+        s = line.decode('utf-8')
+        if s.startswith('{') and progress is not None:
+            try:
+                progress(json.loads(s))
+                continue
+            except ValueError:
+                pass
+        outs.append(s)
+    proc.wait()
+    timer.cancel()
         
     elasp_time =time.time()-start_time
     print(f'Elasped time: {elasp_time :.1f}[s] @ {core} cores')
-    outstring = outs.decode('utf-8').split('\n')
+    outstring = ''.join(outs).split('\n')
     
     
     try:
-        out_file = outstring[-3].strip()
+        out_file = [s.strip() for s in outstring if s.strip().endswith('_c.npy')][-1]
 
     except:
         out_file = "error, check the angle file"
@@ -115,20 +164,86 @@ def fit_analysis(target_file, method='hw', comment='', filter=30, pmax=30,
     return folder_dir, outstring
     
 
+def load_map(target, NX=2368, NY=2240):
+    """peak map from a headerless float32 .npy file (fit.py output) or an array
+
+    Files are read with vc.read_npy, cropped to the crop descriptor of their folder if any.
+
+    Args:
+        target (str or ndarray): .npy file path and name, or an array (returned as float32)
+        NX (int, optional) : number of x pixels. Defaults to 2368.
+        NY (int, optional) : number of y pixels. Defaults to 2240.
+
+    Returns:
+        ndarray: (NX, NY) float32, or the cropped (height, width) read-only view
+    """
+    if isinstance(target, (str, Path)):
+        return vc.read_npy(target, NX, NY, vc.crop_of(target))
+    return np.asarray(target, dtype=np.float32)
+
+
+def save_maps(maps, out_file, out_tif=True):
+    """save maps as {out_file}/{out_file}_{key}.npy (and .tif), the layout of fft.npy2folder
+
+    Args:
+        maps (dict): {key: 2D array}
+        out_file (str): output file name (folder name)
+        out_tif (bool, optional): output to tif file. Defaults to 'True'
+
+    Returns:
+        pathlib: output folder
+    """
+    p_dir = Path(out_file).resolve()
+    p_dir.mkdir(parents=True, exist_ok=True)
+    for key, data in maps.items():
+        data = np.asarray(data, dtype=np.float32)
+        data.tofile(str(p_dir / f'{p_dir.name}_{key}.npy'))
+        if out_tif:
+            tiff.imwrite(str(p_dir / f'{p_dir.name}_{key}.tif'), data, compression=None)
+    return p_dir
+
+
+def q_analysis(target_t, target_c, angle_t=0, angle_c=120, q=6.258, NX=2368, NY=2240):
+    """q calculation in memory (q2.compute_q), no files are written
+
+    Args:
+        target_t (str or ndarray): angle_t .npy file or peak map. data unit [arcsec].
+        target_c (str or ndarray): angle_c .npy file or peak map. data unit [arcsec].
+        angle_t (int, optional): theta angle . Defaults to 0.
+        angle_c (int, optional): chi angle. Defaults to 120.
+        q (float, optional): lattice value. Defaults to 6.258.
+        NX (int, optional) : number of x pixels (only for .npy files). Defaults to 2368.
+        NY (int, optional) : number of y pixels (only for .npy files). Defaults to 2240.
+
+    Returns:
+        dict: same as rean.load_q_tif {'x', 'y', 'z', 'xy', 'ang', 'angxy', 'r'}
+
+    Example:
+        rc0 = rean.load_rc_tif(out_folder_0)
+        rc120 = rean.load_rc_tif(out_folder_120)
+        q_0120 = q_analysis(rc0['c'], rc120['c'], angle_t=0, angle_c=120)
+    """
+    ret = q2.compute_q(load_map(target_t, NX, NY), load_map(target_c, NX, NY),
+                       angle_t, angle_c, q)
+    return rean.q_dict(ret['x'], ret['y'], ret['z'])
+
+
 def q_analysis_2R(target_t, target_c, out_file='q_anal', angle_t=0, angle_c=120, 
-                q=6.258, NX=2368, NY=2240, out_tif=True):
-    """q calculation using subprocess
+                q=6.258, NX=2368, NY=2240, out_tif=True, out_fig=True):
+    """q calculation (q2.compute_q) and save to the folder out_file
 
     Args:
-        target_t (str):  angle_t .npy file path and name. data unit [arcsec].
-        target_c (str):  angle_c .npy file path and name. data unit [arcsec].
+        target_t (str or ndarray):  angle_t .npy file path and name or peak map. data unit [arcsec].
+        target_c (str or ndarray):  angle_c .npy file path and name or peak map. data unit [arcsec].
         out_file (str, optional): output file name. Defaults to 'q_anal'.
         angle_t (int, optional): theta angle . Defaults to 0.
         angle_c (int, optional): chi angle. Defaults to 120.
         q (float, optional): lattice value. Defaults to 6.258.
-        NX (int, optional) : number of x pixels (Width=NX), type=int, default=2240
-        NY (int, optional) : number of y pixels (Height=NY), type=int, default=2368
+        NX (int, optional) : number of x pixels (Width=NX), type=int, default=2368
+        NY (int, optional) : number of y pixels (Height=NY), type=int, default=2240
         out_tif (bool, optional): output to tif file. Defaults to 'True'
+        out_fig (bool, optional): save the summary figure (q2.summary_figure) as
+            {out_file}/{out_file}_f.png. Defaults to 'True'
         
     Returns:
         folder_dir(str): Output folder name
@@ -147,32 +262,54 @@ def q_analysis_2R(target_t, target_c, out_file='q_anal', angle_t=0, angle_c=120,
     print(f'outfile name:{out_file}')
     print(f'Image Size (h(NY),w(NX)):{NY ,NX}')
     print(f'set Angle t: {angle_t}, c: {angle_c}')
-    print(f'set target t: {str(target_t)}, c: {str(target_c)}')
-    
-    command_list = ['python', q2_path, '-t', str(target_t), '-c', str(target_c), '-p', out_file, 
-                    '-q', str(q), '-s', '--anglet', str(angle_t), '--anglec', str(angle_c),
-                    '--nx', str(NX), '--ny', str(NY) ]
+    if isinstance(target_t, (str, Path)):
+        print(f'set target t: {str(target_t)}, c: {str(target_c)}')
 
-    proc = subprocess.Popen(command_list, stdout=PIPE, stderr=PIPE)
+    ret = q2.compute_q(load_map(target_t, NX, NY), load_map(target_c, NX, NY),
+                       angle_t, angle_c, q)
+    folder_dir = save_maps(ret, out_file, out_tif)
+    if out_fig:
+        import matplotlib.pyplot as plt
+        fig_path = folder_dir / f'{folder_dir.name}_f.png'
+        plt.close(q2.summary_figure(ret['x'], ret['y'], ret['z'], out_file, str(fig_path)))
+        print(fig_path)
+    print('-'*10)
 
-    try:
-        outs, errs = proc.communicate(timeout=1800)
-    except subprocess.SubprocessError:
-        proc.kill()
-        outs, errs = proc.communicate()
-    
-    output_file_name = f'{out_file}_x.npy'
+    return folder_dir
+
+
+def q_analysis_nR(targets, angles, out_file='q_anal', q=6.258, NX=2368, NY=2240, out_tif=True):
+    """q calculation from two or more psi directions (least squares, q2.solve_q)
+
+    One run instead of the pairwise q_analysis_2R runs and re_analysis.average_3q.
+    The rms residual of the peak shifts [arcsec] is saved as {out_file}_res.
 
-    folder_dir= fft.npy2folder(output_file_name,NX,NY,out_tif)
+    Args:
+        targets (list): .npy file path and name or peak map of each direction. data unit [arcsec].
+        angles (list[int]): psi angle of each direction [deg].
+        out_file (str, optional): output file name. Defaults to 'q_anal'.
+        q (float, optional): lattice value. Defaults to 6.258.
+        NX (int, optional) : number of x pixels (Width=NX), type=int, default=2368
+        NY (int, optional) : number of y pixels (Height=NY), type=int, default=2240
+        out_tif (bool, optional): output to tif file. Defaults to 'True'
+
+    Returns:
+        folder_dir(str): Output folder name
+
+    Example:
+        targets = ['hw_210721_105547_c.npy', 'hw_210721_105858_c.npy', 'hw_210721_110210_c.npy']
+        q_analysis_nR(targets, angles=[0, 120, -120], out_file='q_3d')
+    """
+
+    print(f'outfile name:{out_file}')
+    print(f'Image Size (h(NY),w(NX)):{NY ,NX}')
+    print(f'set Angles: {list(angles)}')
 
-    # print(f'Output file name: {out_file}')
-    # print(f'Folder name: {str(folder_dir)}')
-   
-    outstring=outs.decode('utf-8').split('\n')
-    print(outstring)
-    print('-'*10)  
+    ret = q2.solve_q([load_map(t, NX, NY) for t in targets], angles, q)
+    folder_dir = save_maps({k: ret[k] for k in ('x', 'y', 'z', 'res')}, out_file, out_tif)
+    print('-'*10)
 
     return folder_dir
-    
+
 if __name__ == '__main__':
     pass
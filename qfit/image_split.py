@@ -6,6 +6,8 @@ import cv2
 import numpy as np
 from PIL import Image
 
+from qfit import map_stats as ms
+
 def split_row_col(imagefile, rows, cols, save=False, outpath='out', ext='tif'):
     """
     行数、列数を指定して、分割する場合
@@ -123,9 +125,10 @@ def split_average(split_lists, rows, cols):
 
     ave_image = np.array(ave_lists).reshape((rows,cols))
 
+    row = ms.describe([ave_image], quantiles=(0.5,), sample=None).result()['0']
     print(f'shape:{ave_image.shape}')
-    print(f'Max:{np.nanmax(ave_image):.2f}, Min:{np.nanmin(ave_image):.2f}')
-    print(f'Ave:{np.nanmean(ave_image):.2f}, Median:{np.nanmedian(ave_image):.2f}')
+    print(f"Max:{row['max']:.2f}, Min:{row['min']:.2f}")
+    print(f"Ave:{row['mean']:.2f}, Median:{row['q50']:.2f}")
 
     return ave_image
 
@@ -2,6 +2,7 @@
 Image treatment 
 - calling affine_transformation_parameters_editor_r.py
 - trimming GUI and trimming
+- virtual trimming (virtual_crop): crop.json in the folder instead of a trimmed copy
 
 """
 
@@ -12,10 +13,13 @@ __date__ = "2022/09/02"
 __version__= "1.0.0"
 __revised__ = "2022/09/02"
 
+from functools import lru_cache
+import json
 from pathlib import Path
 import subprocess
 from subprocess import PIPE
 import time
+import warnings
 
 import cv2
 import numpy as np
@@ -24,6 +28,8 @@ import tifffile as tiff
 
 
 from qfit import file_folder_trans as fft
+from qfit import virtual_crop as vc
+from qfit import wafer
 
 editor_path = Path().resolve()
 # print(Path().resolve())
@@ -31,6 +37,11 @@ editor_path = Path().resolve()
 
 img_edit_path = str(list(editor_path.glob('*/affine_transformation_parameters_editor_r.py'))[0])
 
+# trimming record written by auto2trim
+TRIM_SIDECAR = 'trim.json'
+# largest side of the trimming GUI preview [pixel]
+PREVIEW_SIZE = 1200
+
 
 def img_editor_process():
     """ Call affine_transformation_parameters_editor_r.py
@@ -58,7 +69,7 @@ def img_editor_process():
 
     return output_folder_list, outstring
 
-def gui2trim(file_name, wh=1100, NX=2368, NY=2240, time_out=120):
+def gui2trim(file_name, wh=1100, NX=2368, NY=2240, time_out=120, virtual=False):
     """trim gui + trimming Main function
         wrapping pos_est_rect
         
@@ -70,18 +81,19 @@ def gui2trim(file_name, wh=1100, NX=2368, NY=2240, time_out=120):
         NX (int, optional): original size w. Defaults to 2368.
         NY (int, optional): original size h. Defaults to 2240.
         time_out (int, optional): GUI timeout [s]. Defaults to 120. -> 3 min
+        virtual (bool, optional): virtual_trim instead of folder2trim2tif. Defaults to False.
     
     Returns:
-        pathlib : new holder name path
+        pathlib : new holder name path (virtual: the folder of file_name)
     """
 
     trim_position = pos_est_rect(file_name, wh, NX, NY, time_out)
 
-    new_folder = folder2trim2tif(file_name, *trim_position)
+    new_folder = _trim_folder(file_name, trim_position, virtual)
 
     return new_folder
 
-def gui2trim2(file_name, wh=1100, NX=2368, NY=2240, time_out=120):
+def gui2trim2(file_name, wh=1100, NX=2368, NY=2240, time_out=120, virtual=False):
     """trim gui + triming Main function
         wrapping pos_est_rect
         
@@ -95,34 +107,143 @@ def gui2trim2(file_name, wh=1100, NX=2368, NY=2240, time_out=120):
         NX (int, optional): original size w. Defaults to 2368.
         NY (int, optional): original size h. Defaults to 2240.
         time_out (int, optional): GUI timeout [s]. Defaults to 120. -> 3 min
+        virtual (bool, optional): virtual_trim instead of folder2trim2tif. Defaults to False.
         
     Returns:
-        pathlib : new holder name path
+        pathlib : new holder name path (virtual: the folder of file_name)
         trim_position :tuple
     """
 
     trim_position = pos_est_rect(file_name, wh, NX, NY, time_out)
 
-    new_folder = folder2trim2tif(file_name, *trim_position)
+    new_folder = _trim_folder(file_name, trim_position, virtual)
 
     return new_folder, trim_position
 
-def pos_est_rect(file_name, wh=1100, NX=2368, NY=2240, time_out=120):
-    """trimming position estimation by using opencv GUI
+def auto2trim(file_name, wh=1100, margin=0, NX=2368, NY=2240, virtual=False):
+    """automatic trimming (no GUI): position from the detected wafer circle + trimming
+        gui2trim2 without pos_est_rect, the trim is recorded in new folder/trim.json
+        (virtual: in the crop.json of the folder)
 
     Args:
-        file_name (str):file name or folder. Allowed file types -> .tif, .npy, (.jpeg, .png)
-        wh (int, optional): triming size. Defaults to 1100.
-                            1 px -> 0.05 mm  2 inch -> 1100
+        file_name (str or pathlib): file path or folder
+        wh (int, optional): triming size. None: wafer diameter + 2 * margin. Defaults to 1100.
+        margin (int, optional): margin around the wafer [pixel] (wh=None). Defaults to 0.
+        NX (int, optional): original size w. Defaults to 2368.
+        NY (int, optional): original size h. Defaults to 2240.
+        virtual (bool, optional): virtual_trim instead of folder2trim2tif. Defaults to False.
+
+    Returns:
+        pathlib : new holder name path (virtual: the folder of file_name)
+        trim_position :tuple
+    """
+    trim_position, geom = auto_trim_position(file_name, wh, margin, NX, NY, with_geometry=True)
+
+    new_folder = _trim_folder(file_name, trim_position, virtual)
+    if not virtual:
+        save_trim(new_folder, trim_position, source=file_name, geom=geom)
+
+    return new_folder, trim_position
+
+def batch_auto2trim(file_names, wh=1100, margin=0, NX=2368, NY=2240, same_position=False, virtual=False):
+    """automatic trimming of several folders (e.g. all wafers and directions), unattended
+
+    Args:
+        file_names (list): file paths or folders
+        wh (int, optional): triming size. None: wafer diameter + 2 * margin. Defaults to 1100.
+        margin (int, optional): margin around the wafer [pixel] (wh=None). Defaults to 0.
+        NX (int, optional): original size w. Defaults to 2368.
+        NY (int, optional): original size h. Defaults to 2240.
+        same_position (bool, optional): use the position of the first folder for all. Defaults to False.
+        virtual (bool, optional): virtual_trim instead of folder2trim2tif. Defaults to False.
+
+    Returns:
+        list: [(new folder, trim_position)]
+    """
+    results = []
+    trim_position = geom = None
+    for file_name in file_names:
+        if trim_position is None or not same_position:
+            trim_position, geom = auto_trim_position(file_name, wh, margin, NX, NY, with_geometry=True)
+        new_folder = _trim_folder(file_name, trim_position, virtual)
+        if not virtual:
+            save_trim(new_folder, trim_position, source=file_name, geom=geom)
+        print(f'{Path(file_name).name} -> {new_folder.name}: {trim_position}')
+        results.append((new_folder, trim_position))
+
+    return results
+
+def auto_trim_position(file_name, wh=1100, margin=0, NX=2368, NY=2240, with_geometry=False):
+    """trimming position from the detected wafer circle (wafer.detect_wafer), replaces pos_est_rect
+
+    For a folder with a _h map, the geometry is cached in the folder (wafer.wafer_geometry).
+    The window is centered on the wafer and kept inside the image (full maps, a crop.json is ignored).
+    A window larger than the image is reduced to the short side of the image (with a warning).
+
+    Args:
+        file_name (str or ndarray): file name, folder or image
+        wh (int, optional): triming size. None: wafer diameter + 2 * margin. Defaults to 1100.
+        margin (int, optional): margin around the wafer [pixel] (wh=None). Defaults to 0.
         NX (int, optional): Original width. Defaults to 2368.
         NY (int, optional): Original height. Defaults to 2240.
-        time_out (int, optional): time out second. Defaults to 120.
+        with_geometry (bool, optional): also return the wafer geometry. Defaults to False.
 
     return:
-        int: cord_x, cord_y, wh, wh
+        int: cord_x, cord_y, wh, wh (same as pos_est_rect)
+
+    Raises:
+        ValueError: no plausible wafer is found (wafer.plausible)
     """
-    
-    start = time.time()
+    geom = None
+    if not isinstance(file_name, np.ndarray):
+        fp_name = Path(file_name).resolve()
+        if fp_name.is_dir() and list(fp_name.glob('*_h.tif')):
+            geom = wafer.wafer_geometry(fp_name, crop=False)
+    if geom is None:
+        img = load_image(file_name, NX, NY)
+        geom = wafer.detect_wafer(img)
+    if not wafer.plausible(geom):
+        raise ValueError(f'wafer not found: {file_name}')
+
+    rows, cols = geom['shape']
+    cx, cy = geom['center']
+    if wh is None:
+        wh = int(np.ceil(2 * (geom['radius'] + margin)))
+    if wh > min(rows, cols):
+        warnings.warn(f'trimming size {wh} is larger than the image {(rows, cols)}, reduced to {min(rows, cols)}')
+        wh = min(rows, cols)
+    cord_x = int(np.clip(round(cx - wh / 2), 0, max(cols - wh, 0)))
+    cord_y = int(np.clip(round(cy - wh / 2), 0, max(rows - wh, 0)))
+    print(f'wafer center: ({cx:.1f}, {cy:.1f}), radius: {geom["radius"]:.1f}')
+    print(f'start x:{cord_x}, y:{cord_y} --wh:{wh}-- end x:{cord_x+wh}, y:{cord_y+wh}')
+
+    if with_geometry:
+        return (cord_x, cord_y, wh, wh), geom
+    return cord_x, cord_y, wh, wh
+
+def save_trim(folder, trim_position, source=None, geom=None):
+    """record a trimming in folder/trim.json (x, y, width, height, source folder, wafer geometry)"""
+    x, y, width, height = (int(v) for v in trim_position)
+    info = {'x': x, 'y': y, 'width': width, 'height': height,
+            'source': None if source is None or isinstance(source, np.ndarray) else str(Path(source).resolve()),
+            'wafer': geom}
+    with open(Path(folder)/TRIM_SIDECAR, 'w') as f:
+        json.dump(info, f, indent=2)
+
+def load_trim(folder):
+    """trimming recorded by save_trim
+
+    Returns:
+        dict: {'x', 'y', 'width', 'height', 'source', 'wafer'} or None
+    """
+    path = Path(folder)/TRIM_SIDECAR
+    if not path.exists():
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def load_image(file_name, NX=2368, NY=2240):
+    """image of a file or the first image of a folder (.tif, .npy, (.jpeg, .png)) or ndarray"""
     if type(file_name) == np.ndarray:
         img = file_name
 
@@ -148,9 +269,96 @@ def pos_est_rect(file_name, wh=1100, NX=2368, NY=2240, time_out=120):
             
         else:
             img = cv2.imread(str(file_name))
-        
 
-    img = img.astype('uint8')
+    return img
+
+def to_uint8(img, lower=1, upper=99):
+    """8 bit display image: percentiles lower-upper of the finite values -> 0-255 (nan -> 0)
+
+    Replaces astype('uint8'), which wraps values outside 0-255 (e.g. peak maps in arcsec).
+    """
+    img = np.asarray(img, dtype=np.float32)
+    finite = np.isfinite(img)
+    if not finite.any():
+        return np.zeros(img.shape, dtype=np.uint8)
+    lo, hi = np.percentile(img[finite], (lower, upper))
+    scale = 255 / (hi - lo) if hi > lo else 0
+    out = np.clip((np.where(finite, img, lo) - lo) * scale, 0, 255)
+    return out.astype(np.uint8)
+
+def image_pyramid(img, min_size=256):
+    """normalized (to_uint8) image pyramid, each level half the size of the previous one (cv2.pyrDown)
+
+    Args:
+        img (ndarray): full resolution image (2D, or color image of cv2.imread)
+        min_size (int, optional): the last level is the first one with a side <= min_size. Defaults to 256.
+
+    Returns:
+        list: [(level image uint8, scale)], scale = full resolution pixels per level pixel (1, 2, 4, ...)
+    """
+    level = to_uint8(img)
+    levels = [(level, 1)]
+    while min(level.shape[:2]) > min_size:
+        level = cv2.pyrDown(level)
+        levels.append((level, levels[-1][1] * 2))
+    return levels
+
+def _image_source(path):
+    "the file load_image reads for path: the first .tif (else .npy) of a folder, or path itself"
+    if path.is_dir():
+        for pattern in ('*.tif', '*.npy'):
+            for fp in path.glob(pattern):
+                return fp
+    return path
+
+@lru_cache(maxsize=4)
+def _cached_pyramid(path, source, mtime, NX, NY):
+    "image_pyramid of load_image(path), cached while the file it reads (source) is unchanged"
+    return image_pyramid(load_image(path, NX, NY))
+
+def preview_pyramid(file_name, NX=2368, NY=2240):
+    """image_pyramid of load_image(file_name), cached for files and folders"""
+    if isinstance(file_name, np.ndarray):
+        return image_pyramid(file_name)
+    path = Path(file_name).resolve()
+    source = _image_source(path)
+    return _cached_pyramid(str(path), str(source), source.stat().st_mtime_ns, NX, NY)
+
+def preview_level(levels, max_size=PREVIEW_SIZE):
+    """largest pyramid level with both sides <= max_size (the smallest level if none fits)
+
+    Returns:
+        tuple: level image, scale
+    """
+    for level, scale in levels:
+        if max(level.shape[:2]) <= max_size:
+            return level, scale
+    return levels[-1]
+
+def pos_est_rect(file_name, wh=1100, NX=2368, NY=2240, time_out=120, max_size=PREVIEW_SIZE):
+    """trimming position estimation by using opencv GUI
+
+    The GUI shows a level of the normalized image pyramid (preview_pyramid, cached)
+    with a side <= max_size. Clicked positions are converted to full resolution.
+
+    Args:
+        file_name (str):file name or folder. Allowed file types -> .tif, .npy, (.jpeg, .png)
+        wh (int, optional): triming size. Defaults to 1100.
+                            1 px -> 0.05 mm  2 inch -> 1100
+        NX (int, optional): Original width. Defaults to 2368.
+        NY (int, optional): Original height. Defaults to 2240.
+        time_out (int, optional): time out second. Defaults to 120.
+        max_size (int, optional): largest side of the preview [pixel]. Defaults to PREVIEW_SIZE.
+
+    return:
+        int: cord_x, cord_y, wh, wh (full resolution)
+    """
+    
+    start = time.time()
+    levels = preview_pyramid(file_name, NX, NY)
+    img, scale = preview_level(levels, max_size)
+    img = img.copy()
+    full_shape = levels[0][0].shape
     
     cord_x = 0
     cord_y = 0
@@ -160,29 +368,32 @@ def pos_est_rect(file_name, wh=1100, NX=2368, NY=2240, time_out=120):
         nonlocal cord_x, cord_y
         
         if event == cv2.EVENT_LBUTTONDOWN:
+            # display -> full resolution
+            cord_x = min(x * scale, full_shape[1] - 1)
+            cord_y = min(y * scale, full_shape[0] - 1)
+
             img_tmp = img.copy()
-            cv2.rectangle(img_tmp,(x,y),(x+wh,y+wh),(255,255,255), thickness=10)
-            cv2.putText(img_tmp, text=f'(x,y):({x},{y})',org=(x, y-20), fontFace=cv2.FONT_HERSHEY_SIMPLEX,
-                        fontScale=2.0, color=(255,255,255),thickness=3,lineType=cv2.LINE_4)
+            d_wh = max(int(round(wh / scale)), 1)
+            cv2.rectangle(img_tmp,(x,y),(x+d_wh,y+d_wh),(255,255,255), thickness=2)
+            cv2.putText(img_tmp, text=f'(x,y):({cord_x},{cord_y})',org=(x, max(y-8, 12)), fontFace=cv2.FONT_HERSHEY_SIMPLEX,
+                        fontScale=0.5, color=(255,255,255),thickness=1,lineType=cv2.LINE_4)
 
-            print(f'start x:{x}, y:{y} --wh:{wh}-- end x:{x+wh}, y:{y+wh}')
+            print(f'start x:{cord_x}, y:{cord_y} --wh:{wh}-- end x:{cord_x+wh}, y:{cord_y+wh}')
 
             cv2.imshow('image',img_tmp)
             
-            cord_x = x
-            cord_y = y
-            
         elif event == cv2.EVENT_RBUTTONDOWN:
             cv2.imshow('image',img)
             
-    print(img.shape)
+    print(f'{full_shape} -> preview {img.shape} (1/{scale})')
     print('Quit -> press "ESC" Key')
 
     cv2.namedWindow('image',cv2.WINDOW_NORMAL)
     cv2.setMouseCallback('image',printCoor)
     cv2.moveWindow('image', 100,100)
-    cv2.putText(img, text=f'Quit -> press "ESC" Key',org=(20,60), fontFace=cv2.FONT_HERSHEY_SIMPLEX,
-                        fontScale=2.0, color=(255,255,255),thickness=3,lineType=cv2.LINE_4)
+    cv2.resizeWindow('image', img.shape[1], img.shape[0])
+    cv2.putText(img, text=f'Quit -> press "ESC" Key',org=(10,20), fontFace=cv2.FONT_HERSHEY_SIMPLEX,
+                        fontScale=0.5, color=(255,255,255),thickness=1,lineType=cv2.LINE_4)
     cv2.imshow('image',img)
     
     while True:
@@ -249,7 +460,8 @@ def folder2trim2tif(filename_or_path, x, y, width, height):
         pathlib : new holder name path
     """
     npy_lists = fft.folder_file_list(filename_or_path)
-    new_folder = npy_lists[0].resolve().parents[1]/f'tr_{npy_lists[0].stem[:-2]}'
+    # the folder name is the file stem without its map suffix (_c, _h, _w, _chi2 ...)
+    new_folder = npy_lists[0].resolve().parents[1]/f'tr_{npy_lists[0].stem.rsplit("_", 1)[0]}'
     new_folder.mkdir(exist_ok=True)
 
     for fn in npy_lists:
@@ -262,6 +474,38 @@ def folder2trim2tif(filename_or_path, x, y, width, height):
 
     return new_folder
 
+def virtual_trim(filename_or_path, x, y, width, height):
+    """virtual trimming: folder2trim2tif without new files
+
+    The crop is written to crop.json in the folder of the maps (virtual_crop.save_crop),
+    re_analysis loaders, fit.py --crop and the rotation of the image editor read only the cropped part.
+    An existing crop is replaced (the position is in the coordinates of the full maps).
+
+    Args:
+        filename_or_path (str): filename_or_path
+        x (int): trim cordinate x (left top)
+        y (int): trim cordinate y (left top)
+        width (int): trim width
+        height (int): trim height
+
+    Returns:
+        pathlib : folder of the maps
+    """
+    tif_lists = fft.folder_file_list(filename_or_path)
+    folder = tif_lists[0].resolve().parent
+    with tiff.TiffFile(str(tif_lists[0])) as tf:
+        shape = tf.pages[0].shape
+    vc.save_crop(folder, x, y, width, height, shape=shape)
+    print(f'Virtual trim h(Y), w(X) :  {(height, width)} -> {folder/vc.CROP_SIDECAR}')
+
+    return folder
+
+def _trim_folder(file_name, trim_position, virtual):
+    "folder2trim2tif or virtual_trim"
+    if virtual:
+        return virtual_trim(file_name, *trim_position)
+    return folder2trim2tif(file_name, *trim_position)
+
 # --- Not use ---
 def tif2torim(tifname,x, y, width, height):
     """
@@ -0,0 +1,206 @@
+"""
+Single-pass statistics of maps (nan values are skipped)
+
+- MapStats: accumulator of count, mean, var, min, max, quantiles (from a sample)
+  and pairwise correlations of several maps
+- describe: MapStats of several maps, chunked and multithreaded
+- print_table: summary table of a MapStats
+
+Examples:
+    >>> from qfit import map_stats as ms
+    >>> st = ms.describe({'c0': rc0['c'], 'c120': rc120['c'], 'w0': rc0['w']}, corr=True)
+    >>> ms.print_table(st)
+    >>> st.result()['c0']['mean'], st.corr()
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+import numpy as np
+
+
+class MapStats:
+    """statistics of several maps accumulated chunk by chunk
+
+    Mean and variance are merged with the pairwise formulas of Chan et al.,
+    so partial results of chunks (and threads) can be combined with merge().
+    Quantiles are calculated from a systematic sample of the finite values
+    (every step-th value, all values if step is 1).
+
+    Args:
+        names (list[str]): map names
+        quantiles (tuple, optional): quantiles. Defaults to (0.25, 0.5, 0.75).
+        corr (bool, optional): accumulate pairwise correlations. Defaults to False.
+        step (int, optional): sampling step for the quantiles. Defaults to 1.
+    """
+
+    def __init__(self, names, quantiles=(0.25, 0.5, 0.75), corr=False, step=1):
+        self.names = list(names)
+        self.quantiles = tuple(quantiles)
+        self.step = max(int(step), 1)
+        m = len(self.names)
+        self.n = np.zeros(m)
+        self.mean = np.zeros(m)
+        self.m2 = np.zeros(m)
+        self.min = np.full(m, np.inf)
+        self.max = np.full(m, -np.inf)
+        self.samples = [[] for _ in range(m)]
+        # pairs (i, j), i < j: [n, mean_i, mean_j, m2_i, m2_j, comoment]
+        self.pairs = {(i, j): np.zeros(6) for i in range(m) for j in range(i + 1, m)} if corr else None
+
+    def update(self, chunks):
+        """add one chunk of each map (1D arrays of the same length)"""
+        chunks = [np.asarray(v, dtype=np.float64) for v in chunks]
+        finite = [np.isfinite(v) for v in chunks]
+        for i, (v, f) in enumerate(zip(chunks, finite)):
+            vv = v[f]
+            if vv.size == 0:
+                continue
+            mean = vv.mean()
+            self._merge_moments(i, vv.size, mean, np.sum((vv - mean)**2))
+            self.min[i] = min(self.min[i], vv.min())
+            self.max[i] = max(self.max[i], vv.max())
+            if self.quantiles:
+                self.samples[i].append(vv[::self.step])
+
+        if self.pairs is not None:
+            for (i, j), acc in self.pairs.items():
+                f = finite[i] & finite[j]
+                n = np.count_nonzero(f)
+                if n == 0:
+                    continue
+                a = chunks[i][f]
+                b = chunks[j][f]
+                ma, mb = a.mean(), b.mean()
+                da, db = a - ma, b - mb
+                _merge_pair(acc, np.array([n, ma, mb, np.sum(da*da), np.sum(db*db), np.sum(da*db)]))
+        return self
+
+    def _merge_moments(self, i, n, mean, m2):
+        n0 = self.n[i]
+        tot = n0 + n
+        delta = mean - self.mean[i]
+        self.mean[i] += delta * n / tot
+        self.m2[i] += m2 + delta**2 * n0 * n / tot
+        self.n[i] = tot
+
+    def merge(self, other):
+        """add the statistics of another MapStats of the same maps"""
+        for i in range(len(self.names)):
+            if other.n[i]:
+                self._merge_moments(i, other.n[i], other.mean[i], other.m2[i])
+            self.min[i] = min(self.min[i], other.min[i])
+            self.max[i] = max(self.max[i], other.max[i])
+            self.samples[i].extend(other.samples[i])
+        if self.pairs is not None:
+            for key, acc in self.pairs.items():
+                _merge_pair(acc, other.pairs[key])
+        return self
+
+    def result(self, ddof=0):
+        """statistics of each map
+
+        Returns:
+            dict: {name: {'count', 'mean', 'std', 'var', 'min', 'max', 'q25', 'q50', ...}}
+            nan for maps without finite values
+        """
+        ret = {}
+        for i, name in enumerate(self.names):
+            n = self.n[i]
+            valid = n > 0
+            var = self.m2[i] / (n - ddof) if n > ddof else np.nan
+            row = {'count': int(n),
+                   'mean': float(self.mean[i]) if valid else np.nan,
+                   'std': float(np.sqrt(var)),
+                   'var': float(var),
+                   'min': float(self.min[i]) if valid else np.nan,
+                   'max': float(self.max[i]) if valid else np.nan}
+            if self.quantiles:
+                sample = np.concatenate(self.samples[i]) if self.samples[i] else np.empty(0)
+                qs = np.quantile(sample, self.quantiles) if sample.size else [np.nan] * len(self.quantiles)
+                for q, v in zip(self.quantiles, qs):
+                    row[f'q{100*q:g}'] = float(v)
+            ret[name] = row
+        return ret
+
+    def corr(self):
+        """pearson correlation matrix (pixels where both maps are finite)
+
+        Returns:
+            ndarray: (maps, maps), nan if correlations were not accumulated
+        """
+        m = len(self.names)
+        ret = np.eye(m)
+        if self.pairs is None:
+            return np.full((m, m), np.nan)
+        for (i, j), (n, ma, mb, m2a, m2b, c) in self.pairs.items():
+            with np.errstate(divide='ignore', invalid='ignore'):
+                r = c / np.sqrt(m2a * m2b) if n > 1 else np.nan
+            ret[i, j] = ret[j, i] = r
+        return ret
+
+
+def _merge_pair(acc, other):
+    "merge [n, mean_a, mean_b, m2_a, m2_b, comoment] of other into acc"
+    n0, n = acc[0], other[0]
+    if n == 0:
+        return
+    tot = n0 + n
+    da = other[1] - acc[1]
+    db = other[2] - acc[2]
+    acc[1] += da * n / tot
+    acc[2] += db * n / tot
+    acc[3] += other[3] + da * da * n0 * n / tot
+    acc[4] += other[4] + db * db * n0 * n / tot
+    acc[5] += other[5] + da * db * n0 * n / tot
+    acc[0] = tot
+
+
+def describe(maps, quantiles=(0.25, 0.5, 0.75), corr=False, sample=1 << 16, chunk=1 << 20, workers=None):
+    """statistics of several maps in one chunked, multithreaded pass
+
+    Args:
+        maps (dict or list): {name: array} or list of arrays (names '0', '1', ...), same size
+        quantiles (tuple, optional): quantiles. Defaults to (0.25, 0.5, 0.75).
+        corr (bool, optional): pairwise correlations (MapStats.corr). Defaults to False.
+        sample (int, optional): about this many values per map are kept for the quantiles,
+            None keeps all values (exact quantiles). Defaults to 1 << 16.
+        chunk (int, optional): pixels per chunk. Defaults to 1 << 20.
+        workers (int, optional): number of threads. Defaults to os.cpu_count().
+
+    Returns:
+        MapStats: .result() -> {name: {'count', 'mean', 'std', 'var', 'min', 'max', 'q25', 'q50', 'q75'}},
+                  .corr() -> correlation matrix
+    """
+    if not isinstance(maps, dict):
+        maps = {str(i): m for i, m in enumerate(maps)}
+    names = list(maps)
+    arrays = [np.asarray(m).reshape(-1) for m in maps.values()]
+    size = arrays[0].size if arrays else 0
+    step = 1 if sample is None else max(size // sample, 1)
+
+    def run(start):
+        sl = slice(start, start + chunk)
+        return MapStats(names, quantiles, corr, step).update([a[sl] for a in arrays])
+
+    starts = range(0, size, chunk)
+    total = MapStats(names, quantiles, corr, step)
+    if len(starts) <= 1:
+        for start in starts:
+            total.merge(run(start))
+        return total
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        # merged in chunk order, the result does not depend on the number of threads
+        for part in pool.map(run, starts):
+            total.merge(part)
+    return total
+
+
+def print_table(stats, keys=('count', 'mean', 'std', 'min', 'max', 'q50'), fmt='.4g'):
+    """print MapStats.result() as a table (one row per map)"""
+    rows = stats.result()
+    width = max([len(name) for name in rows] + [4])
+    print(f"{'name':>{width}s} " + ' '.join(f'{k:>10s}' for k in keys))
+    for name, row in rows.items():
+        print(f'{name:>{width}s} ' + ' '.join(f'{row.get(k, np.nan):>10{fmt}}' for k in keys))
@@ -24,6 +24,187 @@ def R(x,y,z,a):
     return rot
 
 
+def _rodrigues(kx, ky, kz, a, ux, uy, uz):
+    "rotate vectors u by angles a around the unit axis k (Rodrigues), same as R(k,a) @ u"
+    SA = np.sin(a)
+    CA = np.cos(a)
+    KU = (kx * ux + ky * uy + kz * uz) * (1 - CA)
+    wx = ux * CA + (ky * uz - kz * uy) * SA + kx * KU
+    wy = uy * CA + (kz * ux - kx * uz) * SA + ky * KU
+    wz = uz * CA + (kx * uy - ky * ux) * SA + kz * KU
+    return wx, wy, wz
+
+
+def q_vector(tdel, cdel, axis_t, axis_c, q=1.0, chunk=1 << 20):
+    """(R(axis_c,cdel) @ R(axis_t,tdel)) @ (0,0,q) without the (N,3,3) rotation stacks
+
+    Only the third column of R(axis_t,tdel) is needed, both rotations are evaluated
+    in closed form on chunks of 'chunk' pixels. Returns qx, qy, qz (float32, shape of tdel).
+    """
+    tdel = np.asarray(tdel, dtype=np.float32)
+    cdel = np.asarray(cdel, dtype=np.float32)
+    tx, ty, tz = (np.float32(v) for v in axis_t)
+    cx, cy, cz = (np.float32(v) for v in axis_c)
+    q = np.float32(q)
+
+    t = tdel.reshape(-1)
+    c = cdel.reshape(-1)
+    qx = np.empty(t.shape, dtype=np.float32)
+    qy = np.empty(t.shape, dtype=np.float32)
+    qz = np.empty(t.shape, dtype=np.float32)
+    for i in range(0, len(t), chunk):
+        sl = slice(i, i + chunk)
+        # R(axis_t,t) @ (0,0,q)
+        ux, uy, uz = _rodrigues(tx, ty, tz, t[sl], 0, 0, q)
+        qx[sl], qy[sl], qz[sl] = _rodrigues(cx, cy, cz, c[sl], ux, uy, uz)
+    return qx.reshape(tdel.shape), qy.reshape(tdel.shape), qz.reshape(tdel.shape)
+
+
+def compute_q(theta_map, chi_map, angle_t=0, angle_c=120, q=1.0, normalize=True):
+    """q maps from the peak maps of two directions (in memory, same result as the q2.py command)
+
+    Args:
+        theta_map (ndarray): peak map of the angle_t direction [arcsec] (array or np.memmap)
+        chi_map (ndarray): peak map of the angle_c direction [arcsec] (same shape)
+        angle_t (float, optional): psi of theta_map [deg]. Defaults to 0.
+        angle_c (float, optional): psi of chi_map [deg]. Defaults to 120.
+        q (float, optional): length of q. Defaults to 1.0.
+        normalize (bool, optional): subtract the mean of each map. Defaults to True.
+
+    Returns:
+        dict: {'x':qx, 'y':qy, 'z':qz} float32, shape of theta_map
+
+    Examples:
+        >>> ret = compute_q(rc0['c'], rc120['c'], 0, 120, q=6.258)
+    """
+    arcsec2rad = np.float32(np.pi / 180 / 3600)
+    tdata = np.asarray(theta_map, dtype=np.float32)
+    cdata = np.asarray(chi_map, dtype=np.float32)
+    if normalize:
+        tdata = tdata - np.nanmean(tdata)
+        cdata = cdata - np.nanmean(cdata)
+    axis_t = (np.sin(np.deg2rad(angle_t)), np.cos(np.deg2rad(angle_t)), 0)
+    axis_c = (np.sin(np.deg2rad(angle_c)), np.cos(np.deg2rad(angle_c)), 0)
+    qx, qy, qz = q_vector(tdata * arcsec2rad, cdata * arcsec2rad, axis_t, axis_c, q)
+    return {"x": qx, "y": qy, "z": qz}
+
+
+def solve_q(deltas, angles, q=1.0, normalize=True, chunk=1 << 20):
+    """q vector from the peak shifts of two or more psi directions (per-pixel least squares)
+
+    A rotation around the axis (sin(psi), cos(psi), 0) (see Data.calc) tilts (0,0,1)
+    towards d = (cos(psi), -sin(psi)). Each direction measures delta_i = d_i . t,
+    the tilt t = (tx, ty) [rad] is the least squares solution over the directions
+    that are not nan. q = q * (tan(tx), tan(ty), 1) / norm.
+    For 2 orthogonal directions this equals Data.calc, for 0/120/-120 it equals
+    the average of the three pairwise q (re_analysis.average_3q) to first order.
+
+    Args:
+        deltas (list[ndarray]): peak maps of each direction [arcsec] (same shape)
+        angles (list[float]): psi of each direction [deg]
+        q (float, optional): length of q. Defaults to 1.0.
+        normalize (bool, optional): subtract the mean of each map. Defaults to True.
+        chunk (int, optional): pixels per chunk. Defaults to 1 << 20.
+
+    Returns:
+        dict: {'x':qx, 'y':qy, 'z':qz, 'res':rms of delta_i - d_i . t [arcsec], 'n':number of directions used}
+        nan where less than two independent directions are available
+    """
+    shape = np.shape(deltas[0])
+    arcsec2rad = np.float32(np.pi / 180 / 3600)
+    ds = []
+    for data in deltas:
+        data = np.asarray(data, dtype=np.float32).reshape(-1)
+        if normalize:
+            data = data - np.nanmean(data)
+        ds.append(data)
+    dirs = [(np.float32(np.cos(np.deg2rad(a))), np.float32(-np.sin(np.deg2rad(a)))) for a in angles]
+
+    n_pix = ds[0].size
+    out = {k: np.empty(n_pix, dtype=np.float32) for k in ("x", "y", "z", "res", "n")}
+    for i in range(0, n_pix, chunk):
+        sl = slice(i, i + chunk)
+        # normal equations (a11 a12; a12 a22) t = (b1, b2)
+        a11 = a12 = a22 = b1 = b2 = n = 0
+        for data, (dx, dy) in zip(ds, dirs):
+            d = data[sl] * arcsec2rad
+            w = np.isfinite(d)
+            d = np.where(w, d, 0)
+            a11 = a11 + w * (dx * dx)
+            a12 = a12 + w * (dx * dy)
+            a22 = a22 + w * (dy * dy)
+            b1 = b1 + d * dx
+            b2 = b2 + d * dy
+            n = n + w
+        det = a11 * a22 - a12 * a12
+        with np.errstate(divide="ignore", invalid="ignore"):
+            det = np.where(det > 1e-6, det, np.nan)
+            tx = (a22 * b1 - a12 * b2) / det
+            ty = (a11 * b2 - a12 * b1) / det
+        ssr = 0
+        for data, (dx, dy) in zip(ds, dirs):
+            r = data[sl] * arcsec2rad - (dx * tx + dy * ty)
+            ssr = ssr + np.where(np.isfinite(r), r * r, 0)
+        gx = np.tan(tx)
+        gy = np.tan(ty)
+        norm = q / np.sqrt(gx * gx + gy * gy + 1)
+        out["x"][sl] = gx * norm
+        out["y"][sl] = gy * norm
+        out["z"][sl] = norm
+        out["res"][sl] = np.sqrt(ssr / np.maximum(n, 1)) / arcsec2rad
+        out["n"][sl] = n
+    out["res"][~np.isfinite(out["x"])] = np.nan
+    return {k: v.reshape(shape) for k, v in out.items()}
+
+
+def summary_figure(qx, qy, qz, title, path):
+    "save heat maps, histogram and vector fields (quivers) of q to path (png) and return the figure"
+    import matplotlib.pyplot as plt
+    from mpl_toolkits.axes_grid1 import make_axes_locatable
+    plt.rcParams["font.size"] = 6
+
+    fig, ((ax1, ax2, ax3), (ax4, ax5, ax6)) = plt.subplots(2, 3)
+    fig.suptitle(title.upper())
+    axs = [ax1,ax2,ax3,ax4,ax5,ax6]
+    for c,col in zip("xyzavw",axs):
+        cmap = "gist_rainbow_r"
+        if c in "xyz":
+            data = {"x": qx, "y": qy, "z": qz}[c]
+        else:
+            xdata, ydata, zdata = qx, qy, qz
+
+            data = np.hypot(xdata, ydata)
+            xyzdata = np.rad2deg(np.arctan(data/np.abs(zdata)))
+            # xyzdata = np.where(np.isnan(xyzdata), np.abs(np.random.normal(0.035, 0.015, size=xyzdata.shape)), xyzdata)
+        if c in "axy":
+            # im = col.imshow(data, cmap=cmap, vmin=-0.2, vmax=0.2)
+            im = col.imshow(data, cmap=cmap)
+        elif c == "z":
+            # im = col.imshow(data, cmap=cmap, vmin=0.99999, vmax=1.000)
+            im = col.imshow(data, cmap=cmap)
+        elif c == "v":
+            xdata = xdata[::50,::50]
+            ydata = ydata[::50,::50]
+            col.invert_yaxis()
+            col.quiver(xdata,-ydata)
+            col.set_aspect('equal')
+        else:
+            # im = col.imshow(xyzdata, cmap=cmap)
+            xyzdata = xyzdata.reshape(-1)
+            xyzdata = xyzdata[~np.isnan(xyzdata)]
+            col.hist(xyzdata, bins=100, density=True)
+            col.set_xlim(0, 0.15)
+            # col.hist(xyzdata.reshape(-1), bins=25, density=True)
+        divider = make_axes_locatable(col)
+        if c in "axyz":
+            cax = divider.append_axes('right', size='5%', pad=0.06, title=("Q"+c.upper() if c != "w" else "|QX+QY|/|QZ|"))
+            fig.colorbar(im, cax=cax, orientation='vertical')
+
+    fig.tight_layout()
+    fig.savefig(path, dpi=300)
+    return fig
+
+
 class Data:
     # image.shape: h,w = 2240(NY) x 2368(NX)
     NX = 2368
@@ -75,7 +256,16 @@ class Data:
         print(self.qx[X],self.qy[X],self.qz[X])
 
     def calc(self):
-        "matrix calculations, which can be easily generalized to other angles"
+        "closed form of calc_matrix (compute_q), rotation axes from ANGLE_t and ANGLE_c"
+        "left-handed coordinate system"
+        print(f'set Angle t:{self.ANGLE_t}, c:{self.ANGLE_c}')
+        ret = compute_q(self.tdata, self.cdata, self.ANGLE_t, self.ANGLE_c, self.q)
+        self.qx = ret["x"].reshape(self.NX,self.NY)
+        self.qy = ret["y"].reshape(self.NX,self.NY)
+        self.qz = ret["z"].reshape(self.NX,self.NY)
+
+    def calc_matrix(self):
+        "matrix calculations, which can be easily generalized to other angles (reference of calc, (N,3,3) stacks)"
         "left-handed coordinate system"
         # if Data.ANGLE == 120:
         #     rot_t = R(0,1,0,self.tdel)
@@ -127,56 +317,10 @@ class Data:
     def show(self, path, prefix):
         "display heat maps, histogram and vector fields (quivers)"
         import matplotlib.pyplot as plt
-        from mpl_toolkits.axes_grid1 import make_axes_locatable
-        plt.rcParams["font.size"] = 6
 
         dtype = np.float32
-
-        fig, ((ax1, ax2, ax3), (ax4, ax5, ax6)) = plt.subplots(2, 3)
-        fig.suptitle(prefix.upper())
-        axs = [ax1,ax2,ax3,ax4,ax5,ax6]
-        for c,col in zip("xyzavw",axs):
-            cmap = "gist_rainbow_r"
-            if c in "xyz":
-                p = path[:-5] + c + ".npy"
-                data = np.fromfile(p, dtype=dtype).reshape(Data.NX,Data.NY)
-            else:
-                p = path[:-5] + "x.npy"
-                xdata = np.fromfile(p, dtype=dtype).reshape(Data.NX,Data.NY)
-                p = path[:-5] + "y.npy"
-                ydata = np.fromfile(p, dtype=dtype).reshape(Data.NX,Data.NY)
-                p = path[:-5] + "z.npy"
-                zdata = np.fromfile(p, dtype=dtype).reshape(Data.NX,Data.NY)
-
-                data = np.hypot(xdata, ydata)
-                xyzdata = np.rad2deg(np.arctan(data/np.abs(zdata)))
-                # xyzdata = np.where(np.isnan(xyzdata), np.abs(np.random.normal(0.035, 0.015, size=xyzdata.shape)), xyzdata)
-            if c in "axy":
-                # im = col.imshow(data, cmap=cmap, vmin=-0.2, vmax=0.2)
-                im = col.imshow(data, cmap=cmap)
-            elif c == "z":
-                # im = col.imshow(data, cmap=cmap, vmin=0.99999, vmax=1.000)
-                im = col.imshow(data, cmap=cmap)
-            elif c == "v":
-                xdata = xdata[::50,::50]
-                ydata = ydata[::50,::50]
-                col.invert_yaxis()
-                col.quiver(xdata,-ydata)
-                col.set_aspect('equal')
-            else:
-                # im = col.imshow(xyzdata, cmap=cmap)
-                xyzdata = xyzdata.reshape(-1)
-                xyzdata = xyzdata[~np.isnan(xyzdata)]
-                col.hist(xyzdata, bins=100, density=True)
-                col.set_xlim(0, 0.15)
-                # col.hist(xyzdata.reshape(-1), bins=25, density=True)
-            divider = make_axes_locatable(col)
-            if c in "axyz":
-                cax = divider.append_axes('right', size='5%', pad=0.06, title=("Q"+c.upper() if c != "w" else "|QX+QY|/|QZ|"))
-                fig.colorbar(im, cax=cax, orientation='vertical')
-                
-        plt.tight_layout()
-        plt.savefig(f"{prefix}_f.png",dpi=300)
+        q = {c: np.fromfile(path[:-5] + c + ".npy", dtype=dtype).reshape(Data.NX,Data.NY) for c in "xyz"}
+        summary_figure(q["x"], q["y"], q["z"], prefix, f"{prefix}_f.png")
         print(f"{prefix}_f.png")
         plt.show()
 
@@ -206,6 +350,9 @@ def main():
     
     parser.add_argument("--dtheta", "-t", help="data file with delta theta data [arcsec]")
     parser.add_argument("--dchi", "-c", help="data file with delta chi data [arcsec]")
+    parser.add_argument("--data", help="data file [arcsec] and psi angle[deg] of one direction "
+                        "(repeat for 2 or more directions, least squares; replaces -t -c)",
+                        nargs=2, action="append", metavar=("FILE", "ANGLE"))
     parser.add_argument("-q", help="set q unit:Angstrom^-1", default="1.0", type=float)
 	# q-vector of GaN (112¯4) for which the length equals 6.258 Å−1 (= 2π/d112¯4)
 
@@ -245,6 +392,17 @@ def main():
 
     # print(Data.NX,Data.NY,Data.ANGLE_t,Data.ANGLE_c)
 
+    if args.data:
+        deltas = [np.fromfile(f, dtype=np.float32) for f, _ in args.data]
+        angles = [float(a) for _, a in args.data]
+        logging.debug(f"solving q for psi {angles}")
+        ret = solve_q(deltas, angles, q=args.q)
+        for k in ("x", "y", "z", "res"):
+            logging.debug(f"writing data to {args.prefix}_{k}.npy")
+            ret[k].tofile(f"{args.prefix}_{k}.npy")
+        print(f"{args.prefix}_x.npy")
+        return
+
     D = Data(args.dtheta,args.dchi,show=args.show, prefix=args.prefix, q=args.q, old=args.old)
     
 
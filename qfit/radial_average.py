@@ -12,6 +12,7 @@ import cv2
 import numpy as np
 # import pandas as pd
 from PIL import Image
+from scipy import ndimage
 
 from qfit import re_analysis as rean
 from qfit import multiplot as mlplt
@@ -73,13 +74,16 @@ def read_tif2uint8(file_name):
 
     return img_b_u8, img_array
 
-def find_circle(b_image, area_size=50000):
+def find_circle(b_image, area_size=50000, show=True):
     """find wafer center and radius
 
+    See wafer.detect_wafer for a headless sub-pixel detection (cached with wafer.wafer_geometry).
+
     Args:
         b_image (ndarray): binary ndarray dtype uint8
         area_size (int, optional): select circle filter . Defaults to 50000.
             If it is smaller than this value, it will not be detected.
+        show (bool, optional): show the image with the circles. Defaults to True.
 
     Returns:
         (list) : center_lists, radius_lists, area_lists
@@ -116,7 +120,8 @@ def find_circle(b_image, area_size=50000):
         area_lists.append(c_area) 
 
     # Displays an image with enclosed lines.
-    plt.imshow(imgc,cmap =CMAP)
+    if show:
+        plt.imshow(imgc,cmap =CMAP)
 
     return center_lists, radius_lists, area_lists
 
@@ -154,6 +159,304 @@ def _make_circle_mask(org_image, center, radius):
     return dst, mask_float
 
 
+class WaferGrid:
+    """polar coordinates of the pixels around a wafer center, shared by the radial and sector analyses
+
+    Use WaferGrid.get(shape, center, pixel_size) to reuse the grid of the same shape and center
+    (e.g. the 3 psi directions), WaferGrid.clear() to release the cached grids.
+    Maps are calculated on first use and kept, the ring and sector index maps
+    only for the last MAX_INDEX parameter sets.
+    Azimuth is arctan2(row - cy, col - cx) [deg] (image coordinates, -180 to 180).
+
+    Args:
+        shape (tuple): image shape (rows, cols)
+        center (tuple): center (x, y) = (col, row), same as cv2.circle
+        pixel_size (float, optional): pixel size [mm]. Defaults to PIX_SIZE.
+
+    Examples:
+        grid = WaferGrid.get(rc0['wt'].shape, center, pixel_size=0.05)
+        st = grid.sector_ring_stats([rc0['wt'], rc120['wt']], dr=50, nsec=8, max_radius=1000)
+        polar = grid.resample(rc0['ct'], nr=200, ntheta=360, max_radius=1000)
+    """
+    MAX_CACHE = 8
+    MAX_INDEX = 4
+    _cache = {}
+
+    def __init__(self, shape, center, pixel_size=PIX_SIZE):
+        self.shape = tuple(shape)
+        self.center = (float(center[0]), float(center[1]))
+        self.pixel_size = pixel_size
+        self._maps = {}
+
+    @classmethod
+    def get(cls, shape, center, pixel_size=PIX_SIZE):
+        "cached grid for shape, center and pixel_size"
+        key = (tuple(shape), float(center[0]), float(center[1]), pixel_size)
+        grid = cls._cache.get(key)
+        if grid is None:
+            if len(cls._cache) >= cls.MAX_CACHE:
+                cls._cache.pop(next(iter(cls._cache)))
+            grid = cls._cache[key] = cls(shape, center, pixel_size)
+        return grid
+
+    @classmethod
+    def from_geometry(cls, geom, pixel_size=PIX_SIZE):
+        "cached grid of a wafer.detect_wafer geometry"
+        return cls.get(geom['shape'], geom['center'], pixel_size)
+
+    @classmethod
+    def clear(cls):
+        "drop the cached grids"
+        cls._cache.clear()
+
+    def _get(self, key, func):
+        if key not in self._maps:
+            self._maps[key] = func()
+        elif isinstance(key, tuple):
+            # most recently used last
+            self._maps[key] = self._maps.pop(key)
+        if isinstance(key, tuple):
+            indices = [k for k in self._maps if isinstance(k, tuple)]
+            for k in indices[:-self.MAX_INDEX]:
+                del self._maps[k]
+        return self._maps[key]
+
+    @property
+    def dx(self):
+        "col - cx [pixel], (1, cols)"
+        return self._get('dx', lambda: (np.arange(self.shape[1], dtype=np.float32)
+                                        - np.float32(self.center[0]))[None, :])
+
+    @property
+    def dy(self):
+        "row - cy [pixel], (rows, 1)"
+        return self._get('dy', lambda: (np.arange(self.shape[0], dtype=np.float32)
+                                        - np.float32(self.center[1]))[:, None])
+
+    @property
+    def radius(self):
+        "distance from center [pixel]"
+        return self._get('radius', lambda: np.hypot(self.dx, self.dy))
+
+    @property
+    def radius_mm(self):
+        "distance from center [mm]"
+        return self._get('radius_mm', lambda: self.radius * np.float32(self.pixel_size))
+
+    @property
+    def azimuth(self):
+        "azimuth [deg]"
+        return self._get('azimuth', lambda: np.rad2deg(np.arctan2(self.dy, self.dx)))
+
+    def ring_index(self, dr, max_radius=None):
+        """ring index map: k for pixels with (k-1)*dr < radius <= k*dr (center pixel in ring 1), 0 outside max_radius"""
+        def calc():
+            index = np.maximum(np.ceil(self.radius / np.float32(dr)), 1).astype(np.int32)
+            if max_radius is not None:
+                index[self.radius > max_radius] = 0
+            return index
+        return self._get(('ring', dr, max_radius), calc)
+
+    def sector_index(self, nsec, offset=0):
+        """sector index map: 0..nsec-1, sector s covers azimuth offset + [s, s+1) * 360/nsec [deg]"""
+        def calc():
+            ang = np.mod(self.azimuth - offset, 360)
+            return np.minimum((ang * (nsec / 360)).astype(np.int32), nsec - 1)
+        return self._get(('sector', nsec, offset), calc)
+
+    def sector_ring_stats(self, images, dr, nsec=8, max_radius=None, offset=0, valid=None):
+        """sector x ring statistics of one or several maps (np.bincount, nan skipped)
+
+        Args:
+            images (ndarray or list): map (rows, cols) or maps (n, rows, cols)
+            dr (float): ring width [pixel]
+            nsec (int, optional): number of sectors. Defaults to 8.
+            max_radius (float, optional): maximum radius [pixel]. Defaults to the image corner.
+            offset (float, optional): start azimuth of sector 0 [deg]. Defaults to 0.
+            valid (2d-ndarray, optional): bool mask of the pixels used. Defaults to all finite pixels.
+
+        Returns:
+            dict: {'r': outer radius of the rings [pixel], 'r_mm': [mm], 'theta': sector center [deg],
+                   'mean', 'std', 'sum', 'count': (n, nsec, nring) or (nsec, nring) for one map}
+        """
+        stack = np.asarray(images)
+        single = stack.ndim == 2
+        if single:
+            stack = stack[None]
+        ring = self.ring_index(dr, max_radius)
+        nring = int(ring.max())
+        if max_radius is not None:
+            nring = max(nring, int(np.ceil(max_radius / dr)))
+        cell = self.sector_index(nsec, offset) * (nring + 1) + ring
+        inside = ring > 0
+        if valid is not None:
+            inside = inside & valid
+        nbins = nsec * (nring + 1)
+
+        out = {k: np.empty((len(stack), nsec, nring)) for k in ('mean', 'std', 'sum', 'count')}
+        for i, image in enumerate(stack):
+            use = inside & np.isfinite(image)
+            idx = cell[use]
+            values = image[use].astype(np.float64)
+            shift = values.mean() if values.size else 0.0
+            cnt = np.bincount(idx, minlength=nbins).reshape(nsec, nring + 1)[:, 1:]
+            s = np.bincount(idx, weights=values, minlength=nbins).reshape(nsec, nring + 1)[:, 1:]
+            s2 = np.bincount(idx, weights=(values - shift)**2, minlength=nbins).reshape(nsec, nring + 1)[:, 1:]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean = s / cnt
+                var = s2 / cnt - (mean - shift)**2
+            out['mean'][i] = mean
+            out['std'][i] = np.sqrt(np.maximum(var, 0))
+            out['sum'][i] = s
+            out['count'][i] = cnt
+        if single:
+            out = {k: v[0] for k, v in out.items()}
+        out['count'] = out['count'].astype(np.int64)
+        r = np.arange(1, nring + 1) * dr
+        out.update({'r': r, 'r_mm': r * self.pixel_size,
+                    'theta': offset + (np.arange(nsec) + 0.5) * 360 / nsec})
+        return out
+
+    def resample(self, image, nr=200, ntheta=360, max_radius=None, order=1):
+        """map on an (theta, r) grid (scipy.ndimage.map_coordinates, nan outside the image)
+
+        Args:
+            image (2d-ndarray): map
+            nr (int, optional): number of radii. Defaults to 200.
+            ntheta (int, optional): number of azimuths. Defaults to 360.
+            max_radius (float, optional): maximum radius [pixel]. Defaults to the largest radius in the image.
+            order (int, optional): spline order. Defaults to 1 (bilinear).
+
+        Returns:
+            dict: {'img': (ntheta, nr), 'r': radius [pixel], 'r_mm': [mm], 'theta': azimuth [deg]}
+        """
+        if max_radius is None:
+            max_radius = float(self.radius.max())
+        r = np.linspace(0, max_radius, nr)
+        theta = np.linspace(-180, 180, ntheta, endpoint=False)
+        t = np.deg2rad(theta)[:, None]
+        rows = self.center[1] + r[None, :] * np.sin(t)
+        cols = self.center[0] + r[None, :] * np.cos(t)
+        img = ndimage.map_coordinates(np.asarray(image, dtype=np.float64), [rows, cols], order=order,
+                                      mode='constant', cval=np.nan)
+        return {'img': img, 'r': r, 'r_mm': r * self.pixel_size, 'theta': theta}
+
+
+def radius_index(shape, center, dr, max_radius=None):
+    """ring index map: k for pixels with (k-1)*dr < distance <= k*dr (the center pixel is in ring 1)
+
+    Args:
+        shape (tuple): image shape (rows, cols)
+        center (tuple): center (x, y) = (col, row), same as cv2.circle
+        dr (float): ring width [pixel]
+        max_radius (float, optional): pixels outside max_radius get index 0. Defaults to no limit.
+
+    Returns:
+        ndarray: int32 ring index (0: outside), cached in WaferGrid
+    """
+    return WaferGrid.get(shape, center).ring_index(dr, max_radius)
+
+
+def _ring_medians(values, index, nbins):
+    "median of each ring (sort by ring index and value)"
+    order = np.lexsort((values, index))
+    vs = values[order]
+    counts = np.bincount(index, minlength=nbins)
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    med = np.full(nbins, np.nan)
+    ok = counts > 0
+    lo = starts[ok] + (counts[ok] - 1)//2
+    hi = starts[ok] + counts[ok]//2
+    med[ok] = (vs[lo] + vs[hi])/2
+    return med
+
+
+def _disk_medians(values, index, nbins, blocks=1024):
+    "median of each disk (index <= k): value-sorted pixels, counts per (index, value block)"
+    n = len(values)
+    med = np.full(nbins, np.nan)
+    if n == 0:
+        return med
+    order = np.argsort(values, kind='stable')
+    vs = values[order]
+    ids = index[order]
+    nb = min(blocks, n)
+    block = (np.arange(n, dtype=np.int64) * nb) // n
+    bstart = np.searchsorted(block, np.arange(nb))
+    bend = np.append(bstart[1:], n)
+    # table[k, b]: number of pixels with index <= k in the value blocks <= b
+    table = np.bincount(ids.astype(np.int64)*nb + block, minlength=nbins*nb).reshape(nbins, nb)
+    table = np.cumsum(np.cumsum(table, axis=0), axis=1)
+
+    def rank_value(k, t):
+        b = int(np.searchsorted(table[k], t + 1))
+        prev = table[k, b - 1] if b > 0 else 0
+        sel = np.flatnonzero(ids[bstart[b]:bend[b]] <= k)
+        return vs[bstart[b] + sel[t - prev]]
+
+    for k in range(1, nbins):
+        m = table[k, -1]
+        if m:
+            med[k] = (rank_value(k, (m - 1)//2) + rank_value(k, m//2))/2
+    return med
+
+
+def radial_profile(image, center, dr=100, max_radius=None, valid=None, median=True, index=None):
+    """ring (donut, dr) and disk (radius r) statistics with np.bincount on a radius index map
+
+    Args:
+        image (2d-ndarray): image, nan values are skipped
+        center (tuple): center (x, y) = (col, row), same as cv2.circle
+        dr (float, optional): ring width [pixel]. Defaults to 100.
+        max_radius (float, optional): maximum radius [pixel]. Defaults to the image corner.
+        valid (2d-ndarray, optional): bool mask of the pixels used. Defaults to all finite pixels.
+        median (bool, optional): calculate medians (sorts the pixels). Defaults to True.
+        index (2d-ndarray, optional): radius_index(image.shape, center, dr, max_radius) to reuse.
+
+    Returns:
+        dict: {'r': outer radius of ring k [pixel] (k=1..),
+               'ring': {'mean', 'sum', 'count', 'std', 'median'},
+               'disk': {'mean', 'sum', 'count', 'std', 'median'}}
+
+    Examples:
+        prof = radial_profile(rc0['wt'], center=(1150, 1130), dr=20, max_radius=1100)
+        plt.plot(prof['r'] * PIX_SIZE, prof['ring']['mean'])
+    """
+    image = np.asarray(image)
+    if index is None:
+        index = radius_index(image.shape, center, dr, max_radius)
+    use = np.isfinite(image) & (index > 0)
+    if valid is not None:
+        use &= valid
+    values = image[use].astype(np.float64)
+    idx = index[use]
+    nbins = int(index.max()) + 1
+    if max_radius is not None:
+        nbins = max(nbins, int(np.ceil(max_radius / dr)) + 1)
+
+    count = np.bincount(idx, minlength=nbins).astype(np.float64)
+    total = np.bincount(idx, weights=values, minlength=nbins)
+    # squares around the global mean (less cancellation)
+    shift = values.mean() if values.size else 0.0
+    total2 = np.bincount(idx, weights=(values - shift)**2, minlength=nbins)
+
+    def stats(cnt, s, s2):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = s / cnt
+            var = s2 / cnt - (mean - shift)**2
+        return {'mean': mean[1:], 'sum': s[1:], 'count': cnt[1:].astype(np.int64),
+                'std': np.sqrt(np.maximum(var, 0))[1:]}
+
+    ring = stats(count, total, total2)
+    disk = stats(np.cumsum(count), np.cumsum(total), np.cumsum(total2))
+    if median:
+        ring['median'] = _ring_medians(values, idx, nbins)[1:]
+        disk['median'] = _disk_medians(values, idx, nbins)[1:]
+
+    return {'r': np.arange(1, nbins) * dr, 'ring': ring, 'disk': disk}
+
+
 def _circle_plots(original_img, dimg_lists, rad_lists, ave_lists, title='Select Imgae', nrows=None, ncols=4, pixel_size=0.05,save=False):
     
     # def zscore(x):
@@ -219,7 +522,7 @@ def _circle_plots(original_img, dimg_lists, rad_lists, ave_lists, title='Select
 
 def calc_circle_radius_ave(org_image, center, max_radius, dr=100, pixel_size=0.05, 
                            fig_show=True, ylim=(0,0), ylabel='$FWHM_g$ ($^{\circ}$)',
-                           title='r $\cdot$ $\Delta r$',save=False):
+                           title='r $\cdot$ $\Delta r$',save=False, images=True):
     """Average in radial direction and in donut-shaped radial direction
 
     Args:
@@ -231,6 +534,7 @@ def calc_circle_radius_ave(org_image, center, max_radius, dr=100, pixel_size=0.0
         fig_show (bool, optional): graph and figure. Defaults to True.
         ylim (tuple, optional): y axis limit. The default is (0,0), which means autoscale.
         In case of fwhm, ylim=(0.0035,0.006)
+        images (bool, optional): return the masked images 'img' (always made for fig_show). Defaults to True.
 
     Returns:
         dict: dsi-> radial average, dri-> donut-shaped radial average
@@ -239,49 +543,25 @@ def calc_circle_radius_ave(org_image, center, max_radius, dr=100, pixel_size=0.0
     """
     
     num = 1 + (max_radius//dr)
-    radius_lists =[i*100 for i in range(1,num+1)]
+    radius_lists =[i*dr for i in range(1,num+1)]
+    real_radius_lists = [ri*pixel_size for ri in radius_lists] #radius_list x pixel size
+
+    # one bincount pass, values <= 0.00001 are skipped (masked pixels)
+    index = radius_index(org_image.shape, center, dr, max_radius=num*dr)
+    prof = radial_profile(org_image, center, dr, max_radius=num*dr, valid=org_image > 0.00001,
+                          median=False, index=index)
+    mean_lists = list(prof['disk']['mean'][:num])
+    sum_lists = list(prof['disk']['sum'][:num])
+    mean_r_lists = list(prof['ring']['mean'][:num])
+    sum_r_lists = list(prof['ring']['sum'][:num])
 
     dst_lists = []
-    sum_lists = []
-    mean_lists = []
-    
     dr_lists = []
-    sum_r_lists = []
-    mean_r_lists = []
-    real_radius_lists = [] #radius_list x pixel size
-   
-    tmp_maskf = np.zeros_like(org_image)
-    
-    for ri in radius_lists:
+    if images or fig_show:
+        for k in range(1, num+1):
+            dst_lists.append(org_image * (index <= k) * (index > 0))
+            dr_lists.append(org_image * (index == k))
 
-        tmp_dst,tmp_mask = _make_circle_mask(org_image=org_image, center=center ,radius=ri)
-        dst_lists.append(tmp_dst)
-       
-        tmp_maskf = tmp_mask - tmp_maskf
-        
-        tmp_drc = tmp_dst.copy()
-        tmp_dr = tmp_drc*tmp_maskf
-        dr_lists.append(tmp_dr)
-        
-        tmp_maskf = tmp_mask
-        
-        # tmp_sum = np.nansum(np.abs(tmp_dst*arcsec2deg))
-        # tmp_mean =np.nanmean(np.abs(tmp_dst*arcsec2deg))
-        dst_nan = np.where(tmp_dst<=0.00001, np.nan, tmp_dst)
-        tmp_sum = np.nansum(dst_nan)
-        tmp_mean =np.nanmean(dst_nan)
-        sum_lists.append(tmp_sum)
-        mean_lists.append(tmp_mean)
-        
-        dr_nan = np.where(tmp_dr<=0.00001, np.nan, tmp_dr)
-        tmp_r_sum = np.nansum(dr_nan)
-        tmp_r_mean =np.nanmean(dr_nan)
-        sum_r_lists.append(tmp_r_sum)
-        mean_r_lists.append(tmp_r_mean)
-        real_radius_lists.append(ri*pixel_size)
-        # print(f'radius:{ri}, SUM:{tmp_sum:.2f}, MEAN:{tmp_mean:.2f}')
-        # print(f'radius:{ri}, SUM:{tmp_r_sum:.2f}, MEAN:{tmp_r_mean:.2f}')
-        
     if fig_show:
         mean_arr = np.array(mean_lists)
         diff_mean = np.diff(mean_arr, prepend=0)
@@ -318,6 +598,113 @@ def calc_circle_radius_ave(org_image, center, max_radius, dr=100, pixel_size=0.0
 
     return dsi, dri
 
+def radial_batch(maps, center, max_radius, dr=100, pixel_size=PIX_SIZE, valid_min=None, median=False):
+    """radial and donut-shaped radial profiles of several maps (e.g. wt of 3 directions, ct, q ang)
+
+    All maps share one radius index (WaferGrid), only the profile tables are returned.
+    Use ring_images to render selected ring images.
+
+    Args:
+        maps (dict or list): {name: 2d-ndarray} or list of maps (names 0, 1, ...), same shape
+        center (tuple): center (x, y) = (col, row), same as cv2.circle
+        max_radius (int): wafer radius [pixel]
+        dr (int, optional): ring width [pixel]. Defaults to 100.
+        pixel_size (float, optional): detector pixel size [mm]. Defaults to PIX_SIZE.
+        valid_min (float, optional): skip values <= valid_min (calc_circle_radius_ave uses 0.00001).
+            Defaults to None (only nan is skipped).
+        median (bool, optional): add 'median'. Defaults to False.
+
+    Returns:
+        dict: {name: (dsi, dri)}, same keys as calc_circle_radius_ave without 'img'
+            dsi = {'r': radius [mm], 'ave', 'sum', 'count', 'std', ('median')}  radius <= r
+            dri = {'r': radius [mm], 'ave', 'sum', 'count', 'std', ('median')}  r - dr < radius <= r
+
+    Examples:
+        prof = radial_batch({'0': rc0['wt'], '120': rc120['wt'], '-120': rcm120['wt']},
+                            center=hc_lists[0], max_radius=hr_lists[0], dr=50)
+        r_dr_plot(prof)
+    """
+    if not isinstance(maps, dict):
+        maps = dict(enumerate(maps))
+    num = 1 + (max_radius//dr)
+    shape = np.shape(next(iter(maps.values())))
+    index = WaferGrid.get(shape, center, pixel_size).ring_index(dr, num*dr)
+    r_mm = [k*dr*pixel_size for k in range(1, num+1)]
+
+    ret = {}
+    for name, image in maps.items():
+        image = np.asarray(image)
+        valid = image > valid_min if valid_min is not None else None
+        prof = radial_profile(image, center, dr, max_radius=num*dr, valid=valid, median=median, index=index)
+        tables = []
+        for part in ('disk', 'ring'):
+            table = {'r': r_mm}
+            for key, value in prof[part].items():
+                table['ave' if key == 'mean' else key] = value[:num]
+            tables.append(table)
+        ret[name] = tuple(tables)
+    return ret
+
+
+def ring_images(image, center, max_radius, rings, dr=100):
+    """images of selected disks and rings (on demand, for plots)
+
+    Args:
+        image (2d-ndarray): map
+        center (tuple): center (x, y) = (col, row)
+        max_radius (int): wafer radius [pixel]
+        rings (list[int]): ring numbers k (1: innermost, radius k*dr)
+        dr (int, optional): ring width [pixel]. Defaults to 100.
+
+    Returns:
+        tuple: disk images, ring images (lists, 0 outside like calc_circle_radius_ave 'img')
+    """
+    num = 1 + (max_radius//dr)
+    index = WaferGrid.get(np.shape(image), center).ring_index(dr, num*dr)
+    disks = [image * ((index <= k) & (index > 0)) for k in rings]
+    donuts = [image * (index == k) for k in rings]
+    return disks, donuts
+
+
+def r_dr_plot(profiles, labels=None, ylim=(0,0), ylabel='$FWHM_g$ ($^{\circ}$)',
+              title='r $\cdot$ $\Delta r$', save=False):
+    """r and dr plots of several profiles
+
+    Args:
+        profiles (dict): {name: (dsi, dri)}, radial_batch output
+        labels (dict, optional): {name: legend label}. Defaults to the names.
+        ylim (tuple, optional): y axis limit. The default is (0,0), which means autoscale.
+        ylabel (str, optional): y label.
+        title (str, optional): figure title.
+        save (bool, optional): save figure. Defaults to False.
+    """
+    markers_ = ['o-', 's-', '^-', 'v-', 'D-', 'x-']
+    nrow=1
+    ncol=2
+    fig, (ax1,ax2) =plt.subplots(nrow, ncol, figsize=(ncol*width_u,nrow*height_u), tight_layout=True)
+    for i, (name, (dsi, dri)) in enumerate(profiles.items()):
+        label = labels.get(name, name) if labels else name
+        marker = markers_[i % len(markers_)]
+        ax1.plot(np.array(dsi['r']), dsi['ave'], marker, label=label)
+        ax2.plot(np.array(dri['r']), dri['ave'], marker, label=label)
+    ax1.set_title('r')
+    ax2.set_title('$\Delta r$')
+    for ax in (ax1, ax2):
+        ax.set_xlabel('Radius (mm)')
+        ax.set_ylabel(ylabel)
+        ax.grid()
+        ax.legend(loc='upper left')
+        if ylim != (0,0):
+            ax.set_ylim(ylim)
+
+    fig.suptitle(title)
+
+    if save:
+        filename=mlplt.re_replace(title)
+        plt.savefig(f'{filename}.{EXT}', dpi=DPI)
+
+    plt.show()
+
 def curvature_plot(dsi,dri,ylim=(0,0),title=''):
     """curvature_plot
         q tilte data
@@ -364,41 +751,9 @@ def r_dr_3data_plot(r0_dsi,r0_dri,rp120_dsi,rp120_dri,rm120_dsi,rm120_dri,
                     save=False):
    
     # r and dr plots of 3 directions
-    nrow=1
-    ncol=2
-    fig, (ax1,ax2) =plt.subplots(nrow, ncol, figsize=(ncol*width_u,nrow*height_u), tight_layout=True)
-    ax1.plot(np.array(r0_dsi['r']),r0_dsi['ave'],'o-',label='$\psi=0^{\circ}$')
-    ax1.plot(np.array(rp120_dsi['r']),rp120_dsi['ave'],'s-',label='$\psi=120^{\circ}$')
-    ax1.plot(np.array(rm120_dsi['r']),rm120_dsi['ave'],'^-',label='$\psi=-120^{\circ}$')
-    ax1.set_title('r')
-    ax1.set_xlabel('Radius (mm)')
-    ax1.set_ylabel(ylabel)
-    ax1.grid()
-    ax1.legend(loc='upper left')
-    # ax2.plot(radius_lists,diff_mean)
-    # ax2.set_title('Differance Average')
-    # ax2.set_xlabel('Radious [pixel]')
-    # ax2.set_ylabel('Difference Average')
-    ax2.plot(np.array(r0_dri['r']),r0_dri['ave'],'o-',label='$\psi=0^{\circ}$')
-    ax2.plot(np.array(rp120_dri['r']),rp120_dri['ave'],'s-',label='$\psi=120^{\circ}$')
-    ax2.plot(np.array(rm120_dri['r']),rm120_dri['ave'],'^-',label='$\psi=-120^{\circ}$')
-    ax2.set_title('$\Delta r$')
-    ax2.set_xlabel('Radius (mm)')
-    ax2.set_ylabel(ylabel)
-    ax2.grid()
-    ax2.legend(loc='upper left',fontsize=14)
-    
-    if ylim != (0,0):
-        ax1.set_ylim(ylim)
-        ax2.set_ylim(ylim)
-
-    fig.suptitle(title)
-    
-    if save:
-        filename=mlplt.re_replace(title)
-        plt.savefig(f'{filename}.{EXT}', dpi=DPI)
-        
-    plt.show()
+    profiles = {'0': (r0_dsi, r0_dri), '120': (rp120_dsi, rp120_dri), '-120': (rm120_dsi, rm120_dri)}
+    labels = {'0': '$\psi=0^{\circ}$', '120': '$\psi=120^{\circ}$', '-120': '$\psi=-120^{\circ}$'}
+    r_dr_plot(profiles, labels=labels, ylim=ylim, ylabel=ylabel, title=title, save=save)
   
 if __name__ == '__main__':
     pass
@@ -12,6 +12,7 @@ __date__ = "2022/09/02"
 __version__= "2.0.0"
 __revised__ = "2023/02/02"
 
+from collections.abc import Mapping
 from pathlib import Path
 
 import numpy as np
@@ -19,17 +20,42 @@ from PIL import Image
 import tifffile as tiff
 
 from qfit import file_folder_trans as fft
+from qfit import map_stats as ms
+from qfit import virtual_crop as vc
+# goodness-of-fit map suffixes written by fit.py (gaussian method)
+from qfit.fit import GOF_KEYS
 
+def _folder_crop(file_path, crop):
+    "crop descriptor: True -> crop.json of the folder (None if absent), False -> None"
+    if crop is True:
+        return vc.crop_of(file_path)
+    return crop or None
 
-def load_rc_tif(file_path):
+
+def _read_tif(fn, crop):
+    "tif map in memory (cropped without reading the whole file if crop is given)"
+    if crop is None:
+        return tiff.imread(str(fn))
+    return np.array(vc.read_tif(fn, crop))
+
+
+def load_rc_tif(file_path, lazy=False, dtype=np.float32, crop=True):
     """load rc  from tif data
     
     Args:
         file_path (str):  Name of the folder where .npy and .tif files are stored.
         In Load, only Tif files are used.
+        lazy (bool, optional): return RCMap (maps are read and calculated on first access).
+            Defaults to False.
+        dtype (optional): dtype of RCMap. Defaults to np.float32.
+        crop (bool or dict, optional): virtual crop (virtual_crop). True: crop.json of the folder if present,
+            False: full maps, dict: crop descriptor. Defaults to True.
 
     Returns:
         dict:  {'c':peak[arcsec], 'h':height, 'w':width[arcsec], 'ct':peak-ave[deg], 'ht':normalize, 'wt':width[deg]}
+        If the folder contains the goodness-of-fit maps of the gaussian fit (fit.py GOF_KEYS),
+        they are added as {'chi2':reduced chi-square, 'rms':residual RMS,
+        'eh':error of height, 'ec':error of peak[arcsec], 'ew':error of sigma[arcsec]}
         
     Note:
     FWHM = 2 * root(2*ln(2))* sigma(gauss) ~2.35*sigma
@@ -38,18 +64,22 @@ def load_rc_tif(file_path):
     Method hw (width) -> FWHM / HWFACTOR (~=sigma) 
     method gauss (width) -> sigma
     """
+    if lazy:
+        return RCMap.from_folder(file_path, dtype=dtype, crop=crop)
    
     file_lists = fft.folder_file_list(file_path)
+    crop = _folder_crop(file_path, crop)
 
     # print(file_lists)
     # convert arcsec to deg
     arcsec2deg = (1/3600)
     # sigma to FWHM
     HWFACTOR = 2 * np.sqrt(2 * np.log(2))
+    gof = {}
     
     for fn in file_lists:
 
-        tmp_array = tiff.imread(str(fn))
+        tmp_array = _read_tif(fn, crop)
         tmp_ave = np.mean(tmp_array[~np.isnan(tmp_array)])
 
         if '_c.' in fn.name:
@@ -67,15 +97,24 @@ def load_rc_tif(file_path):
             w_data = tmp_array*HWFACTOR
             w_tra = np.abs(w_data * arcsec2deg)
 
+        else:
+            for key in GOF_KEYS:
+                if f'_{key}.' in fn.name:
+                    gof[key] = tmp_array
 
-    return {'c':c_data, 'h':h_data, 'w':w_data, 'ct':c_tra, 'ht':h_tra, 'wt':w_tra }
 
+    return {'c':c_data, 'h':h_data, 'w':w_data, 'ct':c_tra, 'ht':h_tra, 'wt':w_tra, **gof }
 
-def load_q_tif(file_path):
+
+def load_q_tif(file_path, lazy=False, dtype=np.float32, crop=True):
     """load q tif data
 
     Args:
         file_path (str): folder name containg q tif data
+        lazy (bool, optional): return QMap (maps are read and calculated on first access).
+            Defaults to False.
+        dtype (optional): dtype of QMap. Defaults to np.float32.
+        crop (bool or dict, optional): virtual crop, see load_rc_tif. Defaults to True.
 
     Returns:
         dict : {'x':qx, 'y':qy, 'z':qz, 'xy':qxy, 'ang':q_ang, 'angxy':q_angxy, 'r':q_r}
@@ -90,11 +129,14 @@ def load_q_tif(file_path):
         and the positive direction of the x-axis in the polar coordinate plane (declination).
     
     """
+    if lazy:
+        return QMap.from_folder(file_path, dtype=dtype, crop=crop)
        
     file_lists = fft.folder_file_list(file_path)
+    crop = _folder_crop(file_path, crop)
 
     for fn in file_lists:
-        tmp_array = tiff.imread(str(fn))
+        tmp_array = _read_tif(fn, crop)
         # print(fn.name)
     
         if '_x.' in fn.name:
@@ -109,6 +151,14 @@ def load_q_tif(file_path):
         else:
             pass
 
+    return q_dict(qx, qy, qz)
+
+def q_dict(qx, qy, qz):
+    """q dict (same as load_q_tif) from qx, qy, qz arrays, e.g. q2.compute_q output
+
+    Returns:
+        dict : {'x':qx, 'y':qy, 'z':qz, 'xy':qxy, 'ang':q_ang, 'angxy':q_angxy, 'r':q_r}
+    """
     qxy = np.hypot(qx, qy)
     q_ang = np.rad2deg(np.arctan(qxy/qz))
     # q_ang = np.rad2deg(np.arctan2(qxy,qz))
@@ -117,6 +167,280 @@ def load_q_tif(file_path):
 
     return {'x':qx, 'y':qy, 'z':qz, 'xy':qxy, 'ang':q_ang, 'angxy':q_angxy, 'r':q_r}
 
+
+class LazyMap(Mapping):
+    """dict-like maps of one folder: read on first access, derived maps calculated on first access
+
+    Base class of RCMap and QMap.
+    Tif files are memory-mapped when possible (uncompressed, as written by fft.npy2folder).
+    With a crop descriptor (virtual_crop) only the cropped part of the files is read.
+    Maps are kept in dtype (None: as stored). Results are cached until invalidate().
+
+    Args:
+        maps (dict, optional): maps in memory {key: 2D array}
+        files (dict, optional): tif files {key: path}
+        dtype (optional): dtype of the maps. Defaults to np.float32.
+        mmap (bool, optional): memory-map tif files. Defaults to True.
+        crop (dict, optional): crop descriptor of the files. Defaults to None.
+    """
+    FILES = {}    # key: file suffix
+    DERIVED = {}  # key: required keys
+
+    def __init__(self, maps=None, files=None, dtype=np.float32, mmap=True, crop=None):
+        self.dtype = dtype
+        self.mmap = mmap
+        self.crop = crop
+        self._files = dict(files or {})
+        self._cache = {}
+        for key, data in (maps or {}).items():
+            self._cache[key] = self._as_dtype(data)
+
+    @classmethod
+    def from_folder(cls, file_path, crop=True, **kwargs):
+        """maps of the tif files in a folder (fft.folder_file_list), cropped by its crop.json if crop is True"""
+        kwargs['crop'] = _folder_crop(file_path, crop)
+        files = {}
+        for fn in fft.folder_file_list(file_path):
+            for key, suffix in cls.FILES.items():
+                if f'_{suffix}.' in fn.name:
+                    files[key] = fn
+        return cls(files=files, **kwargs)
+
+    def _as_dtype(self, data):
+        data = np.asarray(data)
+        if self.dtype is None or data.dtype == self.dtype:
+            return data
+        return data.astype(self.dtype)
+
+    def _read(self, key):
+        data = vc.read_tif(self._files[key], self.crop, self.mmap)
+        return self._loaded(key, self._as_dtype(data))
+
+    def _loaded(self, key, data):
+        "conversion of a map read from file"
+        return data
+
+    def _derive(self, key):
+        raise NotImplementedError
+
+    def _has(self, key):
+        if key in self._cache or key in self._files:
+            return True
+        if key in self.DERIVED:
+            return all(self._has(k) for k in self.DERIVED[key])
+        return False
+
+    def __getitem__(self, key):
+        if key in self._cache:
+            return self._cache[key]
+        if key in self._files:
+            data = self._read(key)
+        elif key in self.DERIVED and self._has(key):
+            data = self._derive(key)
+        else:
+            raise KeyError(key)
+        self._cache[key] = data
+        return data
+
+    def __setitem__(self, key, data):
+        "replace a map, the derived maps depending on it are invalidated"
+        self._cache[key] = self._as_dtype(data)
+        self._files.pop(key, None)
+        self.invalidate(*[k for k, req in self.DERIVED.items() if key in req and k != key])
+
+    def __contains__(self, key):
+        return self._has(key)
+
+    def __iter__(self):
+        keys = [k for k in self.FILES if self._has(k)]
+        keys += [k for k in self._cache if k not in keys and k not in self.DERIVED]
+        keys += [k for k in self.DERIVED if self._has(k)]
+        return iter(keys)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({list(self)}, cached={self.cached()})'
+
+    def invalidate(self, *keys):
+        """drop cached maps (all derived maps if no key is given), they are recalculated or read again"""
+        if not keys:
+            keys = tuple(self.DERIVED)
+        for key in keys:
+            if key in self._files or key in self.DERIVED:
+                self._cache.pop(key, None)
+
+    def cached(self):
+        "keys of the maps in memory"
+        return list(self._cache)
+
+    def to_dict(self):
+        "all maps as dict (reads and calculates everything)"
+        return {key: self[key] for key in self}
+
+
+class RCMap(LazyMap):
+    """lazy version of load_rc_tif
+
+    Keys are the same as load_rc_tif, 'w' is FWHM (sigma * HWFACTOR).
+
+    Examples:
+        >>> rc = RCMap.from_folder(out_folder)  # or load_rc_tif(out_folder, lazy=True)
+        >>> plt.imshow(rc['ct'])  # reads only _c.tif
+    """
+    FILES = {'c': 'c', 'h': 'h', 'w': 'w', **{key: key for key in GOF_KEYS}}
+    DERIVED = {'ct': ('c',), 'ht': ('h',), 'wt': ('w',)}
+    HWFACTOR = 2 * np.sqrt(2 * np.log(2))
+    ARCSEC2DEG = 1/3600
+
+    def _loaded(self, key, data):
+        if key == 'w':
+            return data * self.HWFACTOR
+        return data
+
+    def _derive(self, key):
+        if key == 'ct':
+            c = self['c']
+            return (c - np.nanmean(c)) * self.ARCSEC2DEG
+        if key == 'ht':
+            h = self['h']
+            h_ave = np.nanmean(h)
+            return (h - h_ave)/h_ave
+        if key == 'wt':
+            return np.abs(self['w'] * self.ARCSEC2DEG)
+        raise KeyError(key)
+
+
+class QMap(LazyMap):
+    """lazy version of load_q_tif / q_dict
+
+    Keys are the same as load_q_tif, '_res' of q2.solve_q is read as 'res'.
+
+    Examples:
+        >>> q = QMap.from_folder(out_q_folder)  # or load_q_tif(out_q_folder, lazy=True)
+        >>> q = QMap(q2.compute_q(rc0['c'], rc120['c']))
+        >>> plt.imshow(q['angxy'])  # calculates only xy, angxy
+    """
+    FILES = {'x': 'x', 'y': 'y', 'z': 'z', 'res': 'res'}
+    DERIVED = {'xy': ('x', 'y'), 'ang': ('x', 'y', 'z'), 'angxy': ('x', 'y'), 'r': ('x', 'y', 'z')}
+
+    def _derive(self, key):
+        if key == 'xy':
+            return np.hypot(self['x'], self['y'])
+        if key == 'ang':
+            return np.rad2deg(np.arctan(self['xy']/self['z']))
+        if key == 'angxy':
+            return np.rad2deg(np.arctan2(self['y'], self['x']))
+        if key == 'r':
+            x, y, z = self['x'], self['y'], self['z']
+            return np.sqrt(x**2 + y**2 + z**2)
+        raise KeyError(key)
+
+def _q_apply(func, qs, out=None, dtype=np.float32, chunk=None):
+    """evaluate func(list of components, out=component) for x, y, z of the q dicts qs
+
+    Args:
+        func (callable): func(arrays, out) writes the result to out
+        qs (list[dict]): q dicts or QMap
+        out (dict or QMap, optional): q dict or QMap for the result (can be one of qs).
+            'x', 'y', 'z' are overwritten in place if they are writable arrays of the result shape,
+            otherwise (e.g. read-only memory-mapped files) they are replaced by new arrays.
+            Missing keys of out are added.
+            The derived maps of out are recalculated ('xy', 'ang', 'angxy', 'r') and 'res' is removed.
+        dtype (optional): dtype of the new result. Defaults to np.float32.
+        chunk (int, optional): rows evaluated at once (limits temporaries of func). Defaults to all rows.
+
+    Returns:
+        QMap: derived maps are calculated on first access (out itself if it is a QMap)
+
+    Examples:
+        out can be any of the inputs
+        >>> for i in range(3):
+        ...     qs = [{k: np.full(2, v, np.float32) for k in 'xyz'} for v in (1, 2, 10)]
+        ...     print(round(float(q_average(qs, out=qs[i], chunk=1)['x'][0]), 3), round(float(qs[i]['z'][1]), 3))
+        4.333 4.333
+        4.333 4.333
+        4.333 4.333
+        >>> out = {}
+        >>> sorted(q_difference(*qs[:2], out=out)), sorted(out)
+        (['ang', 'angxy', 'r', 'x', 'xy', 'y', 'z'], ['x', 'y', 'z'])
+    """
+    ret = {}
+    for key in ('x', 'y', 'z'):
+        arrays = [q[key] for q in qs]
+        shape = np.shape(arrays[0])
+        dest = out.get(key) if out is not None else None
+        if not (isinstance(dest, np.ndarray) and dest.flags.writeable and dest.shape == shape):
+            # copy on write: the result is stored to out below
+            dest = np.empty(shape, dtype=dtype)
+        step = chunk or max(len(dest), 1)
+        for i in range(0, len(dest), step):
+            sl = slice(i, i + step)
+            func([a[sl] for a in arrays], dest[sl])
+        ret[key] = dest
+    if out is None:
+        return QMap(ret, dtype=None)
+
+    for key, dest in ret.items():
+        if out.get(key) is not dest:
+            out[key] = dest
+    if isinstance(out, LazyMap):
+        # 'res' of the inputs does not belong to the result
+        out._cache.pop('res', None)
+        out._files.pop('res', None)
+        out.invalidate()
+        return out
+    out.pop('res', None)
+    result = QMap(ret, dtype=None)
+    for key in QMap.DERIVED:
+        if key in out:
+            out[key] = result[key]
+    return result
+
+def _mean(arrays, out):
+    "mean of arrays written to out, which can be (a view of) any of the arrays"
+    same = [a for a in arrays if a is out or (a.shape == out.shape and a.strides == out.strides
+            and a.__array_interface__['data'][0] == out.__array_interface__['data'][0])]
+    # partial overlaps with out are read before out is written
+    rest = [a.copy() if np.shares_memory(a, out) else a for a in arrays if not any(a is s for s in same)]
+    if same:
+        np.multiply(out, len(same), out=out)
+    else:
+        np.add(rest[0], rest[1], out=out)
+        rest = rest[2:]
+    for a in rest:
+        np.add(out, a, out=out)
+    np.multiply(out, 1/len(arrays), out=out)
+
+def q_average(qs, out=None, dtype=np.float32, chunk=None):
+    """average of q dicts (x, y, z), float32 and without full-size temporaries
+
+    Args:
+        qs (list[dict]): q dicts or QMap (2 or more)
+        out (dict or QMap, optional): q dict or QMap for the result, see _q_apply. Defaults to new arrays.
+        dtype (optional): dtype of the new result. Defaults to np.float32.
+        chunk (int, optional): rows evaluated at once. Defaults to all rows.
+
+    Returns:
+        QMap: {'x', 'y', 'z', 'xy', 'ang', 'angxy', 'r'}
+
+    Examples:
+        q3 = q_average([q_0120, q_0m120, q_120m120])
+    """
+    return _q_apply(_mean, qs, out, dtype, chunk)
+
+def q_difference(qa, qb, out=None, dtype=np.float32, chunk=None):
+    """qa - qb (x, y, z), see q_average for the arguments"""
+    return _q_apply(lambda a, o: np.subtract(a[0], a[1], out=o), [qa, qb], out, dtype, chunk)
+
+def q_ratio(qa, qb, out=None, dtype=np.float32, chunk=None):
+    """qa / qb (x, y, z), see q_average for the arguments"""
+    def div(a, o):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(a[0], a[1], out=o)
+    return _q_apply(div, [qa, qb], out, dtype, chunk)
+
 def average_3q(q0p,q0m,qpm):
     """ Average of 3q
 
@@ -126,19 +450,10 @@ def average_3q(q0p,q0m,qpm):
         qpm (dict): load q data
 
     Returns:
-        dict: {'x':qtx, 'y':qty, 'z':qtz, 'xy':qtxy, 'ang':qt_ang, 'angxy':qt_angxy, 'r':qt_r}
+        QMap: {'x':qtx, 'y':qty, 'z':qtz, 'xy':qtxy, 'ang':qt_ang, 'angxy':qt_angxy, 'r':qt_r}
     """
     
-    qtx = (q0p['x'] + q0m['x'] + qpm['x'])/3
-    qty = (q0p['y'] + q0m['y'] + qpm['y'])/3
-    qtz = (q0p['z'] + q0m['z'] + qpm['z'])/3
-    
-    qtxy = np.hypot(qtx, qty)
-    qt_ang = np.rad2deg(np.arctan(qtxy/qtz))
-    qt_angxy = np.rad2deg(np.arctan2(qty,qtx))
-    qt_r = np.sqrt(qtx**2 + qty**2+ qtz**2)
-    
-    return {'x':qtx, 'y':qty, 'z':qtz, 'xy':qtxy, 'ang':qt_ang, 'angxy':qt_angxy, 'r':qt_r}
+    return q_average([q0p, q0m, qpm])
 
 def difference_2q(qaf,qbf,flag='minus'):
     """ difference of q calculations
@@ -150,7 +465,7 @@ def difference_2q(qaf,qbf,flag='minus'):
             Defaults to 'minus'.
 
     Returns:
-        dict: {'x':qtx, 'y':qty, 'z':qtz, 'xy':qtxy, 'ang':qt_ang, 'angxy':qt_angxy, 'r':qt_r}
+        QMap: {'x':qtx, 'y':qty, 'z':qtz, 'xy':qtxy, 'ang':qt_ang, 'angxy':qt_angxy, 'r':qt_r}
 
     Examples:
         qd = difference_2q(qbf=q_bs,qaf=q_epi,flag='minus')
@@ -158,37 +473,15 @@ def difference_2q(qaf,qbf,flag='minus'):
     """
 
     if flag== 'minus':
-        qtx = qaf['x'] -qbf['x']
-        qty = qaf['y'] -qbf['y']
-        qtz = qaf['z'] -qbf['z']
-
-        qtxy = np.hypot(qtx, qty)
-        qt_ang = np.rad2deg(np.arctan(qtxy/qtz))
-        qt_angxy = np.rad2deg(np.arctan2(qty,qtx))
-        qt_r = np.sqrt(qtx**2 + qty**2+ qtz**2)
-
+        return q_difference(qaf, qbf)
 
     elif flag== 'div':
-        qtx = qbf['x'] /qaf['x']
-        qty = qbf['y'] /qaf['y']
-        qtz = qbf['z'] /qaf['z']
-
-        qtxy = np.hypot(qtx, qty)
-        qt_ang = np.rad2deg(np.arctan(qtxy/qtz))
-        qt_angxy = np.rad2deg(np.arctan2(qty,qtx))
-        qt_r = np.sqrt(qtx**2 + qty**2+ qtz**2)
+        return q_ratio(qbf, qaf)
     
     elif flag == 'ave':
-        qtx = (qaf['x'] + qbf['x'])/2
-        qty = (qaf['y'] + qbf['y'])/2
-        qtz = (qaf['z'] + qbf['z'])/2
+        return q_average([qaf, qbf])
 
-        qtxy = np.hypot(qtx, qty)
-        qt_ang = np.rad2deg(np.arctan(qtxy/qtz))
-        qt_angxy = np.rad2deg(np.arctan2(qty,qtx))
-        qt_r = np.sqrt(qtx**2 + qty**2+ qtz**2)
-
-    return {'x':qtx, 'y':qty, 'z':qtz, 'xy':qtxy, 'ang':qt_ang, 'angxy':qt_angxy, 'r':qt_r}
+    raise ValueError(f"flag must be 'minus', 'div' or 'ave': {flag}")
 
 
 import numpy.ma as ma
@@ -217,11 +510,9 @@ def nan_corr(q1,q2):
 
     print(corrd.data)       
     """
-    a = ma.masked_invalid(q1)
-    b = ma.masked_invalid(q2)
-
-    msk = (~a.mask & ~b.mask)
-    corr = ma.corrcoef(a[msk],b[msk])
+    # one pass over the pixels where both are finite (map_stats)
+    st = ms.describe([q1, q2], quantiles=(), corr=True)
+    corr = ma.masked_invalid(st.corr())
     print(corr)
     
     return corr
@@ -229,12 +520,13 @@ def nan_corr(q1,q2):
 
 # --- cos and polar calculation ---
 
-def cosxy(qx,qy):
+def cosxy(qx,qy,dtype=None):
     """qx ,qy convert cos values
 
     Args:
         qx (2d-ndarray): qx
         qy (2d-ndarray): qy
+        dtype (optional): output dtype, e.g. np.float32. Defaults to float64.
 
     Returns:
         dict[2d-ndarray]: {'qxsg':qcxsig, 'qysg':qcysig, 'qcx':qcx, 'qcy':qcy, 'qc0':qs0}
@@ -243,15 +535,14 @@ def cosxy(qx,qy):
         qcos=polar_conv(q_0m120['x'],q_0m120['y']) 
         
     """
-    qcx = qx.copy()
-    qcy = qy.copy()
-    q_r, q_t = getRD(x=qcx, y=qcy, out_deg_or_rad='rad')
-    q_ri, q_ti = getRD(y=qcx, x=qcy, out_deg_or_rad='rad')
-    qcx=np.cos(q_t)
-    qcy=np.cos(q_ti)
+    # cos(arctan2(qy,qx)) and cos(arctan2(qx,qy)), 1 for qx=qy=0 like arctan2
+    qcx, qcy = inner_cos((qx, qy), [(1, 0), (0, 1)], dtype=dtype)
+    zero = (qx == 0) & (qy == 0)
+    qcx[zero] = 1
+    qcy[zero] = 1
     qcxsig = np.sign(qcx)
     qcysig = np.sign(qcy)
-    qs0=np.zeros(qcx.shape)
+    qs0=np.zeros(qcx.shape, dtype=qcx.dtype)
     
     return {'qxsg':qcxsig, 'qysg':qcysig, 'qcx':qcx, 'qcy':qcy, 'qc0':qs0}
 
@@ -321,11 +612,41 @@ def _inner_cos(u: np.ndarray, v: np.ndarray):
         
     return cos_t
 
-def d2_inner_product(qx,qy,u_angd=(0,90)):
+def inner_cos(v, units, dtype=None):
+    """cos between the vectors v of all pixels and each vector of units (vectorized _inner_cos)
+
+    Args:
+        v (tuple[ndarray]): components of the vectors, e.g. (qx, qy) or (qx, qy, qz)
+        units (list): vectors (same number of components as v), need not be normalized
+        dtype (optional): calculation and output dtype, e.g. np.float32. Defaults to float64.
+
+    Returns:
+        list[ndarray]: cos values for each vector of units.
+        nan where v contains nan or has length 0
+
+    Example:
+        qux, quy = inner_cos((qx, qy), [(1, 0), (0, 1)], dtype=np.float32)
+    """
+    dtype = np.float64 if dtype is None else dtype
+    v = [np.asarray(c, dtype=dtype) for c in v]
+    norm = np.sqrt(sum(c * c for c in v))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inv = np.where(norm > 0, 1 / norm, np.nan).astype(dtype, copy=False)
+
+    ret = []
+    for u in units:
+        u = np.asarray(u, dtype=np.float64)
+        u = (u / np.linalg.norm(u)).astype(dtype)
+        dot = sum(ui * c for ui, c in zip(u, v))
+        ret.append(dot * inv)
+    return ret
+
+def d2_inner_product(qx,qy,u_angd=(0,90),dtype=None):
     """2D cos values
     Args:
         qx (ndarray): 2D ndarray
         qy (ndarray): 2D ndarray
+        dtype (optional): output dtype, e.g. np.float32. Defaults to float64.
         u_angd (tuple, optional): unit vector angle [deg]. Defaults to (0,90).
                 (0,90)
                 ux = np.array([1,0])
@@ -343,27 +664,13 @@ def d2_inner_product(qx,qy,u_angd=(0,90)):
         cos -> 1 same direction, -> -1 opposit direction, -> 0 no compornet
         
     """       
-    ux = np.array([np.cos(np.deg2rad(u_angd[0])),np.sin(np.deg2rad(u_angd[0]))])
-    uy = np.array([np.cos(np.deg2rad(u_angd[1])),np.sin(np.deg2rad(u_angd[1]))])
+    ux = (np.cos(np.deg2rad(u_angd[0])), np.sin(np.deg2rad(u_angd[0])))
+    uy = (np.cos(np.deg2rad(u_angd[1])), np.sin(np.deg2rad(u_angd[1])))
 
-    shape_ = qx.shape
+    qux, quy = inner_cos((qx, qy), (ux, uy), dtype=dtype)
 
-    ux_cos = []
-    uy_cos = []
-    for i,j in zip(qx.flatten(),qy.flatten()):
-        v = np.array([i,j])
-        ux_cos_t = _inner_cos(ux,v)
-        uy_cos_t = _inner_cos(uy,v)
-        
-        ux_cos.append(ux_cos_t)
-        uy_cos.append(uy_cos_t)
-    
-    qux = np.array(ux_cos).reshape(shape_)
-    quy = np.array(uy_cos).reshape(shape_)
-    
     return qux, quy
 
-@np.vectorize
 def curvature_ang(ang,r,printf=True):
     """calculate curvature radius
     
@@ -376,11 +683,13 @@ def curvature_ang(ang,r,printf=True):
     R = (r^2+d^2)/2d
 
     Args:
-        ang (float): tilting angle [deg]
-        r (float): sample radius [m]
+        ang (float or ndarray): tilting angle [deg]
+        r (float or ndarray): sample radius [m]
+        printf (bool, optional): print the result (scalar input only). Defaults to True.
 
     Returns:
         R(float), d(float): curvature radius [m], edge distance [m]
+        arrays for array input (nan where ang or r is nan, inf where ang is 0)
         
     example:
         4 inch: 10.16cm --> 0.1016m, 
@@ -401,33 +710,117 @@ def curvature_ang(ang,r,printf=True):
     """
 
     d = r * np.tan(np.deg2rad(ang))
-    R = (r**2 + d**2)/(2*d)
-    if printf:
+    with np.errstate(divide='ignore', invalid='ignore'):
+        R = (r**2 + d**2)/(2*d)
+    if printf and np.ndim(R) == 0:
         print(f'curvature:{R:.2f} [m], edge distance:{d:.2e} [m]')
 
     return R, d
 
-@np.vectorize
 def curvature_d(d,r,printf=True):
     """calculate curvature radius and angle
     
     Args:
-        d (float): edge distance [m]
-        r (float): sample radius [m]
+        d (float or ndarray): edge distance [m]
+        r (float or ndarray): sample radius [m]
+        printf (bool, optional): print the result (scalar input only). Defaults to True.
 
     Returns:
         R(float), thi(float): curvature radius [m], tilting angle [deg]
+        arrays for array input
     
     Example:
         curvature_d(0.2e-3,100e-3)
     """
     
-    R = (r**2 + d**2)/(2*d)
-    thi =np.rad2deg(np.arctan(d/r))
-    if printf:
-        print(f'curvature:{R:.2f} [m], tilting angle:{r:.3f} [deg]')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        R = (r**2 + d**2)/(2*d)
+        thi =np.rad2deg(np.arctan(d/r))
+    if printf and np.ndim(R) == 0:
+        print(f'curvature:{R:.2f} [m], tilting angle:{thi:.3f} [deg]')
     return R, thi
 
+def _pixel_xy(shape, pixel_size, center=None, dtype=np.float32):
+    """x (axis 0) and y (axis 1) pixel positions [m] from center (default: image center)"""
+    nx, ny = shape
+    cx, cy = ((nx - 1)/2, (ny - 1)/2) if center is None else center
+    x = ((np.arange(nx) - cx) * pixel_size).astype(dtype)[:, None]
+    y = ((np.arange(ny) - cy) * pixel_size).astype(dtype)[None, :]
+    return x, y
+
+def curvature_map(qx,qy,qz,pixel_size,center=None,dtype=np.float32):
+    """curvature radius map from the radial q tilt and the pixel radius (curvature_ang on 2D maps)
+
+    The radial tilt is the component of (qx,qy)/qz along the direction from center,
+    positive when q tilts outward (convex lattice planes).
+    Axis 0 of the maps is x and axis 1 is y (q2.py reshape(NX,NY)).
+
+    Args:
+        qx (ndarray): 2D ndarray
+        qy (ndarray): 2D ndarray
+        qz (ndarray): 2D ndarray
+        pixel_size (float): pixel size [m]
+        center (tuple, optional): wafer center (axis 0, axis 1) [pixel]. Defaults to the image center.
+        dtype (optional): calculation dtype. Defaults to np.float32.
+
+    Returns:
+        dict: {'R':curvature radius [m], 'd':edge distance [m], 'ang':radial tilt [deg], 'r':radius [m]}
+        nan where q is nan and at the center
+
+    Example:
+        q = rean.load_q_tif(out_q_folder)
+        cm = curvature_map(q['x'], q['y'], q['z'], pixel_size=50e-6)
+    """
+    qx = np.asarray(qx, dtype=dtype)
+    qy = np.asarray(qy, dtype=dtype)
+    qz = np.asarray(qz, dtype=dtype)
+    x, y = _pixel_xy(qx.shape, pixel_size, center, dtype)
+    r = np.hypot(x, y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tilt = (qx * x + qy * y) / (r * qz)
+    ang = np.rad2deg(np.arctan(tilt))
+    R, d = curvature_ang(ang, r, printf=False)
+    return {'R':R, 'd':d, 'ang':ang, 'r':np.broadcast_to(r, qx.shape)}
+
+def local_curvature(qx,qy,qz,pixel_size,dtype=np.float32):
+    """local curvature of the lattice planes from the gradients of the tilt (qx/qz, qy/qz)
+
+    kxx = d(qx/qz)/dx, kyy = d(qy/qz)/dy, kxy = (d(qx/qz)/dy + d(qy/qz)/dx)/2,
+    k = (kxx + kyy)/2 (mean curvature, positive for convex), R = 1/k.
+    Axis 0 of the maps is x and axis 1 is y (q2.py reshape(NX,NY)).
+
+    Args:
+        qx (ndarray): 2D ndarray
+        qy (ndarray): 2D ndarray
+        qz (ndarray): 2D ndarray
+        pixel_size (float): pixel size [m]
+        dtype (optional): calculation dtype. Defaults to np.float32.
+
+    Returns:
+        dict: {'kxx', 'kyy', 'kxy', 'k':curvature [1/m], 'R':curvature radius [m]}
+        nan next to nan pixels
+
+    Note:
+        For a sphere of radius R the tilt at radius r is r/R, so k = 1/R.
+        curvature_ang (edge distance model) gives about r/(2*tilt) for the same tilt.
+    """
+    qz = np.asarray(qz, dtype=dtype)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sx = np.asarray(qx, dtype=dtype) / qz
+        sy = np.asarray(qy, dtype=dtype) / qz
+    dsx_dx, dsx_dy = np.gradient(sx, pixel_size)
+    dsy_dx, dsy_dy = np.gradient(sy, pixel_size)
+    kxx = dsx_dx
+    kyy = dsy_dy
+    kxy = (dsx_dy + dsy_dx)/2
+    invalid = ~(np.isfinite(sx) & np.isfinite(sy))
+    for kk in (kxx, kyy, kxy):
+        kk[invalid] = np.nan
+    k = (kxx + kyy)/2
+    with np.errstate(divide='ignore'):
+        R = 1/k
+    return {'kxx':kxx, 'kyy':kyy, 'kxy':kxy, 'k':k, 'R':R}
+
 # --- data statics infos ---
 def static_info(qx,qy,qz):
     """ static infomation
@@ -439,13 +832,9 @@ def static_info(qx,qy,qz):
         qz (float): ndarray
     
     """
-    q_list = [qx,qy,qz]
-    for i in q_list:
-        qav = np.nanmean(i)
-        qmax = np.nanmax(i)
-        qmin = np.nanmin(i)
-        qstd = np.nanstd(i)
-        print(f'ave:{qav}, max:{qmax}, min:{qmin}, std:{qstd}')
+    st = ms.describe([qx, qy, qz], quantiles=())
+    for row in st.result().values():
+        print(f"ave:{row['mean']}, max:{row['max']}, min:{row['min']}, std:{row['std']}")
         
 
 # --- data rotation ---
@@ -571,46 +960,29 @@ def getXY(r, angle, deg_or_rad='deg'):
     return x, y
 
 
-def d3_inner_product(qx,qy,qz):
+def d3_inner_product(qx,qy,qz,units=None,dtype=None):
     """
     3D cos values
     Args:
         qx (ndarray): 2D ndarray
         qy (ndarray): 2D ndarray
         qz (ndarray): 2D ndarray
+        units (list, optional): vectors (x,y,z). Defaults to the x, y, z axes.
+        dtype (optional): output dtype, e.g. np.float32. Defaults to float64.
     Returns:
         qux: 2D ndarray cos values 
         quy: 2D ndarray cos values 
         quz: 2D ndarray cos values
+        (one array for each of units)
     Note: 
         cos -> 1 same direction, -> -1 opposit direction, -> 0 no compornet
     
     """
 
-    ux = np.array([1,0,0])
-    uy = np.array([0,1,0])
-    uz = np.array([0,0,1])
+    if units is None:
+        units = ((1, 0, 0), (0, 1, 0), (0, 0, 1))
 
-    shape_ = qx.shape
+    return tuple(inner_cos((qx, qy, qz), units, dtype=dtype))
 
-    ux_cos = []
-    uy_cos = []
-    uz_cos = []
-    for i,j,k in zip(qx.flatten(),qy.flatten(),qz.flatten()):
-        v = np.array([i,j,k])
-        ux_cos_t = _inner_cos(ux,v)
-        uy_cos_t = _inner_cos(uy,v)
-        uz_cos_t = _inner_cos(uz,v)
-        
-        ux_cos.append(ux_cos_t)
-        uy_cos.append(uy_cos_t)
-        uz_cos.append(uz_cos_t)
-    
-    qux = np.array(ux_cos).reshape(shape_)
-    quy = np.array(uy_cos).reshape(shape_)
-    quz = np.array(uz_cos).reshape(shape_)
-    
-    return qux, quy, quz
-  
 if __name__ == '__main__':
     pass
@@ -0,0 +1,151 @@
+"""
+Virtual cropping of tif (and raw npy) maps: no trimmed copies are written
+
+- save_crop / load_crop / clear_crop: crop descriptor folder/crop.json (x, y, width, height)
+- read_tif: cropped map as a view of the memory-mapped file (uncompressed tif),
+  or decoded from only the strips of the cropped rows (compressed tif)
+- read_npy: cropped view of a raw float32 map (fit.py output)
+- crop_of: crop descriptor of a folder or of the folder of a file
+
+Coordinates are (x, y) = (col, row) of the left top corner like image_treat.trim.
+
+Examples:
+    >>> from qfit import virtual_crop as vc
+    >>> vc.save_crop(fit_folder, 634, 570, 1100, 1100)   # instantaneous, replaces folder2trim2tif
+    >>> rc0 = rean.load_rc_tif(fit_folder)              # maps are (1100, 1100)
+    >>> c = vc.read_tif(fit_folder/'hw_220222_133037_c.tif', vc.load_crop(fit_folder))
+    >>> vc.clear_crop(fit_folder)                        # full maps again
+"""
+
+import json
+from pathlib import Path
+
+import numpy as np
+import tifffile as tiff
+
+CROP_SIDECAR = "crop.json"
+
+
+def save_crop(folder, x, y, width, height, shape=None):
+    """write the crop descriptor folder/crop.json
+
+    Args:
+        folder (str or pathlib): folder of the maps (tif, npy) or raw images (fit.py input)
+        x (int): crop coordinate x (left top)
+        y (int): crop coordinate y (left top)
+        width (int): crop width
+        height (int): crop height
+        shape (tuple, optional): full map shape (rows, cols), needed for headerless npy files.
+
+    Returns:
+        dict: crop descriptor {'x', 'y', 'width', 'height', 'shape'}
+    """
+    x, y, width, height = (int(v) for v in (x, y, width, height))
+    if x < 0 or y < 0 or width <= 0 or height <= 0:
+        raise ValueError(f"illegal crop: x={x}, y={y}, width={width}, height={height}")
+    if shape is not None:
+        shape = [int(v) for v in shape]
+        if y + height > shape[0] or x + width > shape[1]:
+            raise ValueError(f"crop {(x, y, width, height)} exceeds the shape {tuple(shape)}")
+    crop = {"x": x, "y": y, "width": width, "height": height, "shape": shape}
+    with open(Path(folder) / CROP_SIDECAR, "w") as f:
+        json.dump(crop, f, indent=2)
+    return crop
+
+
+def load_crop(folder):
+    """crop descriptor written by save_crop
+
+    Returns:
+        dict: {'x', 'y', 'width', 'height', 'shape'} or None
+    """
+    path = Path(folder) / CROP_SIDECAR
+    if not path.exists():
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def clear_crop(folder):
+    "remove the crop descriptor (the full maps are used again)"
+    path = Path(folder) / CROP_SIDECAR
+    if path.exists():
+        path.unlink()
+
+
+def crop_of(filename_or_path):
+    """crop descriptor of a folder, or of the folder of a file"""
+    p = Path(filename_or_path)
+    return load_crop(p.parent if p.is_file() else p)
+
+
+def crop_slices(crop):
+    "(row slice, col slice) of a crop descriptor"
+    return (slice(crop["y"], crop["y"] + crop["height"]),
+            slice(crop["x"], crop["x"] + crop["width"]))
+
+
+def read_tif(path, crop=None, mmap=True):
+    """cropped tif map without reading the rest of the image where possible
+
+    1. uncompressed contiguous tif: view of the memory-mapped file (read on access)
+    2. stripped tif (e.g. compressed): only the strips of the cropped rows are read and decoded
+    3. otherwise (tiled ...): full image, sliced
+
+    Args:
+        path (str or pathlib): tif file (2D)
+        crop (dict, optional): crop descriptor. Defaults to None (full map).
+        mmap (bool, optional): memory-map uncompressed files. Defaults to True.
+
+    Returns:
+        ndarray: (height, width), read-only view for memory-mapped files
+    """
+    path = str(path)
+    if mmap:
+        try:
+            data = tiff.memmap(path, mode="r")
+        except ValueError:
+            data = None
+        if data is not None:
+            return data if crop is None else data[crop_slices(crop)]
+    if crop is None:
+        return tiff.imread(path)
+
+    rows, cols = crop_slices(crop)
+    with tiff.TiffFile(path) as tf:
+        page = tf.pages[0]
+        if page.is_tiled or page.samplesperpixel != 1 or len(page.dataoffsets) <= 1:
+            return page.asarray()[rows, cols]
+        return _read_rows(tf.filehandle, page, rows.start, rows.stop)[:, cols]
+
+
+def _read_rows(fh, page, start, stop):
+    "rows start:stop of a stripped tif page, only the strips containing them are read"
+    stop = min(stop, page.imagelength)
+    per_strip = page.rowsperstrip
+    first, last = start // per_strip, (stop - 1) // per_strip
+    strips = []
+    for i in range(first, last + 1):
+        fh.seek(page.dataoffsets[i])
+        segment, _, _ = page.decode(fh.read(page.databytecounts[i]), i)
+        strips.append(segment.reshape(-1, page.imagewidth))
+    rows = np.concatenate(strips) if len(strips) > 1 else strips[0]
+    return rows[start - first * per_strip:stop - first * per_strip]
+
+
+def read_npy(path, NX, NY, crop=None):
+    """cropped view of a raw float32 map (np.fromfile format of fit.py output)
+
+    Args:
+        path (str or pathlib): npy file
+        NX (int): number of rows of the full map (crop['shape'] if given)
+        NY (int): number of columns of the full map
+        crop (dict, optional): crop descriptor. Defaults to None (full map).
+
+    Returns:
+        ndarray: memory-mapped (height, width) view
+    """
+    if crop is not None and crop.get("shape"):
+        NX, NY = crop["shape"]
+    data = np.memmap(str(path), dtype=np.float32, mode="r", shape=(NX, NY))
+    return data if crop is None else data[crop_slices(crop)]
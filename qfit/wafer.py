@@ -0,0 +1,283 @@
+"""
+Wafer disk detection (headless)
+
+- detect_wafer: sub-pixel wafer center and radius by a least squares circle fit
+  on the edge points of the wafer region, with optional flat/notch detection
+- wafer_mask: mask of the wafer (circle minus flat) for an image shape
+- save_geometry / load_geometry: json sidecar of the geometry
+- wafer_geometry: geometry of a dataset folder, read from the sidecar if present
+  (in the coordinates of the maps as loaded, i.e. cropped by a crop.json of the folder;
+  wafer_full.json for the full maps of a cropped folder)
+
+Coordinates are (x, y) = (col, row) like cv2.circle and radial_average.
+
+Examples:
+    >>> from qfit import wafer
+    >>> geom = wafer.wafer_geometry(out_folder)  # detects on '_h' and writes wafer.json once
+    >>> dsi, dri = ra.calc_circle_radius_ave(rc0['wt'], wafer.center_int(geom), int(geom['radius']))
+    >>> mask = wafer.wafer_mask(geom)
+"""
+
+import json
+from pathlib import Path
+import warnings
+
+import numpy as np
+from scipy import ndimage
+
+from qfit import virtual_crop as vc
+
+SIDECAR = "wafer.json"
+# geometry on the full maps of a folder with a crop.json (crop=False)
+FULL_SIDECAR = "wafer_full.json"
+
+
+def downsample(image, factor):
+    """block mean of factor x factor pixels (nan skipped, edge pixels that do not fill a block are dropped)"""
+    image = np.asarray(image, dtype=np.float32)
+    if factor <= 1:
+        return image
+    h = image.shape[0] // factor * factor
+    w = image.shape[1] // factor * factor
+    blocks = image[:h, :w].reshape(h // factor, factor, w // factor, factor)
+    with warnings.catch_warnings():
+        # all-nan blocks
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanmean(blocks, axis=(1, 3))
+
+
+def otsu_threshold(values, bins=256):
+    """Otsu threshold of the finite values"""
+    values = values[np.isfinite(values)]
+    if values.size == 0:
+        return np.nan
+    hist, edges = np.histogram(values, bins=bins)
+    centers = (edges[:-1] + edges[1:]) / 2
+    w0 = np.cumsum(hist)
+    w1 = w0[-1] - w0
+    s0 = np.cumsum(hist * centers)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        m0 = s0 / w0
+        m1 = (s0[-1] - s0) / w1
+        between = w0 * w1 * (m0 - m1) ** 2
+    return float(centers[np.nanargmax(between)])
+
+
+def fit_circle(x, y):
+    """algebraic least squares circle (Kasa): x^2 + y^2 + D x + E y + F = 0
+
+    Returns:
+        tuple: cx, cy, r
+    """
+    a = np.column_stack([x, y, np.ones_like(x)])
+    b = -(x ** 2 + y ** 2)
+    (d, e, f), *_ = np.linalg.lstsq(a, b, rcond=None)
+    cx, cy = -d / 2, -e / 2
+    return cx, cy, np.sqrt(max(cx ** 2 + cy ** 2 - f, 0))
+
+
+def _edge_points(mask):
+    edge = mask & ~ndimage.binary_erosion(mask)
+    y, x = np.nonzero(edge)
+    return x.astype(np.float64), y.astype(np.float64)
+
+
+def _detect_flat(angle, residual, tol, flat_span=10.0, gap=3.0):
+    """largest arc of edge points inside the circle: flat (span > flat_span deg) or notch"""
+    idx = np.flatnonzero(residual < -tol)
+    if len(idx) < 3:
+        return None
+    idx = idx[np.argsort(angle[idx])]
+    ang = angle[idx]
+    # split into arcs at gaps, join the arc crossing +-180
+    breaks = np.flatnonzero(np.diff(ang) > gap) + 1
+    arcs = [(a, i) for a, i in zip(np.split(ang, breaks), np.split(idx, breaks))]
+    if len(arcs) > 1 and ang[0] + 360 - ang[-1] <= gap:
+        last = arcs.pop()
+        arcs[0] = (np.concatenate([last[0] - 360, arcs[0][0]]), np.concatenate([last[1], arcs[0][1]]))
+    ang, idx = max(arcs, key=lambda arc: len(arc[1]))
+    if len(idx) < 3:
+        return None
+    span = float(ang[-1] - ang[0])
+    center = float(np.mod((ang[0] + ang[-1]) / 2 + 180, 360) - 180)
+    return {"type": "flat" if span > flat_span else "notch", "angle": center,
+            "span": span, "depth": float(-residual[idx].min())}
+
+
+def detect_wafer(image, factor=4, threshold=None, flat=True, iterations=3, clip=3.0):
+    """wafer center and radius (sub-pixel) from a map where the wafer is brighter than the background
+
+    1. block mean downsampling by factor, 2. Otsu threshold (or threshold), nan is background,
+    3. largest region with holes filled, 4. least squares circle on its edge points,
+    refitted without outliers (|residual| > clip * MAD, e.g. a flat or a notch),
+    5. optional flat/notch from the edge points inside the circle.
+
+    Args:
+        image (2d-ndarray): e.g. RC height map 'h' (nan allowed)
+        factor (int, optional): downsampling factor. Defaults to 4.
+        threshold (float, optional): wafer threshold. Defaults to Otsu.
+        flat (bool, optional): detect a flat/notch. Defaults to True.
+        iterations (int, optional): outlier rejection iterations. Defaults to 3.
+        clip (float, optional): outlier limit in MAD. Defaults to 3.0.
+
+    Returns:
+        dict: {'center': (x, y), 'radius', 'rms' (edge residual) [pixel, full resolution],
+               'shape', 'factor', 'threshold', 'edge_points', 'flat': {'type', 'angle' [deg], 'span' [deg], 'depth' [pixel]} or None}
+        None if no wafer region is found
+    """
+    image = np.asarray(image, dtype=np.float32)
+    nan = ~np.isfinite(image)
+    if nan.any() and not nan.all():
+        # nan (e.g. the pixels not fitted in the 'h' map) is the background class:
+        # below every finite value, so Otsu separates it from the wafer
+        # (filled before downsampling, the edge blocks are partly background)
+        lo, hi = np.nanmin(image), np.nanmax(image)
+        image = np.where(nan, lo - (hi - lo) - 1, image)
+    small = downsample(image, factor)
+    if threshold is None:
+        threshold = otsu_threshold(small)
+    with np.errstate(invalid="ignore"):
+        region = np.nan_to_num(small, nan=-np.inf) > threshold
+    labels, num = ndimage.label(region)
+    if num == 0:
+        return None
+    sizes = np.bincount(labels.ravel())[1:]
+    mask = ndimage.binary_fill_holes(labels == (np.argmax(sizes) + 1))
+    x, y = _edge_points(mask)
+    if len(x) < 5:
+        return None
+
+    use = np.ones(len(x), dtype=bool)
+    for _ in range(iterations + 1):
+        cx, cy, r = fit_circle(x[use], y[use])
+        residual = np.hypot(x - cx, y - cy) - r
+        mad = 1.4826 * np.median(np.abs(residual[use] - np.median(residual[use])))
+        new = np.abs(residual) <= max(clip * mad, 1.0)
+        if new.sum() < 5 or np.array_equal(new, use):
+            break
+        use = new
+
+    # block centers -> full resolution pixel coordinates,
+    # the edge points are the outermost wafer pixels: the edge is half a pixel outside
+    scale = max(factor, 1)
+    offset = (scale - 1) / 2
+    geom = {
+        "center": (float(cx * scale + offset), float(cy * scale + offset)),
+        "radius": float((r + 0.5) * scale),
+        "rms": float(np.sqrt(np.mean(residual[use] ** 2)) * scale),
+        "shape": list(image.shape),
+        "factor": int(factor),
+        "threshold": float(threshold),
+        "edge_points": int(use.sum()),
+        "flat": None,
+    }
+    if flat:
+        angle = np.rad2deg(np.arctan2(y - cy, x - cx))
+        info = _detect_flat(angle, residual, tol=max(clip * mad, 1.0))
+        if info is not None:
+            info["depth"] = (info["depth"] - 0.5) * scale
+        geom["flat"] = info
+    return geom
+
+
+def plausible(geom, max_rms=0.02, min_radius=0.05):
+    """sanity check of a detect_wafer output
+
+    Args:
+        geom (dict): detect_wafer output
+        max_rms (float, optional): largest edge rms relative to the radius. Defaults to 0.02.
+        min_radius (float, optional): smallest radius relative to the short side of the image. Defaults to 0.05.
+
+    Returns:
+        bool: the center is inside the image, the radius and the edge rms are plausible
+    """
+    if geom is None:
+        return False
+    rows, cols = geom["shape"]
+    cx, cy = geom["center"]
+    radius = geom["radius"]
+    return (0 <= cx < cols and 0 <= cy < rows
+            and radius >= min_radius * min(rows, cols)
+            and geom["rms"] <= max_rms * radius)
+
+
+def center_int(geom):
+    "integer center (x, y) for cv2 based functions"
+    return int(round(geom["center"][0])), int(round(geom["center"][1]))
+
+
+def wafer_mask(geom, shape=None, margin=0.0):
+    """bool mask of the wafer: circle (radius - margin) without the flat/notch segment
+
+    Args:
+        geom (dict): detect_wafer output
+        shape (tuple, optional): image shape. Defaults to geom['shape'].
+        margin (float, optional): edge exclusion [pixel]. Defaults to 0.
+
+    Returns:
+        ndarray: bool (rows, cols)
+    """
+    shape = tuple(geom["shape"]) if shape is None else tuple(shape)
+    cx, cy = geom["center"]
+    dy = (np.arange(shape[0], dtype=np.float32) - np.float32(cy))[:, None]
+    dx = (np.arange(shape[1], dtype=np.float32) - np.float32(cx))[None, :]
+    radius = geom["radius"] - margin
+    mask = dx * dx + dy * dy <= np.float32(radius * radius)
+    info = geom.get("flat")
+    if info is not None and info["type"] == "flat":
+        # chord at distance radius - depth along the flat direction
+        t = np.deg2rad(info["angle"])
+        mask &= dx * np.float32(np.cos(t)) + dy * np.float32(np.sin(t)) <= np.float32(geom["radius"] - info["depth"] - margin)
+    return mask
+
+
+def save_geometry(path, geom):
+    "write geometry json"
+    with open(path, "w") as f:
+        json.dump(geom, f, indent=2)
+
+
+def load_geometry(path):
+    "read geometry json (center as tuple)"
+    with open(path) as f:
+        geom = json.load(f)
+    geom["center"] = tuple(geom["center"])
+    return geom
+
+
+def wafer_geometry(folder, image=None, key="h", refresh=False, crop=True, **kwargs):
+    """wafer geometry of a dataset folder, cached as folder/wafer.json
+
+    Args:
+        folder (str or pathlib): RC output folder (or any folder for the sidecar)
+        image (2d-ndarray, optional): map used for the detection. Defaults to the key map of the folder.
+        key (str, optional): RC map for the detection. Defaults to 'h'.
+        refresh (bool, optional): detect again and overwrite the sidecar. Defaults to False.
+        crop (bool, optional): crop the key map by the crop.json of the folder (virtual_crop). Defaults to True.
+            False uses the sidecar wafer_full.json if the folder has a crop.json.
+        kwargs: detect_wafer arguments
+
+    Returns:
+        dict: detect_wafer output and 'crop', the crop descriptor of its coordinates (None: full maps).
+            Not written to the sidecar if not plausible.
+    """
+    folder_crop = vc.load_crop(folder)
+    frame = folder_crop if crop else None
+    path = Path(folder) / (SIDECAR if crop or folder_crop is None else FULL_SIDECAR)
+    if image is None:
+        # memory-mapped: only read for a new detection
+        from qfit import re_analysis as rean
+        image = rean.RCMap.from_folder(folder, crop=crop)[key]
+    if path.exists() and not refresh:
+        geom = load_geometry(path)
+        if tuple(geom["shape"]) == np.shape(image) and geom.get("crop") == frame:
+            return geom
+    geom = detect_wafer(image, **kwargs)
+    if geom is not None:
+        geom["crop"] = frame
+    if plausible(geom):
+        save_geometry(path, geom)
+    elif geom is not None:
+        warnings.warn(f"implausible wafer geometry (center {geom['center']}, radius {geom['radius']:.1f}, "
+                      f"rms {geom['rms']:.2f}), {path} is not written")
+    return geom